@@ -1,67 +1,3866 @@
 import sys
 import os
+# Keep stdout clean for the command line tools (bench writes JSON there)
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
 import pygame
 from pygame.locals import *
 import threading
+import queue
+import atexit
 import time
+import math
 import random
 import logging
+import struct
+import zlib
+import mmap
+import shutil
+import sqlite3
+import argparse
+import subprocess
+import json
+import hashlib
+import re
+import glob
+import platform
+import tempfile
+import warnings
+import io
+import importlib.util
+# concurrent.futures loads its process pool (used by exports) on first use
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
+from array import array
+from collections import OrderedDict, deque
 
 # Configure logging to use our custom handler (which displays in the window)
 logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
 
-# For file dialogs, microphone selection, and other dialogs
-import tkinter as tk
-from tkinter import filedialog, simpledialog
+# Optional subsystems are only looked up here and imported when first used,
+# so they cost nothing at startup: Tk for file dialogs, microphone selection
+# and other dialogs (see ask_dialog; the editor runs headless without it),
+# PyAudio for recording (see AudioDeviceManager) and Pillow for quantizing
+# true-colour frames in GIF export and for imports.
+TK_AVAILABLE = importlib.util.find_spec("tkinter") is not None
+PYAUDIO_AVAILABLE = importlib.util.find_spec("pyaudio") is not None
+PIL_AVAILABLE = importlib.util.find_spec("PIL") is not None
+if not PYAUDIO_AVAILABLE:
+    logging.error("PyAudio not found. Using VirtualMicrophone.")
+
+import wave
+
+# NumPy is optional; signal generation falls back to array/bytes tricks.
+try:
+    import numpy
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
+# audioop (C, removed in Python 3.13) speeds up the audio codec; there is a
+# pure-Python fallback that produces the same bytes.
+try:
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", DeprecationWarning)
+        import audioop
+    AUDIOOP_AVAILABLE = True
+except ImportError:
+    AUDIOOP_AVAILABLE = False
+
+# Images that ship next to this script
+ASSET_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# GIF export is self-contained; MP4 export pipes frames into an `ffmpeg`
+# executable found on PATH.
+
+# Custom logging handler to store messages for display in the Pygame window
+class PygameLogHandler(logging.Handler):
+    def __init__(self, studio, capacity=10):
+        super().__init__()
+        self.studio = studio
+        self.capacity = capacity
+
+    def emit(self, record):
+        msg = self.format(record)
+        self.studio.log_messages.append(msg)
+        if len(self.studio.log_messages) > self.capacity:
+            self.studio.log_messages.pop(0)
+        self.studio.log_surfaces = None
+        self.studio.invalidate(self.studio.log_area_rect)
+
+class VirtualMicrophone:
+    """
+    Simulates a microphone with a synthetic 8-bit unsigned mono signal.
+
+    Signals: "noise" (seedable, so runs are reproducible), "sine" (a
+    repeating sweep from `frequency[0]` to `frequency[1]` and back over
+    `sweep_seconds`), "silence" and "wav" (loops `wav_path`, converted to
+    8-bit mono at `rate`). Whole buffers are produced at once: noise comes
+    straight from Random.randbytes, the other signals are rendered once
+    into a loop buffer that read() slices. With `realtime` on, read() blocks
+    so data arrives at exactly `rate` samples per second, like real hardware.
+    """
+    SIGNALS = ("noise", "sine", "silence", "wav")
+
+    def __init__(self, chunk=1024, rate=44100, signal="noise", seed=None, realtime=True,
+                 frequency=(220.0, 1760.0), sweep_seconds=2.0, amplitude=0.8, wav_path=None):
+        if signal not in self.SIGNALS:
+            raise ValueError(f"Unknown signal {signal!r}; expected one of {self.SIGNALS}")
+        self.chunk = chunk
+        self.rate = rate
+        self.signal = signal
+        self.realtime = realtime
+        self.samples_read = 0
+        self._start = None
+        self._random = random.Random(seed)
+        self._pos = 0
+        if signal == "sine":
+            self._loop = self._render_sweep(frequency, sweep_seconds, amplitude)
+        elif signal == "silence":
+            self._loop = b"\x80" * chunk
+        elif signal == "wav":
+            self._loop = self._load_wav(wav_path)
+        else:
+            self._loop = None
+
+    def read(self, size):
+        """Return `size` samples (one byte each)."""
+        if self._loop is None:
+            data = self._random.randbytes(size)
+        else:
+            data = self._read_loop(size)
+        self.samples_read += size
+        if self.realtime:
+            self._pace()
+        return data
+
+    def _read_loop(self, size):
+        loop = self._loop
+        parts = []
+        while size > 0:
+            part = loop[self._pos:self._pos + size]
+            parts.append(part)
+            size -= len(part)
+            self._pos = (self._pos + len(part)) % len(loop)
+        return b"".join(parts)
+
+    def _pace(self):
+        """Sleep until the wall clock has caught up with the samples handed out."""
+        now = time.perf_counter()
+        if self._start is None:
+            self._start = now
+        ahead = self._start + self.samples_read / float(self.rate) - now
+        if ahead > 0:
+            time.sleep(ahead)
+
+    def _render_sweep(self, frequency, seconds, amplitude):
+        """
+        One up-and-down linear sweep. The length is nudged so the loop holds
+        a whole number of cycles and repeats without a click.
+        """
+        f0, f1 = frequency
+        mean = (f0 + f1) / 2.0
+        cycles = max(1, round(mean * seconds))
+        n = max(2, int(round(cycles * self.rate / mean)))
+        half = n // 2
+        if NUMPY_AVAILABLE:
+            ramp = numpy.linspace(0.0, 1.0, half, endpoint=False)
+            freqs = f0 + (f1 - f0) * numpy.concatenate([ramp, 1.0 - ramp, [0.0] * (n - 2 * half)])
+            phase = numpy.cumsum(2 * numpy.pi * freqs / self.rate)
+            wave_data = 128 + 127 * amplitude * numpy.sin(phase)
+            return numpy.clip(wave_data, 0, 255).astype(numpy.uint8).tobytes()
+        out = array("B", bytes(n))
+        phase = 0.0
+        step = 2 * math.pi / self.rate
+        for i in range(n):
+            x = i / half if i < half else max(0.0, 2.0 - i / half)
+            phase += step * (f0 + (f1 - f0) * x)
+            out[i] = int(128 + 127 * amplitude * math.sin(phase))
+        return out.tobytes()
+
+    def _load_wav(self, wav_path):
+        """Decode a PCM WAV file to 8-bit unsigned mono at self.rate."""
+        with wave.open(wav_path, "rb") as wf:
+            channels, width, src_rate = wf.getnchannels(), wf.getsampwidth(), wf.getframerate()
+            raw = wf.readframes(wf.getnframes())
+        if width not in (1, 2):
+            raise ValueError("Only 8- and 16-bit WAV files can be replayed")
+        if NUMPY_AVAILABLE:
+            if width == 1:
+                samples = numpy.frombuffer(raw, numpy.uint8).astype(numpy.int16) - 128
+            else:
+                samples = numpy.frombuffer(raw, "<i2") >> 8
+            samples = samples.reshape(-1, channels).mean(axis=1)
+            if src_rate != self.rate:
+                src_t = numpy.arange(len(samples)) / float(src_rate)
+                dst_t = numpy.arange(int(len(samples) * self.rate / src_rate)) / float(self.rate)
+                samples = numpy.interp(dst_t, src_t, samples)
+            return (samples + 128).clip(0, 255).astype(numpy.uint8).tobytes() or b"\x80"
+        if width == 1:
+            samples = array("B", raw)[::channels]
+        else:
+            signed = array("h", raw)
+            if sys.byteorder == "big":
+                signed.byteswap()
+            samples = bytes(((v >> 8) + 128) for v in signed[::channels])
+        step = src_rate / float(self.rate)
+        count = int(len(samples) / step)
+        return bytes(samples[int(i * step)] for i in range(count)) or b"\x80"
+
+
+class WavStreamWriter:
+    """
+    Writes PCM audio to a WAV file while it is being recorded.
+
+    The recording thread hands chunks to write(), which puts them on a
+    bounded queue; a writer thread appends them to the file. The RIFF and
+    data sizes in the header are patched every `patch_interval` seconds and
+    on close() (also run at interpreter exit), so the file on disk is a
+    valid WAV even if the app dies mid-take. Memory use is bounded by the
+    queue, however long the recording. `level` (RMS) and `peak` (0.0-1.0)
+    describe the most recent chunk; `peak_hold` decays slowly for meters.
+    """
+    HEADER_SIZE = 44
+    _SQUARES = [(v - 128) ** 2 for v in range(256)]
+
+    def __init__(self, file_path, rate=44100, channels=1, sampwidth=1, max_chunks=64, patch_interval=1.0):
+        self.file_path = file_path
+        self.rate = rate
+        self.channels = channels
+        self.sampwidth = sampwidth
+        self.patch_interval = patch_interval
+        self.data_size = 0
+        self.level = 0.0
+        self.peak = 0.0
+        self.peak_hold = 0.0
+        self.queue = queue.Queue(maxsize=max_chunks)
+        self._file = open(file_path, "wb")
+        self._write_header()
+        self._closed = False
+        self._thread = threading.Thread(target=self._drain, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _write_header(self):
+        block_align = self.channels * self.sampwidth
+        self._file.seek(0)
+        self._file.write(struct.pack("<4sI4s4sIHHIIHH4sI",
+                                     b"RIFF", 36 + self.data_size, b"WAVE",
+                                     b"fmt ", 16, 1, self.channels, self.rate,
+                                     self.rate * block_align, block_align, self.sampwidth * 8,
+                                     b"data", self.data_size))
+
+    def write(self, chunk):
+        """Queue a chunk for writing and update the meter (8-bit unsigned PCM)."""
+        if self.sampwidth == 1 and chunk:
+            self.level = (sum(map(self._SQUARES.__getitem__, chunk)) / len(chunk)) ** 0.5 / 128.0
+            self.peak = max(max(chunk) - 128, 128 - min(chunk)) / 128.0
+            self.peak_hold = max(self.peak, self.peak_hold * 0.95)
+        self.queue.put(chunk)
+
+    def _drain(self):
+        """Writer thread: append queued chunks, patching the header as it goes."""
+        last_patch = time.monotonic()
+        patched_size = 0
+        while True:
+            try:
+                chunk = self.queue.get(timeout=self.patch_interval)
+            except queue.Empty:
+                chunk = b""
+            if chunk is None:
+                break
+            self._file.write(chunk)
+            self.data_size += len(chunk)
+            now = time.monotonic()
+            if self.data_size != patched_size and now - last_patch >= self.patch_interval:
+                self._patch_header()
+                patched_size = self.data_size
+                last_patch = now
+        self._patch_header()
+
+    def _patch_header(self):
+        end = self._file.tell()
+        self._write_header()
+        self._file.seek(end)
+        self._file.flush()
+
+    def close(self):
+        """Flush everything that was queued and finalize the header."""
+        if self._closed:
+            return
+        self._closed = True
+        atexit.unregister(self.close)
+        self.queue.put(None)
+        self._thread.join()
+        self._file.close()
+
+
+class AudioDeviceManager:
+    """
+    One PyAudio instance for the whole session.
+
+    start() imports PyAudio, initialises PortAudio and lists the input
+    devices on a background thread, once; `devices` holds what is known so
+    far and never blocks. The input stream of the selected device is opened
+    ahead of time (warm()) and only started and stopped around takes, so
+    pressing record does not pay for PortAudio start-up, device enumeration
+    and stream setup. Without PyAudio, or if it fails to start, `available`
+    turns False and recording falls back to a VirtualMicrophone.
+    """
+    def __init__(self, rate=44100, channels=1, chunk=1024):
+        self.rate = rate
+        self.channels = channels
+        self.chunk = chunk
+        self.available = PYAUDIO_AVAILABLE
+        self.devices = []  # (index, name) of the input devices
+        self._pa = None
+        self._format = None
+        self._stream = None
+        self._stream_device = None
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._thread = None
+
+    def start(self, device=None):
+        """Bring PortAudio up in the background and warm up `device` (None: the default input)."""
+        if self._thread is not None:
+            return
+        if not self.available:
+            self._ready.set()
+            return
+        self._thread = threading.Thread(target=self._start, args=(device,), daemon=True,
+                                        name="slipnote-audio")
+        self._thread.start()
+
+    def _start(self, device):
+        try:
+            import pyaudio
+            self._pa = pyaudio.PyAudio()
+            self._format = pyaudio.paUInt8  # WAV stores 8-bit samples unsigned
+            self.devices = self._enumerate()
+        except Exception as e:
+            logging.error("Could not start PyAudio: %s", e)
+            self.available = False
+            self._ready.set()
+            return
+        self._ready.set()
+        try:
+            self.warm(device)
+        except Exception as e:
+            logging.error("Could not open input device %s: %s", device, e)
+
+    def _enumerate(self):
+        devices = []
+        for i in range(self._pa.get_device_count()):
+            info = self._pa.get_device_info_by_index(i)
+            if info.get("maxInputChannels", 0) > 0:
+                devices.append((i, info.get("name", "Unknown")))
+        return devices
+
+    def wait_ready(self, timeout=None):
+        """Block until start() has finished (for use off the main thread)."""
+        return self._ready.wait(timeout)
+
+    def warm(self, device):
+        """Open the input stream of `device` without starting it, closing any other."""
+        with self._lock:
+            if self._pa is None or (self._stream is not None and self._stream_device == device):
+                return
+            self._close_stream()
+            self._stream = self._pa.open(format=self._format, channels=self.channels, rate=self.rate,
+                                         input=True, frames_per_buffer=self.chunk,
+                                         input_device_index=device, start=False)
+            self._stream_device = device
+
+    def open_input(self, device):
+        """Start the (warm) input stream of `device` and return it."""
+        self.start(device)
+        self.wait_ready()
+        if not self.available:
+            raise RuntimeError("PyAudio is not available")
+        try:
+            self.warm(device)
+            self._stream.start_stream()
+        except Exception:
+            with self._lock:
+                self._close_stream()
+            raise
+        return self._stream
+
+    def close_input(self):
+        """Stop the stream after a take; it stays open for the next one."""
+        with self._lock:
+            if self._stream is not None and self._stream.is_active():
+                self._stream.stop_stream()
+
+    def _close_stream(self):
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+            self._stream_device = None
+
+    def close(self):
+        """Close the stream and shut PortAudio down."""
+        if self._thread is not None:
+            self._ready.wait()
+        with self._lock:
+            self._close_stream()
+            if self._pa is not None:
+                self._pa.terminate()
+                self._pa = None
+
+
+# -----------------------------------------------------------------------------
+# .slip CONTAINER
+# -----------------------------------------------------------------------------
+# Layout (all integers little-endian):
+#
+#   header   magic "SLIP", version, width, height, fps, frame_count, toc_offset
+#   frames   one compressed payload per frame, written back to back
+#   chunks   palette ("PAL "), frame index ("FIDX"), audio ("AUD "), ...
+#   toc      chunk count followed by (tag, offset, length) per chunk
+#
+# The header version is 2 for the first container layout (version 1 was the
+# original pickle of RGBA frames, which still loads), and 3 since vector frames
+# were added. Readers accept every container version up to SLIP_VERSION.
+#
+# Each frame index entry holds the payload offset/length, its encoding and the
+# keyframe it depends on. A pixel frame is a keyframe or a delta against the
+# frame before it, and at most SLIP_KEYFRAME_INTERVAL frames share a keyframe,
+# so a frame is decoded from its keyframe's payload and the deltas up to it.
+# The deltas are stored back to back after the keyframe, but the keyframe's
+# payload may lie elsewhere (see below). Vector frames hold the list of
+# strokes drawn on blank paper instead of pixels and are rasterized when read;
+# they are their own keyframe and never take part in a delta chain. Identical
+# frames are stored once: a frame that matches an earlier key (or vector) frame
+# gets an index entry pointing at the same payload, with itself as its
+# keyframe, and the deltas that follow it are read against that payload.
+#
+# A note can also have background layers, shared by all of its frames and
+# stored once in a "LAYR" chunk: per layer, bottom first, its encoding and
+# payload length followed by the payload (pixels as a keyframe, or strokes).
+# Frames are drawn over the flattened backgrounds with paper white left
+# transparent. In readers and FrameStores background layer k goes by the
+# frame number -1 - k, so the code that reads and edits frames serves both.
+SLIP_MAGIC = b"SLIP"
+SLIP_VERSION = 3
+SLIP_HEADER = struct.Struct("<4sHHHHIQ")
+SLIP_TOC_ENTRY = struct.Struct("<4sQQ")
+SLIP_INDEX_ENTRY = struct.Struct("<QIBI")
+SLIP_LAYER_ENTRY = struct.Struct("<BI")
+SLIP_KEYFRAME_INTERVAL = 16
+
+# Frame payload encodings; ENC_DELTA is OR-ed in when the payload is XOR-ed
+# against the previous frame.
+ENC_PLANE1 = 1    # 1-bit plane, for notes with at most two colours
+ENC_STROKES = 2   # vector frame: the strokes, see encode_strokes()
+ENC_INDEX8 = 8    # one palette index per pixel
+ENC_RGB24 = 24    # fallback for notes with more than 256 colours
+ENC_DELTA = 0x80
+
+
+class SlipFormatError(Exception):
+    """Raised when a .slip file is truncated or not a slipnote at all."""
+
+
+def _xor_bytes(a, b):
+    """XOR two equally sized byte strings in one big-integer operation."""
+    x = int.from_bytes(a, "little") ^ int.from_bytes(b, "little")
+    return x.to_bytes(len(a), "little")
+
+
+_PLANE1_TO_ASCII = bytes.maketrans(b"\x00\x01", b"01")
+_ASCII_TO_PLANE1 = bytes.maketrans(b"01", b"\x00\x01")
+
+
+def _pack_plane1(indices):
+    """Pack 0/1 index bytes into a bit plane (8 pixels per byte)."""
+    bits = indices.translate(_PLANE1_TO_ASCII)
+    pad = -len(bits) % 8
+    return int(bits + b"0" * pad, 2).to_bytes((len(bits) + pad) // 8, "big")
+
+
+def _unpack_plane1(plane, count):
+    """Inverse of _pack_plane1."""
+    bits = bin(int.from_bytes(plane, "big"))[2:].zfill(len(plane) * 8)
+    return bits[:count].encode("ascii").translate(_ASCII_TO_PLANE1)
+
+
+def _pack_colour(colour):
+    """Pack an (r, g, b) tuple the way _surface_pixels() lays it out."""
+    return array("I", bytes((colour[0], colour[1], colour[2], 255)))[0]
+
+
+def _unpack_colour(value):
+    return tuple(array("I", [value]).tobytes()[:3])
+
+
+def _surface_pixels(surface):
+    """
+    Return a Surface's pixels as packed colours. The padding byte of "RGBX"
+    mirrors whatever SDL left there, so it is forced to 255 first.
+    """
+    buf = bytearray(pygame.image.tostring(surface, "RGBX"))
+    buf[3::4] = b"\xff" * (len(buf) // 4)
+    return array("I", buf)
+
+
+def surface_colours(surface):
+    """Return the set of packed colours used by a frame Surface."""
+    return set(_surface_pixels(surface))
+
+
+def build_palette(colours):
+    """
+    Turn a set of packed colours into an ordered palette of RGB tuples.
+    Paper white and ink black come first so plain drawings stay 1-bit.
+    Returns None when the note has more colours than an 8-bit index can hold.
+    """
+    if len(colours) > 256:
+        return None
+    palette = [_unpack_colour(c) for c in colours]
+    palette.sort(key=lambda c: (c != (255, 255, 255), c != (0, 0, 0), c))
+    return palette
+
+
+def surface_to_indices(surface, palette):
+    """Map every pixel of a Surface to its index in the palette."""
+    lut = {_pack_colour(c): i for i, c in enumerate(palette)}
+    return bytes(map(lut.__getitem__, _surface_pixels(surface)))
+
+
+def indices_to_surface(indices, size, palette):
+    """Build a display Surface from palette indices."""
+    indexed = pygame.image.frombuffer(indices, size, "P")
+    indexed.set_palette(palette)
+    surface = pygame.Surface(size)
+    surface.blit(indexed, (0, 0))
+    return surface
+
+
+def padded_palette(palette):
+    """
+    A palette filled up to 256 entries with repeats of its first colour, so
+    frames with the same palette have identical ones (SDL then blits them
+    as plain copies) and colour lookups only ever match real entries.
+    """
+    return list(palette) + [palette[0]] * (256 - len(palette))
+
+
+def indexed_surface(indices, size, palette):
+    """An 8-bit Surface holding palette indices; pygame.draw works on it directly."""
+    surface = pygame.image.fromstring(indices, size, "P")
+    surface.set_palette(padded_palette(palette))
+    return surface
+
+
+# -----------------------------------------------------------------------------
+# BUCKET FILL
+# -----------------------------------------------------------------------------
+# Masks are bytearrays with one byte (0 or 1) per pixel, row by row, so the
+# fill can step along a row with bytearray.find/rfind and mark whole spans
+# with slice assignment, and masks can be grown by shifting them as one big
+# integer. No pixel is visited from Python.
+
+_INVERT_MASK = bytes.maketrans(b"\x00\x01", b"\x01\x00")
+
+
+def _match_mask(surface, colour, tolerance):
+    """Pixels whose colour is within `tolerance` of `colour` in every channel."""
+    if surface.get_bitsize() == 8:
+        table = bytes(max(abs(a - b) for a, b in zip(c, colour)) <= tolerance
+                      for c in surface.get_palette())
+        return bytearray(pygame.image.tostring(surface, "P").translate(table.ljust(256, b"\0")))
+    mask = pygame.mask.from_threshold(surface, colour, (tolerance + 1,) * 3 + (255,))
+    flags = pygame.Surface(surface.get_size(), 0, 8)
+    flags.set_palette([(0, 0, 0), (1, 1, 1)])
+    mask.to_surface(flags, setcolor=(1, 1, 1), unsetcolor=(0, 0, 0))
+    return bytearray(pygame.image.tostring(flags, "P"))
+
+
+def _grow_mask(mask, width, steps, within=None):
+    """Grow a mask `steps` pixels into its 4-neighbours, staying inside `within`."""
+    count = len(mask)
+    row = b"\x01" * (width - 1)
+    not_first = int.from_bytes((b"\x00" + row) * (count // width), "big")
+    not_last = int.from_bytes((row + b"\x00") * (count // width), "big")
+    bound = int.from_bytes(within if within is not None else b"\x01" * count, "big")
+    value = int.from_bytes(mask, "big")
+    shift = 8 * width
+    for _ in range(steps):
+        value = (value | (value << 8) & not_last | (value >> 8) & not_first
+                 | value << shift | value >> shift) & bound
+    return bytearray(value.to_bytes(count, "big"))
+
+
+def _scan_fill(mask, width, height, x, y):
+    """
+    Span-based 4-connected flood fill of `mask` from (x, y). Each span is
+    found with one find/rfind pair and the rows above and below are only
+    searched for runs of fillable pixels under it. Returns the filled
+    region and its bounding Rect; the filled pixels are cleared in `mask`.
+    """
+    region = bytearray(len(mask))
+    top, bottom, left_edge, right_edge = height, -1, width, -1
+    stack = [(x, y)]
+    while stack:
+        x, y = stack.pop()
+        row = y * width
+        if not mask[row + x]:
+            continue
+        left = mask.rfind(0, row, row + x) + 1 or row
+        right = mask.find(0, row + x, row + width)
+        if right < 0:
+            right = row + width
+        mask[left:right] = bytes(right - left)
+        region[left:right] = b"\x01" * (right - left)
+        top, bottom = min(top, y), max(bottom, y)
+        left_edge, right_edge = min(left_edge, left - row), max(right_edge, right - row)
+        for next_y in (y - 1, y + 1):
+            if 0 <= next_y < height:
+                next_row = next_y * width
+                pos, end = next_row + left - row, next_row + right - row
+                while pos >= 0:
+                    pos = mask.find(1, pos, end)
+                    if pos < 0:
+                        break
+                    stack.append((pos - next_row, next_y))
+                    pos = mask.find(0, pos, end)
+    return region, pygame.Rect(left_edge, top, right_edge - left_edge, bottom - top + 1)
+
+
+def fill_region(surface, pos, tolerance=0, gap=0):
+    """
+    The pixels a bucket fill at `pos` paints: the 4-connected area of
+    colours within `tolerance` of the one at `pos`. With `gap` > 0 openings
+    in the outline up to about 2 * gap pixels wide are closed: the fill runs
+    with the outline thickened by `gap` and then grows back up to the real
+    outline. Returns (region, bounding Rect), or (None, None) outside the
+    surface.
+    """
+    width, height = surface.get_size()
+    x, y = pos
+    if not (0 <= x < width and 0 <= y < height):
+        return None, None
+    mask = _match_mask(surface, surface.get_at(pos)[:3], tolerance)
+    if gap > 0:
+        walls = _grow_mask(mask.translate(_INVERT_MASK), width, gap)
+        inside = walls.translate(_INVERT_MASK)
+        if inside[y * width + x]:
+            region, rect = _scan_fill(inside, width, height, x, y)
+            # Corners of the thickened outline are 2 * gap steps from the real ones
+            region = _grow_mask(region, width, 2 * gap, within=mask)
+            return region, rect.inflate(4 * gap, 4 * gap).clip(surface.get_rect())
+        # Seed inside a gap-sized nook: fill without closing gaps
+    return _scan_fill(mask, width, height, x, y)
+
+
+def paint_region(surface, region, colour):
+    """Paint the pixels of a fill_region() region in `colour`, in a single blit."""
+    stencil = pygame.image.frombuffer(region, surface.get_size(), "P")
+    stencil.set_palette([(0, 0, 0), colour])
+    stencil.set_colorkey(0)
+    surface.blit(stencil, (0, 0))
+
+
+def flood_fill(surface, pos, colour, tolerance=0, gap=0):
+    """Bucket fill at `pos`; returns the Rect that may have changed (or None)."""
+    region, rect = fill_region(surface, pos, tolerance, gap)
+    if region is not None:
+        paint_region(surface, region, colour)
+    return rect
+
+
+class Stroke:
+    """
+    A brush or line stroke as it was drawn: tool, colour, width and the
+    points, each (x, y, t, pressure) with t in milliseconds since the stroke
+    began and pressure 0-255 (always 255 until there is tablet input).
+    Smooth strokes pass through their points along a Catmull-Rom spline,
+    the others connect them with straight segments. The eraser is a brush
+    in paper white. A bucket fill is a stroke too: one point where it
+    was clicked, with the fill tolerance in place of the pressure and the
+    gap closing size as its width; it is replayed on whatever the strokes
+    before it drew.
+
+    polyline() is what both the live brush and draw() hand to
+    pygame.draw.lines, so a frame rebuilt from its strokes matches the one
+    drawn live; with scale > 1 the same curve is drawn at a higher
+    resolution. Segment i (from point i to i + 1) of a smooth stroke also
+    depends on point i + 2, so while drawing it can only be drawn once that
+    point exists (see complete_segments).
+    """
+    TOOLS = ("brush", "line", "eraser", "fill")
+    SMOOTH = 0x80  # OR-ed into the tool byte
+    HEADER = struct.Struct("<BBBBBI")  # tool, r, g, b, width, point count
+    POINT = struct.Struct("<hhHB")
+    SPLINE_STEP = 3  # pixels between samples of a smooth segment
+
+    def __init__(self, tool, colour, width, points=None, smooth=False):
+        self.tool = tool
+        self.colour = tuple(colour[:3])
+        self.width = width
+        self.points = points if points is not None else []
+        self.smooth = smooth
+
+    def add_point(self, pos, t, pressure=255):
+        self.points.append((pos[0], pos[1], min(int(t), 0xFFFF), pressure))
+
+    @property
+    def complete_segments(self):
+        """Segments whose shape can no longer change as points are added."""
+        return max(0, len(self.points) - (2 if self.smooth else 1))
+
+    def polyline(self, scale=1, start=0, end=None):
+        """Points to connect for segments start..end (default: all), at `scale`."""
+        half = scale // 2
+        points = [(x * scale + half, y * scale + half) for x, y, _, _ in self.points]
+        if end is None:
+            end = len(points) - 1
+        if end <= start:
+            return []
+        if not self.smooth:
+            return points[start:end + 1]
+        line = [points[start]]
+        last = len(points) - 1
+        for i in range(start, end):
+            (x0, y0), (x1, y1) = points[max(i - 1, 0)], points[i]
+            (x2, y2), (x3, y3) = points[i + 1], points[min(i + 2, last)]
+            distance = math.hypot(self.points[i + 1][0] - self.points[i][0],
+                                  self.points[i + 1][1] - self.points[i][1])
+            steps = max(1, int(distance / self.SPLINE_STEP))
+            for step in range(1, steps):
+                t = step / steps
+                t2, t3 = t * t, t * t * t
+                line.append((
+                    round(0.5 * (2 * x1 + (x2 - x0) * t + (2 * x0 - 5 * x1 + 4 * x2 - x3) * t2
+                                 + (3 * x1 - x0 - 3 * x2 + x3) * t3)),
+                    round(0.5 * (2 * y1 + (y2 - y0) * t + (2 * y0 - 5 * y1 + 4 * y2 - y3) * t2
+                                 + (3 * y1 - y0 - 3 * y2 + y3) * t3))))
+            line.append((x2, y2))
+        return line
+
+    def draw(self, surface, scale=1):
+        if self.tool == "fill":
+            x, y, _, tolerance = self.points[0]
+            half = scale // 2
+            flood_fill(surface, (x * scale + half, y * scale + half), self.colour,
+                       tolerance, self.width * scale)
+            return
+        line = self.polyline(scale)
+        if len(line) > 1:
+            pygame.draw.lines(surface, self.colour, False, line, self.width * scale)
+
+
+def overlay(target, layer, area=None):
+    """Blit `layer` onto `target` (within `area`) with its paper white left transparent."""
+    # A subsurface has a colour key of its own, so `layer` is left as it is
+    view = layer.subsurface(layer.get_rect())
+    view.set_colorkey((255, 255, 255))
+    if area is None:
+        target.blit(view, (0, 0))
+    else:
+        target.blit(view, area, area)
+
+
+def polyline_rect(points, width):
+    """Bounding rectangle of pygame.draw.lines(points, width), before drawing it."""
+    xs = [x for x, _ in points]
+    ys = [y for _, y in points]
+    rect = pygame.Rect(min(xs), min(ys), max(xs) - min(xs) + 1, max(ys) - min(ys) + 1)
+    return rect.inflate(width + 2, width + 2)
+
+
+def encode_strokes(strokes):
+    """Serialize a frame's strokes into a compressed vector frame payload."""
+    parts = []
+    for stroke in strokes:
+        tool = Stroke.TOOLS.index(stroke.tool) | (Stroke.SMOOTH if stroke.smooth else 0)
+        parts.append(Stroke.HEADER.pack(tool, *stroke.colour, stroke.width, len(stroke.points)))
+        parts.extend(Stroke.POINT.pack(*point) for point in stroke.points)
+    return zlib.compress(b"".join(parts), 6)
+
+
+def decode_strokes(payload):
+    """Inverse of encode_strokes(); returns a tuple of Strokes."""
+    data = zlib.decompress(payload)
+    strokes = []
+    pos = 0
+    while pos < len(data):
+        tool, r, g, b, width, count = Stroke.HEADER.unpack_from(data, pos)
+        pos += Stroke.HEADER.size
+        end = pos + count * Stroke.POINT.size
+        strokes.append(Stroke(Stroke.TOOLS[tool & ~Stroke.SMOOTH], (r, g, b), width,
+                              list(Stroke.POINT.iter_unpack(data[pos:end])), bool(tool & Stroke.SMOOTH)))
+        pos = end
+    return tuple(strokes)
+
+
+def rasterize_strokes(strokes, size, scale=1, palette=None):
+    """
+    Draw strokes on white paper at `scale` times `size`. With a palette the
+    result is an 8-bit Surface whose pixels are indices into it.
+    """
+    size = (size[0] * scale, size[1] * scale)
+    if palette is None:
+        surface = pygame.Surface(size)
+    else:
+        surface = pygame.Surface(size, 0, 8)
+        surface.set_palette(padded_palette(palette))
+    surface.fill((255, 255, 255))
+    for stroke in strokes:
+        stroke.draw(surface, scale)
+    return surface
+
+
+def compress_pixels(pixels, bpp):
+    """A frame payload for raw pixels in a note of encoding `bpp` (see SlipWriter)."""
+    if bpp == ENC_PLANE1:
+        pixels = _pack_plane1(pixels)
+    return zlib.compress(pixels, 6)
+
+
+class SlipWriter:
+    """
+    Streams frames into a .slip container.
+    Frames are encoded one at a time, so callers never need the whole note in
+    memory. Frames are hashed as they come in, and repeats of a key or vector
+    frame already written share its payload. The file is written next to the
+    target and swapped in on close().
+    """
+    def __init__(self, file_path, width=400, height=240, fps=30, palette=None):
+        self.file_path = file_path
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.palette = palette
+        if palette is None:
+            self.bpp = ENC_RGB24
+        elif len(palette) <= 2:
+            self.bpp = ENC_PLANE1
+        else:
+            self.bpp = ENC_INDEX8
+        self.index = []
+        self.layers = []  # (encoding, payload) of the background layers
+        self.chunks = []
+        self._shared = {}  # SHA-1 of pixels / stroke payload -> (offset, length, encoding)
+        self._prev = None
+        self._keyframe = 0
+        self._tmp_path = file_path + ".tmp"
+        self._file = open(self._tmp_path, "wb")
+        self._file.write(SLIP_HEADER.pack(SLIP_MAGIC, SLIP_VERSION, width, height, fps, 0, 0))
+
+    def add_frame(self, surface):
+        """Encode and append a frame Surface."""
+        if self.bpp == ENC_RGB24:
+            self.add_pixels(pygame.image.tostring(surface, "RGB"))
+        else:
+            self.add_pixels(surface_to_indices(surface, self.palette))
+
+    def add_pixels(self, pixels, payload=None, delta=None):
+        """
+        Append a frame given as raw pixels: palette indices, or RGB triplets
+        for ENC_RGB24 notes. Every SLIP_KEYFRAME_INTERVAL frames a keyframe is
+        forced; otherwise the smaller of the key and delta payload is kept.
+        Callers that compressed the frame already (see compress_pixels), as
+        a keyframe and XOR-ed against the previous frame added, can pass
+        `payload` and `delta` so only the choice is made here.
+        """
+        number = len(self.index)
+        digest = hashlib.sha1(pixels).digest()
+        if digest in self._shared:
+            self.index.append(self._shared[digest] + (number,))
+            self._keyframe = number
+            self._prev = pixels
+            return
+        if payload is None:
+            payload = self._compress(pixels)
+        encoding = self.bpp
+        if self._prev is not None and number - self._keyframe < SLIP_KEYFRAME_INTERVAL:
+            if delta is None:
+                delta = self._compress(_xor_bytes(pixels, self._prev))
+            if len(delta) < len(payload):
+                payload = delta
+                encoding |= ENC_DELTA
+        if not encoding & ENC_DELTA:
+            self._keyframe = number
+            self._shared[digest] = (self._file.tell(), len(payload), encoding)
+        self._prev = pixels
+        self.index.append((self._file.tell(), len(payload), encoding, self._keyframe))
+        self._file.write(payload)
+
+    def add_strokes(self, strokes):
+        """Append a vector frame. The next pixel frame starts a new delta chain."""
+        number = len(self.index)
+        payload = encode_strokes(strokes)
+        digest = hashlib.sha1(payload).digest()
+        if digest not in self._shared:
+            self._shared[digest] = (self._file.tell(), len(payload), ENC_STROKES)
+            self._file.write(payload)
+        self.index.append(self._shared[digest] + (number,))
+        self._prev = None
+
+    def add_background(self, pixels=None, strokes=None):
+        """Add a background layer on top of the previous ones, as raw pixels (see add_pixels) or strokes."""
+        if strokes is not None:
+            self.layers.append((ENC_STROKES, encode_strokes(strokes)))
+        else:
+            self.layers.append((self.bpp, self._compress(pixels)))
+
+    def _compress(self, pixels):
+        return compress_pixels(pixels, self.bpp)
+
+    def add_chunk(self, tag, data):
+        """Append an extra named chunk (4-byte tag) to the trailer."""
+        self.chunks.append((tag, self._file.tell(), len(data)))
+        self._file.write(data)
+
+    def close(self):
+        """Write palette, index and table of contents, then publish the file."""
+        self.finish()
+        self.publish()
+
+    def finish(self):
+        """Complete the temporary file without replacing the target yet."""
+        palette = self.palette or []
+        self.add_chunk(b"PAL ", bytes(v for c in palette for v in c))
+        if self.layers:
+            self.add_chunk(b"LAYR", b"".join(SLIP_LAYER_ENTRY.pack(encoding, len(payload)) + payload
+                                             for encoding, payload in self.layers))
+        self.add_chunk(b"FIDX", b"".join(SLIP_INDEX_ENTRY.pack(*e) for e in self.index))
+        toc_offset = self._file.tell()
+        self._file.write(struct.pack("<I", len(self.chunks)))
+        for entry in self.chunks:
+            self._file.write(SLIP_TOC_ENTRY.pack(*entry))
+        self._file.seek(0)
+        self._file.write(SLIP_HEADER.pack(SLIP_MAGIC, SLIP_VERSION, self.width, self.height,
+                                          self.fps, len(self.index), toc_offset))
+        self._file.close()
+
+    def publish(self):
+        """Move the finished file over the target path."""
+        os.replace(self._tmp_path, self.file_path)
+
+    def abort(self):
+        """Throw away a partially (or completely) written file."""
+        self._file.close()
+        if os.path.exists(self._tmp_path):
+            os.remove(self._tmp_path)
+
+
+class SlipReader:
+    """
+    Random-access reader for .slip container files.
+    The file is memory-mapped and only the header, table of contents and
+    frame index are parsed up front; frame payloads are sliced out on demand.
+    """
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self._file = open(file_path, "rb")
+        # Last decoded (frame number, pixels), so sequential reads of delta
+        # frames decode one payload instead of replaying from the keyframe.
+        self._last = None
+        self._flattened = {}  # scale -> the background layers flattened
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError as e:
+            self._file.close()
+            raise SlipFormatError(f"Corrupt slipnote {file_path}: {e}")
+        try:
+            self._read_trailer()
+        except (struct.error, KeyError, ValueError) as e:
+            self.close()
+            raise SlipFormatError(f"Corrupt slipnote {file_path}: {e}")
+
+    def _read_trailer(self):
+        magic, version, self.width, self.height, self.fps, count, toc_offset = \
+            SLIP_HEADER.unpack_from(self._map, 0)
+        if magic != SLIP_MAGIC:
+            raise ValueError("not a slipnote container")
+        if version > SLIP_VERSION:
+            raise ValueError(f"unsupported version {version}")
+        self.version = version
+        (num_chunks,) = struct.unpack_from("<I", self._map, toc_offset)
+        self.chunks = {}
+        for i in range(num_chunks):
+            pos = toc_offset + 4 + i * SLIP_TOC_ENTRY.size
+            tag, offset, length = SLIP_TOC_ENTRY.unpack_from(self._map, pos)
+            self.chunks[tag] = (offset, length)
+        pal = self.read_chunk(b"PAL ")
+        self.palette = [tuple(pal[i:i + 3]) for i in range(0, len(pal), 3)] or None
+        raw_index = self.read_chunk(b"FIDX")
+        self.index = [e for e in SLIP_INDEX_ENTRY.iter_unpack(raw_index)]
+        if len(self.index) != count:
+            raise ValueError("frame index does not match header")
+        # Background layers, as index entries of frames -1, -2, ...
+        self.layers = []
+        if b"LAYR" in self.chunks:
+            pos, end = self.chunks[b"LAYR"]
+            end += pos
+            while pos < end:
+                encoding, length = SLIP_LAYER_ENTRY.unpack_from(self._map, pos)
+                pos += SLIP_LAYER_ENTRY.size
+                self.layers.append((pos, length, encoding, -1 - len(self.layers)))
+                pos += length
+        # Frames sharing a payload are the same frame: canonical[n] is the
+        # first frame number with frame n's payload.
+        first = {}
+        self.canonical = [first.setdefault(e[:2], n) if e[3] == n else n
+                          for n, e in enumerate(self.index)]
+
+    @property
+    def size(self):
+        return (self.width, self.height)
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def background_count(self):
+        return len(self.layers)
+
+    def _entry(self, number):
+        """Index entry of frame `number`, or of a background layer for -1, -2, ..."""
+        return self.layers[-1 - number] if number < 0 else self.index[number]
+
+    def read_chunk(self, tag):
+        """Return the bytes of a trailer chunk, or None if it is absent."""
+        if tag not in self.chunks:
+            return None
+        offset, length = self.chunks[tag]
+        return self._map[offset:offset + length]
+
+    def read_strokes(self, number):
+        """The strokes of a vector frame, or None for a pixel frame."""
+        offset, length, encoding, _ = self._entry(number)
+        if encoding != ENC_STROKES:
+            return None
+        return decode_strokes(self._map[offset:offset + length])
+
+    def read_pixels(self, number, scale=1, flatten=False):
+        """
+        Decode one frame to raw pixels, starting from its keyframe. With
+        scale > 1 vector frames are redrawn at that resolution and pixel
+        frames are enlarged. With `flatten` the frame comes over the note's
+        background layers (see read_composite).
+        """
+        if flatten and self.layers:
+            return pygame.image.tostring(self.read_composite(number, scale),
+                                         "RGB" if self.palette is None else "P")
+        strokes = self.read_strokes(number)
+        if strokes is not None:
+            surface = rasterize_strokes(strokes, self.size, scale, self.palette)
+            return pygame.image.tostring(surface, "RGB" if self.palette is None else "P")
+        keyframe = self._entry(number)[3]
+        first, pixels = keyframe, None
+        if self._last is not None and keyframe <= self._last[0] < number:
+            first, pixels = self._last[0] + 1, self._last[1]
+        for i in range(first, number + 1):
+            offset, length, encoding, _ = self._entry(i)
+            data = zlib.decompress(self._map[offset:offset + length])
+            if encoding & 0x7F == ENC_PLANE1:
+                data = _unpack_plane1(data, self.width * self.height)
+            pixels = _xor_bytes(data, pixels) if encoding & ENC_DELTA else data
+        self._last = (number, pixels)
+        if scale != 1:
+            fmt = "RGB" if self.palette is None else "P"
+            scaled = pygame.transform.scale(pygame.image.frombuffer(pixels, self.size, fmt),
+                                            (self.width * scale, self.height * scale))
+            return pygame.image.tostring(scaled, fmt)
+        return pixels
+
+    def read_frame(self, number, scale=1, flatten=False):
+        """
+        Decode one frame to a display Surface, at `scale` times the note's
+        size; with `flatten`, over the background layers.
+        """
+        if flatten and self.layers:
+            composite = self.read_composite(number, scale)
+            surface = pygame.Surface(composite.get_size())
+            surface.blit(composite, (0, 0))
+            return surface
+        strokes = self.read_strokes(number)
+        if strokes is not None:
+            return rasterize_strokes(strokes, self.size, scale)
+        pixels = self.read_pixels(number)
+        if self.palette is None:
+            surface = pygame.image.fromstring(pixels, self.size, "RGB")
+        else:
+            surface = indices_to_surface(pixels, self.size, self.palette)
+        if scale != 1:
+            surface = pygame.transform.scale(surface, (self.width * scale, self.height * scale))
+        return surface
+
+    def read_layer(self, number, scale=1):
+        """Frame (or background layer) `number` as a Surface in the note's format: indices with a palette."""
+        strokes = self.read_strokes(number)
+        if strokes is not None:
+            return rasterize_strokes(strokes, self.size, scale, self.palette)
+        size = (self.width * scale, self.height * scale)
+        if self.palette is None:
+            return pygame.image.fromstring(self.read_pixels(number, scale), size, "RGB")
+        return indexed_surface(self.read_pixels(number, scale), size, self.palette)
+
+    def read_composite(self, number, scale=1):
+        """
+        Frame `number` drawn over the background layers, in the note's
+        format. The backgrounds are flattened once per scale and kept.
+        """
+        flat = self._flattened.get(scale)
+        if flat is None:
+            flat = rasterize_strokes((), self.size, scale, self.palette)
+            for k in range(len(self.layers)):
+                overlay(flat, self.read_layer(-1 - k, scale))
+            self._flattened[scale] = flat
+        composite = flat.copy()
+        overlay(composite, self.read_layer(number, scale))
+        return composite
+
+    @property
+    def has_audio(self):
+        return AUDIO_TAG in self.chunks
+
+    def read_audio(self, first_frame=0, last_frame=None):
+        """
+        Decode the embedded audio from the start of `first_frame` up to
+        `last_frame` (or the end of the track). Only the blocks of that span
+        are read. Returns (samples, rate), the samples as signed 16-bit mono,
+        or None when there is no audio in the span.
+        """
+        if AUDIO_TAG not in self.chunks:
+            return None
+        base, length = self.chunks[AUDIO_TAG]
+        codec, rate, fps, count, blocks = AUDIO_HEADER.unpack_from(self._map, base)
+        if codec != AUDIO_CODEC_IMA:
+            raise SlipFormatError(f"Unknown audio codec {codec}")
+        # Frames count at the note's fps, which may differ from the track's
+        note_fps = max(1, self.fps)
+        start = first_frame * rate // note_fps
+        end = count if last_frame is None else min(count, last_frame * rate // note_fps)
+        if start >= end:
+            return None
+        offsets = struct.unpack_from(f"<{blocks}I", self._map, base + AUDIO_HEADER.size)
+        first = min(blocks - 1, start * fps // rate)
+        pcm = array("h")
+        block = first
+        while block < blocks and _audio_block_start(block, rate, fps) < end:
+            lo = base + offsets[block]
+            hi = base + (offsets[block + 1] if block + 1 < blocks else length)
+            samples, _ = _ima_decode(self._map[lo + AUDIO_BLOCK.size:hi],
+                                     AUDIO_BLOCK.unpack_from(self._map, lo))
+            pcm.extend(samples)
+            block += 1
+        skip = start - _audio_block_start(first, rate, fps)
+        return pcm[skip:skip + end - start], rate
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+
+# -----------------------------------------------------------------------------
+# EMBEDDED AUDIO
+# -----------------------------------------------------------------------------
+# A note carries its own audio track in an "AUD " chunk, resampled to
+# AUDIO_RATE and compressed to 4-bit IMA-ADPCM, which is about a fifth of the
+# 44.1 kHz 8-bit recordings:
+#
+#   header   codec, sample rate, fps, sample count, block count
+#   index    offset of every block from the start of the chunk (uint32)
+#   blocks   coder state (predictor, step index), then two codes per byte
+#
+# There is one block per frame at the fps in the header, and every block
+# starts with the coder state it needs, so playback and export decode just
+# the frames they play without reading the audio before them.
+AUDIO_TAG = b"AUD "
+AUDIO_HEADER = struct.Struct("<BIHII")
+AUDIO_BLOCK = struct.Struct("<hB")
+AUDIO_CODEC_IMA = 1
+AUDIO_RATE = 16000
+
+_IMA_INDEX = (-1, -1, -1, -1, 2, 4, 6, 8) * 2
+_IMA_STEPS = (
+    7, 8, 9, 10, 11, 12, 13, 14, 16, 17, 19, 21, 23, 25, 28, 31, 34, 37, 41, 45,
+    50, 55, 60, 66, 73, 80, 88, 97, 107, 118, 130, 143, 157, 173, 190, 209, 230,
+    253, 279, 307, 337, 371, 408, 449, 494, 544, 598, 658, 724, 796, 876, 963,
+    1060, 1166, 1282, 1411, 1552, 1707, 1878, 2066, 2272, 2499, 2749, 3024, 3327,
+    3660, 4026, 4428, 4871, 5358, 5894, 6484, 7132, 7845, 8630, 9493, 10442,
+    11487, 12635, 13899, 15289, 16818, 18500, 20350, 22385, 24623, 27086, 29794,
+    32767)
+
+
+def _ima_encode(samples, state):
+    """
+    Encode an even number of signed 16-bit samples to IMA-ADPCM codes, high
+    nibble first. `state` is (predictor, step index); returns (codes, state).
+    The output matches audioop.lin2adpcm byte for byte.
+    """
+    if AUDIOOP_AVAILABLE:
+        return audioop.lin2adpcm(samples.tobytes(), 2, state)
+    predictor, index = state
+    steps, adjust = _IMA_STEPS, _IMA_INDEX
+    step = steps[index]
+    out = bytearray(len(samples) // 2)
+    high = 0
+    for i, value in enumerate(samples):
+        diff = value - predictor
+        code = 0
+        if diff < 0:
+            code = 8
+            diff = -diff
+        vpdiff = step >> 3
+        if diff >= step:
+            code |= 4
+            diff -= step
+            vpdiff += step
+        step >>= 1
+        if diff >= step:
+            code |= 2
+            diff -= step
+            vpdiff += step
+        step >>= 1
+        if diff >= step:
+            code |= 1
+            vpdiff += step
+        if code & 8:
+            predictor = max(-32768, predictor - vpdiff)
+        else:
+            predictor = min(32767, predictor + vpdiff)
+        index = min(88, max(0, index + adjust[code]))
+        step = steps[index]
+        if i & 1:
+            out[i >> 1] = high | code
+        else:
+            high = code << 4
+    return bytes(out), (predictor, index)
+
+
+def _ima_decode(codes, state):
+    """Decode IMA-ADPCM codes to signed 16-bit samples; returns (array("h"), state)."""
+    if AUDIOOP_AVAILABLE:
+        pcm, state = audioop.adpcm2lin(codes, 2, state)
+        return array("h", pcm), state
+    predictor, index = state
+    steps, adjust = _IMA_STEPS, _IMA_INDEX
+    step = steps[index]
+    out = array("h", bytes(4 * len(codes)))
+    i = 0
+    for byte in codes:
+        for code in (byte >> 4, byte & 15):
+            index = min(88, max(0, index + adjust[code]))
+            vpdiff = step >> 3
+            if code & 4:
+                vpdiff += step
+            if code & 2:
+                vpdiff += step >> 1
+            if code & 1:
+                vpdiff += step >> 2
+            if code & 8:
+                predictor = max(-32768, predictor - vpdiff)
+            else:
+                predictor = min(32767, predictor + vpdiff)
+            step = steps[index]
+            out[i] = predictor
+            i += 1
+    return out, (predictor, index)
+
+
+def _audio_block_start(block, rate, fps):
+    """First sample of a block; kept even so every block is whole bytes of codes."""
+    return (block * rate // fps) & ~1
+
+
+def encode_audio(samples, rate=AUDIO_RATE, fps=30):
+    """Build an "AUD " chunk from signed 16-bit mono samples at `rate`."""
+    count = len(samples)
+    samples = array("h", samples)
+    if count % 2:
+        samples.append(samples[-1])
+    fps = max(1, fps)
+    starts = []
+    while _audio_block_start(len(starts), rate, fps) < count:
+        starts.append(_audio_block_start(len(starts), rate, fps))
+    starts.append(len(samples))
+    offsets = array("I")
+    blocks = []
+    offset = AUDIO_HEADER.size + 4 * (len(starts) - 1)
+    state = (0, 0)
+    for start, end in zip(starts, starts[1:]):
+        codes, next_state = _ima_encode(samples[start:end], state)
+        blocks.append(AUDIO_BLOCK.pack(*state) + codes)
+        offsets.append(offset)
+        offset += len(blocks[-1])
+        state = next_state
+    if sys.byteorder == "big":
+        offsets.byteswap()
+    header = AUDIO_HEADER.pack(AUDIO_CODEC_IMA, rate, fps, count, len(blocks))
+    return header + offsets.tobytes() + b"".join(blocks)
+
+
+def _pcm16_mono(raw, width, channels):
+    """Raw PCM (8-bit unsigned or 16-bit signed, native order) to signed 16-bit mono."""
+    if width not in (1, 2):
+        raise ValueError("Only 8- and 16-bit audio can be embedded")
+    if AUDIOOP_AVAILABLE:
+        if width == 1:
+            raw = audioop.lin2lin(audioop.bias(raw, 1, -128), 1, 2)
+        if channels == 2:
+            raw = audioop.tomono(raw, 2, 0.5, 0.5)
+        elif channels > 2:
+            raw = array("h", raw)[::channels].tobytes()
+        return array("h", raw)
+    if NUMPY_AVAILABLE:
+        if width == 1:
+            samples = (numpy.frombuffer(raw, numpy.uint8).astype(numpy.int16) - 128) << 8
+        else:
+            samples = numpy.frombuffer(raw, numpy.int16)
+        samples = samples.reshape(-1, channels).mean(axis=1).astype(numpy.int16)
+        return array("h", samples.tobytes())
+    if width == 1:
+        return array("h", ((v - 128) << 8 for v in raw[::channels]))
+    return array("h", raw)[::channels]
+
+
+def _resample(samples, src_rate, dst_rate):
+    """Linear (audioop, NumPy) or nearest-sample resampling of 16-bit mono audio."""
+    if src_rate == dst_rate or not samples:
+        return samples
+    if AUDIOOP_AVAILABLE:
+        return array("h", audioop.ratecv(samples.tobytes(), 2, 1, src_rate, dst_rate, None)[0])
+    count = int(len(samples) * dst_rate / src_rate)
+    if NUMPY_AVAILABLE:
+        src = numpy.frombuffer(samples.tobytes(), numpy.int16)
+        dst_t = numpy.arange(count) * (src_rate / float(dst_rate))
+        out = numpy.interp(dst_t, numpy.arange(len(src)), src).astype(numpy.int16)
+        return array("h", out.tobytes())
+    step = src_rate / float(dst_rate)
+    return array("h", (samples[int(i * step)] for i in range(count)))
+
+
+def read_audio_file(file_path, rate=AUDIO_RATE):
+    """
+    Load a recording or an imported sound as signed 16-bit mono at `rate`.
+    PCM WAV files are read directly; other formats (MP3, OGG) are decoded by
+    the pygame mixer, which must be initialised.
+    """
+    try:
+        with wave.open(file_path, "rb") as wf:
+            width, channels, src_rate = wf.getsampwidth(), wf.getnchannels(), wf.getframerate()
+            raw = wf.readframes(wf.getnframes())
+        if width == 2 and sys.byteorder == "big":
+            raw = array("h", raw)
+            raw.byteswap()
+            raw = raw.tobytes()
+    except (wave.Error, EOFError):
+        src_rate, size, channels = pygame.mixer.get_init() or (0, 0, 0)
+        if size not in (8, -16):
+            raise ValueError(f"Cannot decode {file_path} with the current mixer settings")
+        raw = pygame.mixer.Sound(file_path).get_raw()
+        width = abs(size) // 8
+    return _resample(_pcm16_mono(raw, width, channels), src_rate, rate)
+
+
+def encode_audio_file(file_path, rate=AUDIO_RATE, fps=30):
+    """read_audio_file() and encode_audio() in one go."""
+    return encode_audio(read_audio_file(file_path, rate), rate, fps)
+
+
+def pcm_to_wav(samples, rate):
+    """Wrap signed 16-bit mono samples in an in-memory WAV file."""
+    if sys.byteorder == "big":
+        samples = array("h", samples)
+        samples.byteswap()
+    out = io.BytesIO()
+    with wave.open(out, "wb") as wf:
+        wf.setnchannels(1)
+        wf.setsampwidth(2)
+        wf.setframerate(rate)
+        wf.writeframes(samples.tobytes())
+    return out.getvalue()
+
+
+class FrameStore:
+    """
+    The frames of the open note, decoded lazily from a memory-mapped .slip.
+
+    Each slot is either the frame number of a frame in the backing file or
+    a Surface that only exists in memory (new or edited frames). Surfaces in
+    slots are pinned until the note is saved; decoded file frames live in a
+    bounded LRU cache, capped by frame count and optionally by megabytes.
+    The store is shared with the playback thread, so access to the cache
+    and the reader goes through `lock`.
+
+    snapshot() freezes the current frames for a background save: frozen
+    Surfaces are copied by edit() before anyone draws on them again
+    (copy-on-write), and adopt() re-backs the store with the saved file.
+
+    A frame is also either a vector frame, whose pixels are exactly its
+    strokes drawn on white paper (its Surface is just a cached rendering),
+    or a pixel frame (migrated or imported artwork) whose strokes are baked
+    into the bitmap. strokes() tells them apart; the strokes of file frames
+    come from the file, those of pinned frames are kept alongside them.
+
+    Frames are 8-bit Surfaces of indices into the note's `palette`, a
+    quarter of the memory of 32-bit ones; the tools draw on them directly
+    and SDL converts them with a palette lookup when they are blitted to
+    the screen. The palette only ever grows (ensure_colour()), so indices
+    stay valid, and it starts as the palette of the backing file, so file
+    frames decode straight to indices. A note with more than 256 colours
+    switches to true-colour frames (palette None). `on_palette(palette)`
+    is called whenever ensure_colour() changes the palette.
+
+    Slots hold references, so identical frames are stored once: duplicate()
+    copies a reference, new frames all share one blank Surface and file
+    frames with the same content (see SlipReader.canonical) share a frame
+    number and so a cache entry. duplicate(), insert(), remove() and move()
+    never touch pixels; edit() copies a Surface that is shared before it is
+    drawn on (copy-on-write).
+
+    Besides its frames a note has background layers, shared by every frame
+    and always held in memory. They are addressed with negative indices
+    (-1 is the bottom layer, see add_background), so edit(), strokes() and
+    the undo history treat them like frames. composite(index) is what is
+    shown: the frame over the flattened backgrounds, with paper white left
+    transparent. Composites and the flattened backgrounds are cached and
+    only redone where a layer changed: wholly after edit(), and just the
+    areas passed to touch() for drawing done in place since then.
+    """
+    def __init__(self, size=(400, 240), cache_frames=48, cache_mb=None, read_ahead=4,
+                 palette=((255, 255, 255), (0, 0, 0))):
+        self.size = size
+        self.palette = list(palette)
+        self.on_palette = None
+        self.cache_frames = cache_frames
+        self.cache_bytes = cache_mb * 1024 * 1024 if cache_mb else None
+        self.read_ahead = read_ahead
+        self.reader = None
+        self._slots = []
+        # Content stamps, unique within the store: a frame gets a new one
+        # whenever it is edited, so caches of derived images can tell
+        self._versions = []
+        self._last_version = 0
+        self.background_version = 0  # the same for the background layers as a whole
+        self._strokes = []  # strokes of pinned frames (None: pixel frame)
+        self._cache = OrderedDict()
+        self._cache_used = 0
+        self._pending = []
+        self._frozen = {}  # id -> Surface shared with a snapshot being saved
+        self._blank = None  # white frame shared by every new frame
+        self._backgrounds = []  # Surfaces of the background layers, bottom first
+        self._background_strokes = []
+        self._flat = None  # the background layers flattened onto paper
+        self._flat_dirty = []  # areas of _flat to redo
+        self._composites = OrderedDict()  # frame slot -> [composite Surface, areas to redo]
+        self.lock = threading.RLock()
+        self.hits = 0  # file frames served from the cache...
+        self.misses = 0  # ...and decoded on demand
+
+    def open(self, file_path):
+        """Back the store with a .slip file; no frame is decoded yet."""
+        self.attach(SlipReader(file_path))
+
+    def attach(self, reader):
+        """Back the store with an opened SlipReader."""
+        with self.lock:
+            self.release()
+            self.reader = reader
+            self.size = reader.size
+            self.palette = list(reader.palette) if reader.palette is not None else None
+            self._blank = None
+            self._slots = list(reader.canonical)
+            self._versions = [self._new_version() for _ in self._slots]
+            self._strokes = [None] * len(self._slots)
+            count = reader.background_count
+            self._backgrounds = [self._render(-1 - k) for k in range(count)]
+            self._background_strokes = [reader.read_strokes(-1 - k) for k in range(count)]
+            self._flat = None
+
+    def release(self):
+        """Drop the backing file and every cached frame (pinned frames stay)."""
+        with self.lock:
+            self._cache.clear()
+            self._cache_used = 0
+            self._pending = []
+            self._composites.clear()
+            if self.reader is not None:
+                self.reader.close()
+                self.reader = None
+
+    def reset(self, surfaces):
+        """Replace the note with in-memory frames (pixel frames, any depth)."""
+        self.release()
+        colours = set()
+        for surface in surfaces:
+            colours |= surface_colours(surface)
+        self.palette = build_palette(colours)
+        self._blank = None
+        self._slots = [self._convert(surface) for surface in surfaces]
+        self._versions = [self._new_version() for _ in self._slots]
+        self._strokes = [None] * len(self._slots)
+        self._backgrounds = []
+        self._background_strokes = []
+        self._flat = None
+
+    def blank(self):
+        """The shared white frame in the note's format; draw on it through edit() only."""
+        if self.palette is not None:
+            self.ensure_colour((255, 255, 255))
+        if self._blank is None:
+            if self.palette is None:
+                self._blank = pygame.Surface(self.size)
+            else:
+                self._blank = pygame.Surface(self.size, 0, 8)
+                self._blank.set_palette(padded_palette(self.palette))
+            self._blank.fill((255, 255, 255))
+        return self._blank
+
+    def ensure_colour(self, colour):
+        """Make sure frames can hold `colour`, growing the palette (or dropping it) if needed."""
+        colour = tuple(colour[:3])
+        if self.palette is None or colour in self.palette:
+            return
+        self.set_palette(self.palette + [colour] if len(self.palette) < 256 else None)
+        if self.on_palette:
+            self.on_palette(self.palette)
+
+    def set_palette(self, palette):
+        """
+        Switch to `palette`, which must extend the current one, or to true
+        colour (None), converting every frame held in memory.
+        """
+        with self.lock:
+            self.palette = list(palette) if palette is not None else None
+            converted = {}  # so frames that shared a Surface still do
+            for index, slot in enumerate(self._slots):
+                if not isinstance(slot, int):
+                    if id(slot) not in converted:
+                        converted[id(slot)] = self._convert(slot)
+                        if converted[id(slot)] is not slot:
+                            self._frozen.pop(id(slot), None)
+                    self._slots[index] = converted[id(slot)]
+            if self._blank is not None:
+                self._blank = converted.get(id(self._blank)) or self._convert(self._blank)
+            self._backgrounds = [converted.get(id(surface)) or self._convert(surface)
+                                 for surface in self._backgrounds]
+            for number, surface in list(self._cache.items()):
+                self._cache[number] = self._convert(surface)
+            self._backgrounds_changed()
+
+    def _convert(self, surface):
+        """`surface` in the note's current format (palette entries are updated in place)."""
+        if self.palette is None:
+            if surface.get_bitsize() != 8:
+                return surface
+            converted = pygame.Surface(self.size)
+            converted.blit(surface, (0, 0))
+            return converted
+        if surface.get_bitsize() == 8:
+            surface.set_palette(padded_palette(self.palette))
+            return surface
+        return indexed_surface(surface_to_indices(surface, self.palette), self.size, self.palette)
+
+    def __len__(self):
+        return len(self._slots)
+
+    def __getitem__(self, index):
+        """Return the frame (or background layer) Surface; do not draw on it (see edit)."""
+        with self.lock:
+            if index < 0:
+                return self._backgrounds[-1 - index]
+            slot = self._slots[index]
+            if not isinstance(slot, int):
+                return slot
+            surface = self._cache.get(slot)
+            if surface is None:
+                self.misses += 1
+                surface = self._decode(slot)
+            else:
+                self.hits += 1
+                self._cache.move_to_end(slot)
+            return surface
+
+    def edit(self, index):
+        """Return a frame (or background layer) Surface for drawing, pinning it until the next save."""
+        with self.lock:
+            if index < 0:
+                surface = self._backgrounds[-1 - index]
+                if id(surface) in self._frozen or surface is self._blank:
+                    surface = self._backgrounds[-1 - index] = surface.copy()
+                self._backgrounds_changed()
+                return surface
+            self._versions[index] = self._new_version()
+            slot = self._slots[index]
+            self._composites.pop(slot, None)
+            if isinstance(slot, int):
+                surface = self[index]
+                self._uncache(slot)
+                self._slots[index] = surface
+                self._strokes[index] = self.reader.read_strokes(slot)
+                return surface
+            if id(slot) in self._frozen or self._shared(index, slot):
+                slot = slot.copy()
+                self._slots[index] = slot
+            return slot
+
+    def touch(self, index, rect):
+        """Note that `rect` of a Surface from edit(index) was drawn on since (composites redo it)."""
+        with self.lock:
+            # Clipped here: blit(source, area, area) would shift a clipped area
+            rect = pygame.Rect(rect).clip(pygame.Rect((0, 0), self.size))
+            if index < 0:
+                self.background_version += 1
+                self._flat_dirty.append(rect)
+                for entry in self._composites.values():
+                    entry[1].append(rect)
+                return
+            self._versions[index] = self._new_version()
+            entry = self._composites.get(self._slots[index])
+            if entry is not None:
+                entry[1].append(rect)
+
+    def composite(self, index):
+        """
+        The frame at `index` as shown: over the background layers, if the
+        note has any (otherwise the frame itself). Do not draw on it.
+        """
+        with self.lock:
+            layer = self[index]
+            if not self._backgrounds:
+                return layer
+            flat = self._flattened()
+            slot = self._slots[index]
+            entry = self._composites.get(slot)
+            if entry is None:
+                composite = flat.copy()
+                overlay(composite, layer)
+                entry = self._composites[slot] = [composite, []]
+                while len(self._composites) > self.cache_frames:
+                    self._composites.popitem(last=False)
+            elif entry[1]:
+                for area in entry[1]:
+                    entry[0].blit(flat, area, area)
+                    overlay(entry[0], layer, area)
+                entry[1] = []
+            self._composites.move_to_end(slot)
+            return entry[0]
+
+    def _flattened(self):
+        """The background layers on paper, redone where they changed."""
+        if self._flat is None:
+            self._flat = rasterize_strokes((), self.size, 1, self.palette)
+            self._flat_dirty = [self._flat.get_rect()]
+        for area in self._flat_dirty:
+            self._flat.fill((255, 255, 255), area)
+            for layer in self._backgrounds:
+                overlay(self._flat, layer, area)
+        self._flat_dirty = []
+        return self._flat
+
+    def _backgrounds_changed(self):
+        self.background_version += 1
+        self._flat = None
+        self._composites.clear()
+
+    @property
+    def background_count(self):
+        return len(self._backgrounds)
+
+    def add_background(self):
+        """Add a blank background layer on top of the others; returns its (negative) index."""
+        blank = self.blank()
+        with self.lock:
+            self._backgrounds.append(blank)
+            self._background_strokes.append(())
+            self._backgrounds_changed()
+            return -len(self._backgrounds)
+
+    def remove_background(self, index):
+        """Delete background layer `index` (-1 is the bottom one)."""
+        with self.lock:
+            del self._backgrounds[-1 - index]
+            del self._background_strokes[-1 - index]
+            self._backgrounds_changed()
+
+    def _shared(self, index, surface):
+        """True if frames other than `index` (or new ones) use `surface` too."""
+        if surface is self._blank:
+            return True
+        return any(slot is surface for i, slot in enumerate(self._slots) if i != index)
+
+    def version(self, index):
+        """
+        Content stamp of a frame, unique within the store; changes whenever
+        the frame is handed out for drawing or drawn on (see touch). Frames
+        sharing pixels may share a stamp.
+        """
+        return self._versions[index]
+
+    def _new_version(self):
+        self._last_version += 1
+        return self._last_version
+
+    def strokes(self, index):
+        """Tuple of the frame's strokes, or None for a pixel frame."""
+        with self.lock:
+            if index < 0:
+                return self._background_strokes[-1 - index]
+            slot = self._slots[index]
+            if isinstance(slot, int):
+                return self.reader.read_strokes(slot)
+            return self._strokes[index]
+
+    def set_strokes(self, index, strokes):
+        """Record the strokes of a frame handed out by edit() (None: pixel frame)."""
+        if index < 0:
+            self._background_strokes[-1 - index] = strokes
+        else:
+            self._strokes[index] = strokes
+
+    def add_stroke(self, index, stroke):
+        """Record a stroke just drawn on an edited frame; pixel frames only keep the pixels."""
+        strokes = self.strokes(index)
+        if strokes is not None:
+            self.set_strokes(index, strokes + (stroke,))
+
+    def is_dirty(self, index):
+        return not isinstance(self._slots[index], int)
+
+    @property
+    def dirty_count(self):
+        return sum(1 for slot in self._slots if not isinstance(slot, int))
+
+    def insert(self, index, surface, strokes=()):
+        with self.lock:
+            self._slots.insert(index, surface)
+            self._versions.insert(index, self._new_version())
+            self._strokes.insert(index, strokes)
+
+    def append(self, surface, strokes=()):
+        with self.lock:
+            self._slots.append(surface)
+            self._versions.append(self._new_version())
+            self._strokes.append(strokes)
+
+    def duplicate(self, index):
+        """Insert a copy of frame `index` after it; the two share their pixels until one is edited."""
+        with self.lock:
+            self._slots.insert(index + 1, self._slots[index])
+            self._versions.insert(index + 1, self._versions[index])
+            self._strokes.insert(index + 1, self._strokes[index])
+
+    def remove(self, index):
+        """Delete frame `index`."""
+        with self.lock:
+            del self._slots[index]
+            del self._versions[index]
+            del self._strokes[index]
+
+    def move(self, index, target):
+        """Move frame `index` so it ends up at position `target`."""
+        with self.lock:
+            for frames in (self._slots, self._versions, self._strokes):
+                frames.insert(target, frames.pop(index))
+
+    @property
+    def unique_count(self):
+        """Number of distinct frames held (shared and repeated frames count once)."""
+        return len({slot if isinstance(slot, int) else id(slot) for slot in self._slots})
+
+    def file_frame(self, index):
+        """Frame number in the backing file, or None for in-memory frames."""
+        slot = self._slots[index]
+        return slot if isinstance(slot, int) else None
+
+    def snapshot(self, copy_indices=()):
+        """
+        Freeze the current frames and background layers for a background
+        save. Those listed in `copy_indices` (e.g. one being drawn on right
+        now) are copied instead.
+        """
+        with self.lock:
+            slots = []
+            for index, slot in enumerate(self._slots):
+                if not isinstance(slot, int):
+                    if index in copy_indices:
+                        slot = slot.copy()
+                    self._frozen[id(slot)] = slot
+                slots.append(slot)
+            backgrounds = []
+            for k, surface in enumerate(self._backgrounds):
+                if -1 - k in copy_indices:
+                    surface = surface.copy()
+                self._frozen[id(surface)] = surface
+                backgrounds.append((surface, self._background_strokes[k]))
+            return FrameSnapshot(slots, self.reader, self.size, self.lock, list(self._strokes),
+                                 self.palette, backgrounds)
+
+    def discard(self, snapshot):
+        """Forget a snapshot whose save failed or was cancelled."""
+        with self.lock:
+            for slot in snapshot.slots:
+                if not isinstance(slot, int):
+                    self._frozen.pop(id(slot), None)
+            for surface, _ in snapshot.backgrounds:
+                self._frozen.pop(id(surface), None)
+
+    def adopt(self, snapshot, reader):
+        """
+        Re-back the store with `reader`, the file `snapshot` was saved to.
+        Frames that are unchanged since the snapshot become references into
+        the new file; frames edited meanwhile stay pinned in memory.
+        """
+        with self.lock:
+            saved = {}
+            for number, slot in enumerate(snapshot.slots):
+                saved.setdefault(slot if isinstance(slot, int) else id(slot), reader.canonical[number])
+            self.discard(snapshot)
+            slots = []
+            for slot in self._slots:
+                key = slot if isinstance(slot, int) else id(slot)
+                slots.append(saved.get(key, slot))
+            old_reader = self.reader
+            self.release()
+            self.reader = reader
+            self.size = reader.size
+            self._slots = slots
+            if old_reader is not None and old_reader is not snapshot.reader:
+                old_reader.close()
+
+    def prefetch(self, center):
+        """Queue frames around the playhead for decoding by prefetch_step()."""
+        lo = max(0, center - self.read_ahead // 2)
+        hi = min(len(self._slots), center + self.read_ahead + 1)
+        self._pending = [i for i in range(hi - 1, lo - 1, -1)
+                         if isinstance(self._slots[i], int) and self._slots[i] not in self._cache]
+
+    def prefetch_step(self):
+        """Decode one queued frame; called once per main loop tick."""
+        while self._pending:
+            index = self._pending.pop()
+            with self.lock:
+                if index < len(self._slots) and isinstance(self._slots[index], int):
+                    if self._slots[index] not in self._cache:
+                        self._decode(self._slots[index])
+                    return True
+        return False
+
+    def _decode(self, number):
+        surface = self._render(number)
+        self._cache[number] = surface
+        self._cache_used += self._surface_bytes(surface)
+        self._evict()
+        return surface
+
+    def _render(self, number):
+        """Decode file frame (or background layer) `number` into the note's format."""
+        if self.palette is not None and self.reader.palette is not None:
+            strokes = self.reader.read_strokes(number)
+            if strokes is not None:
+                return rasterize_strokes(strokes, self.size, 1, self.palette)
+            return indexed_surface(self.reader.read_pixels(number), self.size, self.palette)
+        return self._convert(self.reader.read_frame(number))
+
+    def _uncache(self, number):
+        surface = self._cache.pop(number, None)
+        if surface is not None:
+            self._cache_used -= self._surface_bytes(surface)
+
+    def _evict(self):
+        while len(self._cache) > 1 and (
+                len(self._cache) > self.cache_frames or
+                (self.cache_bytes is not None and self._cache_used > self.cache_bytes)):
+            _, surface = self._cache.popitem(last=False)
+            self._cache_used -= self._surface_bytes(surface)
+
+    @property
+    def hit_rate(self):
+        """Share of file frame lookups served from the cache (None before any)."""
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else None
+
+    @property
+    def cache_used(self):
+        """Bytes of decoded frames held by the cache."""
+        return self._cache_used
+
+    @staticmethod
+    def _surface_bytes(surface):
+        return surface.get_width() * surface.get_height() * surface.get_bytesize()
+
+
+class FrameSnapshot:
+    """Frozen view of a FrameStore's frames, safe to read from another thread."""
+    def __init__(self, slots, reader, size, lock, strokes, palette, backgrounds=()):
+        self.slots = slots
+        self.backgrounds = backgrounds  # (Surface, strokes) per background layer
+        self.reader = reader
+        self.size = size
+        self.lock = lock
+        self._strokes = strokes
+        self.palette = palette
+
+    def __len__(self):
+        return len(self.slots)
+
+    def is_dirty(self, index):
+        return not isinstance(self.slots[index], int)
+
+    def read_pixels(self, index):
+        with self.lock:
+            return self.reader.read_pixels(self.slots[index])
+
+    def strokes(self, index):
+        slot = self.slots[index]
+        if not isinstance(slot, int):
+            return self._strokes[index]
+        with self.lock:
+            return self.reader.read_strokes(slot)
+
+    def __getitem__(self, index):
+        slot = self.slots[index]
+        if not isinstance(slot, int):
+            return slot
+        with self.lock:
+            return self.reader.read_frame(slot)
+
+
+def write_snapshot(snapshot, file_path, fps, progress=None, audio=None):
+    """
+    Encode a FrameSnapshot into a .slip container, using the note's palette
+    so indexed frames are written as they are (a 1-bit plane for
+    black-on-white notes). For true-colour notes the colours are collected
+    first, in case they fit a palette after all. Vector frames are stored
+    as their strokes. Frames that were never edited are copied from the
+    backing file without being decoded to Surfaces. `audio` is a new "AUD "
+    chunk (see encode_audio); without one the backing file's track is
+    carried over as it is. The background layers are written once, into
+    the "LAYR" chunk. Returns the finished but unpublished SlipWriter; call
+    publish() on it once the old file may be replaced.
+    """
+    reader = snapshot.reader
+    strokes = [snapshot.strokes(i) for i in range(len(snapshot))]
+    palette = snapshot.palette
+    if palette is None:
+        colours = set()
+        if reader is not None and reader.palette is not None:
+            colours = {_pack_colour(c) for c in reader.palette}
+        for i in range(len(snapshot)):
+            if strokes[i] is not None:
+                colours.add(_pack_colour((255, 255, 255)))
+                colours |= {_pack_colour(stroke.colour) for stroke in strokes[i]}
+            elif snapshot.is_dirty(i) or reader.palette is None:
+                colours |= surface_colours(snapshot[i])
+        for surface, _ in snapshot.backgrounds:
+            colours |= surface_colours(surface) | {_pack_colour((255, 255, 255))}
+        palette = build_palette(colours)
+    writer = SlipWriter(file_path, snapshot.size[0], snapshot.size[1], fps, palette)
+    remap = None
+    if reader is not None and reader.palette is not None and palette is not None:
+        remap = bytes(palette.index(c) for c in reader.palette).ljust(256, b"\0")
+    try:
+        for i in range(len(snapshot)):
+            if strokes[i] is not None:
+                writer.add_strokes(strokes[i])
+            elif not snapshot.is_dirty(i) and remap is not None:
+                writer.add_pixels(snapshot.read_pixels(i).translate(remap))
+            elif snapshot.palette is not None:
+                writer.add_pixels(pygame.image.tostring(snapshot[i], "P"))
+            else:
+                writer.add_frame(snapshot[i])
+            if progress:
+                progress(i + 1, len(snapshot))
+        for surface, layer_strokes in snapshot.backgrounds:
+            if layer_strokes is not None:
+                writer.add_background(strokes=layer_strokes)
+            elif snapshot.palette is not None:
+                writer.add_background(pygame.image.tostring(surface, "P"))
+            elif palette is None:
+                writer.add_background(pygame.image.tostring(surface, "RGB"))
+            else:
+                writer.add_background(surface_to_indices(surface, palette))
+        if audio is None and reader is not None:
+            audio = reader.read_chunk(AUDIO_TAG)
+        if audio:
+            writer.add_chunk(AUDIO_TAG, audio)
+        writer.finish()
+    except BaseException:
+        writer.abort()
+        raise
+    return writer
+
+
+def is_slip_container(file_path):
+    """Check the magic bytes to tell containers from legacy pickles."""
+    with open(file_path, "rb") as f:
+        return f.read(len(SLIP_MAGIC)) == SLIP_MAGIC
+
+
+def tile_format(surface):
+    """pygame.image.tostring format that stores `surface` losslessly and compactly."""
+    return "P" if surface.get_bitsize() == 8 else "RGB"
+
+
+def load_tile(data, size, palette):
+    """Inverse of grabbing a tile: `palette` for "P" tiles, None for "RGB" ones."""
+    if palette is None:
+        return pygame.image.fromstring(zlib.decompress(data), size, "RGB")
+    tile = pygame.image.fromstring(zlib.decompress(data), size, "P")
+    tile.set_palette(palette)
+    return tile
+
+
+def segment_rect(start, end, width):
+    """Bounding rectangle of a pygame.draw.line segment, before drawing it."""
+    left, top = min(start[0], end[0]), min(start[1], end[1])
+    rect = pygame.Rect(left, top, abs(end[0] - start[0]) + 1, abs(end[1] - start[1]) + 1)
+    return rect.inflate(width + 2, width + 2)
+
+
+class UndoHistory:
+    """
+    Undo/redo of frame edits, shared by all frames (and background layers,
+    by their negative index) of the note.
+
+    Edits are recorded per TILE x TILE tile: between begin_stroke() and
+    end_stroke() the drawing code calls before_draw(rect) for each area it
+    is about to change, which saves the untouched pixels of tiles it has not
+    seen yet in this stroke. end_stroke() grabs the same tiles again and
+    keeps both versions zlib-compressed, so an entry costs roughly the
+    pixels the stroke touched. Tiles are kept in the frame's own format
+    (palette indices for indexed frames, see tile_format), with the frame's
+    palette, which entries with the same one share and which counts once
+    towards the budget. The oldest entries are dropped once the
+    history exceeds `budget_bytes`. The frame's strokes (see
+    FrameStore.strokes) before and after the edit are kept with the tiles,
+    so undo and redo restore the vector data together with the pixels.
+
+    `on_change(frame, tiles, version, strokes, previous)` is called whenever
+    tiles are written to a frame (version 2: after a stroke or redo, 1:
+    after an undo), with tiles as (rect, before, after) using the compressed
+    data already kept, and the frame's strokes from then on and before.
+    """
+    TILE = 32
+
+    def __init__(self, budget_bytes=8 * 1024 * 1024):
+        self.budget_bytes = budget_bytes
+        self.on_change = None
+        self.undo_stack = []
+        self.redo_stack = []
+        self.used_bytes = 0
+        self._palettes = {}  # packed palette -> [the copy entries share, entries using it]
+        self._frame = None
+        self._surface = None
+        self._before = None
+        self._strokes = None
+
+    def clear(self):
+        self.undo_stack = []
+        self.redo_stack = []
+        self.used_bytes = 0
+        self._palettes = {}
+        self._before = None
+
+    def _keep_palette(self, surface):
+        """The surface's palette packed as RGB bytes, shared with entries that have the same one."""
+        if tile_format(surface) != "P":
+            return None
+        palette = bytes(v for colour in surface.get_palette() for v in colour[:3])
+        held = self._palettes.get(palette)
+        if held is None:
+            held = self._palettes[palette] = [palette, 0]
+            self.used_bytes += len(palette)
+        held[1] += 1
+        return held[0]
+
+    def _forget(self, entry):
+        """Stop counting an entry that left the history."""
+        self.used_bytes -= entry[2]
+        palette = entry[3]
+        if palette is not None:
+            held = self._palettes[palette]
+            held[1] -= 1
+            if not held[1]:
+                del self._palettes[palette]
+                self.used_bytes -= len(palette)
+
+    def begin_stroke(self, frame, surface, strokes=None):
+        """Start recording an edit of `surface`, which is frame number `frame` with `strokes`."""
+        self._frame = frame
+        self._surface = surface
+        self._before = {}
+        self._strokes = strokes
+
+    def before_draw(self, rect):
+        """Save the tiles under `rect` that this stroke has not touched yet."""
+        if self._before is None:
+            return
+        rect = pygame.Rect(rect).clip(self._surface.get_rect())
+        tile = self.TILE
+        for ty in range(rect.top // tile, (rect.bottom - 1) // tile + 1):
+            for tx in range(rect.left // tile, (rect.right - 1) // tile + 1):
+                if (tx, ty) not in self._before:
+                    self._before[(tx, ty)] = self._grab(tx, ty)
+
+    def end_stroke(self, strokes=None):
+        """Finish the stroke, leaving the frame with `strokes`, and push it onto the undo stack."""
+        before, self._before = self._before, None
+        if not before and strokes == self._strokes:
+            return
+        tiles = []
+        size = 0
+        for (tx, ty), pixels in before.items():
+            rect, after = self._grab_rect(tx, ty)
+            if after == pixels:
+                continue
+            entry = (rect, zlib.compress(pixels, 1), zlib.compress(after, 1))
+            size += len(entry[1]) + len(entry[2])
+            tiles.append(entry)
+        if not tiles and strokes == self._strokes:
+            return
+        for entry in self.redo_stack:
+            self._forget(entry)
+        self.redo_stack = []
+        palette = self._keep_palette(self._surface)
+        self.undo_stack.append((self._frame, tiles, size, palette, self._strokes, strokes))
+        self.used_bytes += size
+        if self.on_change:
+            self.on_change(self._frame, tiles, 2, strokes, self._strokes)
+        while self.used_bytes > self.budget_bytes and len(self.undo_stack) > 1:
+            self._forget(self.undo_stack.pop(0))
+
+    def _grab_rect(self, tx, ty):
+        rect = pygame.Rect(tx * self.TILE, ty * self.TILE, self.TILE, self.TILE)
+        rect = rect.clip(self._surface.get_rect())
+        return rect, pygame.image.tostring(self._surface.subsurface(rect), tile_format(self._surface))
+
+    def _grab(self, tx, ty):
+        return self._grab_rect(tx, ty)[1]
+
+    def undo(self, frames):
+        """Revert the last edit. Returns (frame, changed rect), or None."""
+        return self._apply(frames, self.undo_stack, self.redo_stack, 1)
+
+    def redo(self, frames):
+        """Re-apply the last undone edit. Returns (frame, changed rect), or None."""
+        return self._apply(frames, self.redo_stack, self.undo_stack, 2)
+
+    def _apply(self, frames, source, target, version):
+        if not source:
+            return None
+        entry = source.pop()
+        target.append(entry)
+        frame, tiles, _, palette, *strokes = entry
+        if palette is not None:
+            palette = [tuple(palette[i:i + 3]) for i in range(0, len(palette), 3)]
+        surface = frames.edit(frame)
+        for rect, *pixels in tiles:
+            surface.blit(load_tile(pixels[version - 1], rect.size, palette), rect)
+        frames.set_strokes(frame, strokes[version - 1])
+        changed = pygame.Rect(0, 0, 0, 0)
+        if tiles:
+            changed = tiles[0][0].unionall([t[0] for t in tiles[1:]])
+        if self.on_change:
+            self.on_change(frame, tiles, version, strokes[version - 1], strokes[2 - version])
+        return frame, changed
+
+    def frame_inserted(self, index):
+        """Keep recorded frame numbers valid after a frame is inserted at `index`."""
+        self._renumber(lambda frame: frame + 1 if frame >= index else frame)
+
+    def frame_removed(self, index):
+        """Forget the edits of a deleted frame and renumber the frames after it."""
+        self._renumber(lambda frame: None if frame == index else frame - 1 if frame > index else frame)
+
+    def frame_moved(self, index, target):
+        """Follow a frame moved from `index` to `target` (see FrameStore.move)."""
+        def renumber(frame):
+            if frame == index:
+                return target
+            if index < frame <= target:
+                return frame - 1
+            if target <= frame < index:
+                return frame + 1
+            return frame
+        self._renumber(renumber)
+
+    def background_removed(self, index):
+        """Forget the edits of a deleted background layer (negative index) and renumber the ones above."""
+        self._renumber(lambda frame: None if frame == index else frame + 1 if frame < index else frame)
+
+    def _renumber(self, renumber):
+        for stack in (self.undo_stack, self.redo_stack):
+            entries = []
+            for entry in stack:
+                frame = renumber(entry[0])
+                if frame is None:
+                    self._forget(entry)
+                else:
+                    entries.append((frame,) + entry[1:])
+            stack[:] = entries
+
+
+class OnionSkin:
+    """
+    Cached ghost layer for onion skinning.
+
+    The layer is white paper with `before` previous and `after` next frames
+    multiplied onto it, the nearest at `opacity` and each further one
+    weaker by `falloff`. It is rebuilt only when the playhead moves, the
+    settings change or one of those frames is edited; otherwise showing it
+    is a single blit. The live frame is then multiplied on top, so white
+    paper lets the ghosts show through while ink stays on top.
+    """
+    def __init__(self, before=1, after=0, opacity=100, falloff=0.5):
+        self.before = before
+        self.after = after
+        self.opacity = opacity
+        self.falloff = falloff
+        self._key = None
+        self._layer = None
+
+    def neighbours(self, frames, index):
+        """(frame index, alpha) pairs, farthest first."""
+        pairs = []
+        for distance in range(max(self.before, self.after), 0, -1):
+            alpha = int(self.opacity * self.falloff ** (distance - 1))
+            if distance <= self.before and index - distance >= 0:
+                pairs.append((index - distance, alpha))
+            if distance <= self.after and index + distance < len(frames):
+                pairs.append((index + distance, alpha))
+        return pairs
+
+    def layer(self, frames, index):
+        """Return the ghost layer for the frame at `index`."""
+        pairs = self.neighbours(frames, index)
+        key = (index, frames.size, self.before, self.after, self.opacity, self.falloff,
+               tuple((i, frames.version(i), id(frames[i])) for i, _ in pairs))
+        if key != self._key:
+            self._layer = self._build(frames, pairs)
+            self._key = key
+        return self._layer
+
+    def invalidate(self):
+        self._key = None
+
+    def _build(self, frames, pairs):
+        layer = pygame.Surface(frames.size)
+        layer.fill((255, 255, 255))
+        scratch = pygame.Surface(frames.size)
+        ghost = pygame.Surface(frames.size)
+        for i, alpha in pairs:
+            scratch.blit(frames[i], (0, 0))
+            scratch.set_alpha(alpha)
+            ghost.fill((255, 255, 255))
+            ghost.blit(scratch, (0, 0))
+            layer.blit(ghost, (0, 0), special_flags=BLEND_RGB_MULT)
+        return layer
+
+
+class Filmstrip:
+    """
+    Timeline along the bottom of the bottom screen: a row of thumbnails of
+    the frames around the current one, a label and an overview bar that
+    spans the whole note.
+
+    Only the visible window is drawn. Thumbnails are the frames' composites
+    shrunk down, cached by content (the frame's version and the background
+    layers', see FrameStore.version), so one is only made again after its
+    frame changed, and frames sharing pixels share it. update() hands the
+    missing thumbnails of the visible frames to a background job, one job
+    at a time; until it is done the frame's previous thumbnail (or a grey
+    box) stands in. Scrolling and scrubbing through hundreds of frames
+    therefore never holds up a tick.
+    """
+    THUMB_SIZE = (60, 36)
+    GAP = 4
+    LABEL_HEIGHT = 18
+    BAR_HEIGHT = 6
+
+    def __init__(self, rect, font, cache_size=256):
+        self.rect = pygame.Rect(rect)
+        self.font = font
+        self.cache_size = cache_size
+        width, height = self.THUMB_SIZE
+        self.visible = (self.rect.width + self.GAP) // (width + self.GAP)
+        self.cell_width = width + self.GAP
+        self.left = self.rect.x + (self.rect.width - self.visible * self.cell_width + self.GAP) // 2
+        self.thumb_top = self.rect.y + self.LABEL_HEIGHT
+        self.bar_rect = pygame.Rect(self.left, self.thumb_top + height + 6,
+                                    self.visible * self.cell_width - self.GAP, self.BAR_HEIGHT)
+        self.first = 0  # first visible frame
+        self._thumbs = OrderedDict()  # (version, background version) -> thumbnail
+        self._shown = {}  # frame index -> (key, thumbnail) last drawn
+        self._job = None  # thumbnail job in progress
+        self._label = (None, None)
+
+    def follow(self, current, count, margin=1):
+        """Scroll so frame `current` is visible with `margin` frames beside it. Returns True if scrolled."""
+        first = self.first
+        if current < first + margin:
+            first = current - margin
+        elif current > first + self.visible - 1 - margin:
+            first = current - self.visible + 1 + margin
+        first = max(0, min(first, count - self.visible))
+        changed = first != self.first
+        self.first = first
+        return changed
+
+    def scroll(self, frames, count):
+        """Scroll by `frames` thumbnails, clamped to the note."""
+        first = max(0, min(self.first + frames, count - self.visible))
+        changed = first != self.first
+        self.first = first
+        return changed
+
+    def part_at(self, pos):
+        """"bar" or "thumbs" for a point on the overview bar or the thumbnails, else None."""
+        if self.bar_rect.inflate(0, 10).collidepoint(pos):
+            return "bar"
+        if self.rect.collidepoint(pos) and self.thumb_top <= pos[1] < self.thumb_top + self.THUMB_SIZE[1]:
+            return "thumbs"
+        return None
+
+    def scrub(self, x, part, count):
+        """
+        Frame under the pointer at `x` while dragging `part`. The bar spans
+        the whole note; past either end of the thumbnails the strip scrolls
+        by one frame per call, so holding the pointer there keeps going.
+        """
+        if part == "bar":
+            return max(0, min(count - 1, (x - self.bar_rect.x) * count // self.bar_rect.width))
+        if x < self.left:
+            self.scroll(-1, count)
+            return self.first
+        if x >= self.bar_rect.right:
+            self.scroll(1, count)
+            return min(count, self.first + self.visible) - 1
+        return min(count - 1, self.first + (x - self.left) // self.cell_width)
+
+    def cell_rect(self, slot):
+        return pygame.Rect(self.left + slot * self.cell_width, self.thumb_top, *self.THUMB_SIZE)
+
+    def update(self, frames, jobs):
+        """
+        Submit a job for the visible frames that have no thumbnail yet.
+        Returns True if a thumbnail not drawn yet is ready.
+        """
+        ready = False
+        missing = []
+        for index in range(self.first, min(self.first + self.visible, len(frames))):
+            key = (frames.version(index), frames.background_version)
+            if key in self._thumbs:
+                if self._shown.get(index, (None,))[0] != key:
+                    ready = True
+            else:
+                missing.append((index, key))
+        if missing and self._job is None:
+            self._job = jobs.submit("Filmstrip thumbnails", self._make, frames, missing,
+                                    on_done=self._made, on_error=self._made, visible=False)
+        return ready
+
+    def _make(self, job, frames, missing):
+        """
+        Job: thumbnails of the (index, key) pairs in `missing`. A frame is
+        copied under the store's lock and skipped if it changed since it was
+        queued, so no half-drawn frame is cached under its key.
+        """
+        thumbs = []
+        scratch = None
+        for index, key in missing:
+            with frames.lock:
+                if index >= len(frames) or (frames.version(index), frames.background_version) != key:
+                    continue
+                composite = frames.composite(index)
+                if scratch is None or scratch.get_size() != composite.get_size():
+                    scratch = pygame.Surface(composite.get_size())
+                scratch.blit(composite, (0, 0))
+            thumbs.append((key, pygame.transform.smoothscale(scratch, self.THUMB_SIZE)))
+        return thumbs
+
+    def _made(self, thumbs):
+        """Main thread: cache the finished job's thumbnails (`thumbs` is the error if it failed)."""
+        self._job = None
+        if isinstance(thumbs, BaseException):
+            return
+        for key, thumb in thumbs:
+            self._thumbs[key] = thumb
+        while len(self._thumbs) > self.cache_size:
+            self._thumbs.popitem(last=False)
+
+    def draw(self, screen, frames, current):
+        """Draw label, thumbnails and overview bar."""
+        count = len(frames)
+        if self._label[0] != (current, count):
+            self._label = ((current, count), self.font.render(f"Frame {current + 1}/{count}", True, (0, 0, 0)))
+        screen.blit(self._label[1], (self.left, self.rect.y))
+        shown = {}
+        for slot, index in enumerate(range(self.first, min(self.first + self.visible, count))):
+            rect = self.cell_rect(slot)
+            key = (frames.version(index), frames.background_version)
+            thumb = self._thumbs.get(key)
+            if thumb is not None:
+                self._thumbs.move_to_end(key)
+                shown[index] = (key, thumb)
+            elif index in self._shown:
+                thumb = self._shown[index][1]
+                shown[index] = self._shown[index]
+            if thumb is not None:
+                screen.blit(thumb, rect)
+            else:
+                pygame.draw.rect(screen, (220, 220, 220), rect)
+            if index == current:
+                pygame.draw.rect(screen, (220, 0, 0), rect.inflate(4, 4), 2)
+            else:
+                pygame.draw.rect(screen, (0, 0, 0), rect, 1)
+        self._shown = shown
+
+        bar = self.bar_rect
+        pygame.draw.rect(screen, (200, 200, 200), bar)
+        if count:
+            left = bar.x + self.first * bar.width // count
+            right = bar.x + min(count, self.first + self.visible) * bar.width // count
+            pygame.draw.rect(screen, (120, 120, 120), (left, bar.y, max(1, right - left), bar.height))
+            x = bar.x + (2 * current + 1) * bar.width // (2 * count)
+            pygame.draw.line(screen, (220, 0, 0), (x, bar.y - 2), (x, bar.bottom + 1), 2)
+
+
+class BrowseIndex:
+    """
+    Persistent index of the notes in a slipnotes folder, kept in a SQLite
+    sidecar next to them, so Browse mode never has to open every note.
+
+    Each row holds the file's mtime and size (to detect changes), its frame
+    count and FPS, and a zlib-compressed RGB thumbnail of the first frame.
+    poll() rescans the folder at most every `poll_interval` seconds and only
+    when the folder itself changed. A note overwritten in place leaves the
+    folder's mtime alone, so every `recheck_interval` seconds (and on a
+    forced poll, e.g. when Browse mode is entered) the notes are stat-ed
+    anyway. New or changed notes are queued and build_step() indexes them a
+    few at a time, so a large library opens at once and the thumbnails
+    fill in.
+    """
+    FILE_NAME = ".browse-index.sqlite"
+    THUMB_SIZE = (88, 53)
+
+    def __init__(self, folder, poll_interval=2.0, recheck_interval=20.0, thumb_cache=96):
+        self.folder = folder
+        self.poll_interval = poll_interval
+        self.recheck_interval = recheck_interval
+        self.thumb_cache = thumb_cache
+        self.db = sqlite3.connect(os.path.join(folder, self.FILE_NAME))
+        self.db.execute("""CREATE TABLE IF NOT EXISTS notes (
+                               name TEXT PRIMARY KEY, mtime REAL, size INTEGER,
+                               frames INTEGER, fps INTEGER, thumb BLOB)""")
+        self.db.commit()
+        self.entries = []  # sorted note names
+        self.pending = []  # names whose row is missing or out of date
+        self._thumbs = OrderedDict()
+        self._last_poll = None
+        self._last_recheck = None
+        self._folder_mtime = None
+        self.poll(force=True)
+
+    def poll(self, force=False):
+        """Rescan the folder if it or a note changed. Returns True if the listing changed."""
+        now = time.monotonic()
+        if not force and self._last_poll is not None and now - self._last_poll < self.poll_interval:
+            return False
+        self._last_poll = now
+        folder_mtime = os.stat(self.folder).st_mtime_ns
+        if not force and folder_mtime == self._folder_mtime \
+                and now - self._last_recheck < self.recheck_interval:
+            return False
+        self._folder_mtime = folder_mtime
+        self._last_recheck = now
+
+        known = {name: (mtime, size) for name, mtime, size in
+                 self.db.execute("SELECT name, mtime, size FROM notes")}
+        names = []
+        pending = []
+        with os.scandir(self.folder) as it:
+            for entry in it:
+                if entry.name.startswith(".") or not entry.name.lower().endswith(".slip") \
+                        or not entry.is_file():
+                    continue
+                st = entry.stat()
+                names.append(entry.name)
+                if known.pop(entry.name, None) != (st.st_mtime, st.st_size):
+                    pending.append(entry.name)
+        if known:
+            self.db.executemany("DELETE FROM notes WHERE name = ?", [(n,) for n in known])
+            self.db.commit()
+        names.sort()
+        changed = names != self.entries or bool(pending)
+        self.entries = names
+        self.pending = sorted(set(self.pending) | set(pending))
+        for name in pending:
+            self._thumbs.pop(name, None)
+        return changed
+
+    def build_step(self, budget=0.01):
+        """Index pending notes for up to `budget` seconds. Returns the names done."""
+        done = []
+        start = time.perf_counter()
+        while self.pending and time.perf_counter() - start < budget:
+            name = self.pending.pop(0)
+            self._index_note(name)
+            done.append(name)
+        if done:
+            self.db.commit()
+        return done
+
+    def _index_note(self, name):
+        path = os.path.join(self.folder, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return
+        frames = fps = -1
+        thumb = None
+        try:
+            if is_slip_container(path):
+                reader = SlipReader(path)
+                try:
+                    frames, fps = len(reader), reader.fps
+                    first = reader.read_frame(0, flatten=True) if frames else None
+                finally:
+                    reader.close()
+            else:
+                surfaces = read_slip_pickle(path)
+                frames, fps, first = len(surfaces), 0, surfaces[0] if surfaces else None
+            if first is not None:
+                small = pygame.transform.smoothscale(first, self.THUMB_SIZE)
+                thumb = zlib.compress(pygame.image.tostring(small, "RGB"))
+        except Exception as e:
+            logging.error("Could not index %s: %s", name, e)
+        self.db.execute("INSERT OR REPLACE INTO notes VALUES (?, ?, ?, ?, ?, ?)",
+                        (name, st.st_mtime, st.st_size, frames, fps, thumb))
+
+    def info(self, name):
+        """(frame count, fps) of a note, or None while it is not indexed."""
+        row = self.db.execute("SELECT frames, fps FROM notes WHERE name = ?", (name,)).fetchone()
+        return row if row and row[0] is not None else None
+
+    def thumbnail(self, name):
+        """First-frame thumbnail Surface (LRU-cached), or None."""
+        thumb = self._thumbs.get(name)
+        if thumb is not None:
+            self._thumbs.move_to_end(name)
+            return thumb
+        row = self.db.execute("SELECT thumb FROM notes WHERE name = ?", (name,)).fetchone()
+        if not row or not row[0]:
+            return None
+        thumb = pygame.image.fromstring(zlib.decompress(row[0]), self.THUMB_SIZE, "RGB")
+        self._thumbs[name] = thumb
+        while len(self._thumbs) > self.thumb_cache:
+            self._thumbs.popitem(last=False)
+        return thumb
+
+
+def _is_prefix(head, strokes):
+    """True if the stroke sequence `head` starts `strokes` (the same Stroke objects)."""
+    return len(head) <= len(strokes) and all(a is b for a, b in zip(head, strokes))
+
+
+class EditJournal:
+    """
+    Append-only journal of edits made since the note was last written,
+    stored next to it as "<note>.journal".
+
+    Records are appended as edits happen: the compressed tiles a stroke,
+    undo or redo wrote (reused from UndoHistory, so nothing is re-encoded),
+    how the frame's strokes changed and structural frame operations. A
+    stroke drawn (or redone) is recorded on its own and an undone one as
+    the number of strokes left, so a record costs the stroke, not the
+    frame's whole drawing. Each record is flushed straight away;
+    the file is fsynced at most every `sync_interval` seconds. replay()
+    re-applies the records to the note's last saved state, and a record cut
+    short by a crash is ignored. Once the journal grows past `max_bytes` or
+    has held edits for `max_age` seconds, due() asks for it to be compacted
+    into the .slip by a background save, after which compacted() drops the
+    records the save covered.
+    """
+    MAGIC = b"SLJ1"
+    RECORD = struct.Struct("<BiHHHHI")  # frame < 0: a background layer
+    OP_TILE = 1
+    OP_INSERT = 2
+    OP_STROKES = 3  # payload: encode_strokes() of the frame's strokes
+    OP_PIXELS = 4   # the frame became a pixel frame (no strokes)
+    OP_PALETTE = 5  # payload: the note's new palette as RGB triplets (empty: true colour)
+    OP_DUPLICATE = 6
+    OP_DELETE = 7
+    OP_MOVE = 8     # payload: the frame's new position (uint32)
+    OP_ADD_BACKGROUND = 9
+    OP_DELETE_BACKGROUND = 10
+    OP_ADD_STROKES = 11   # payload: encode_strokes() of strokes appended to the frame's
+    OP_TRIM_STROKES = 12  # payload: how many of the frame's strokes are left (uint32)
+
+    def __init__(self, base_path, max_bytes=4 * 1024 * 1024, max_age=60.0, sync_interval=5.0):
+        self.base_path = base_path
+        self.path = base_path + ".journal"
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.sync_interval = sync_interval
+        self._file = None
+        self._first_edit = None
+        self._last_sync = time.monotonic()
+        self._unsynced = False
+
+    @property
+    def size(self):
+        """Bytes of edit records (excluding the magic)."""
+        if self._file is not None:
+            return self._file.tell() - len(self.MAGIC)
+        if os.path.exists(self.path):
+            return max(0, os.path.getsize(self.path) - len(self.MAGIC))
+        return 0
+
+    def _append(self, op, frame, rect, payload=b""):
+        if self._file is None:
+            new = not os.path.exists(self.path)
+            self._file = open(self.path, "ab")
+            if new:
+                self._file.write(self.MAGIC)
+        x, y, w, h = rect
+        self._file.write(self.RECORD.pack(op, frame, x, y, w, h, len(payload)))
+        self._file.write(payload)
+        self._file.flush()
+        self._unsynced = True
+        if self._first_edit is None:
+            self._first_edit = time.monotonic()
+
+    def record_tiles(self, frame, tiles, version, strokes=None, previous=None):
+        """Record tiles written to `frame`, whose strokes went from `previous` to `strokes`."""
+        for rect, *pixels in tiles:
+            self._append(self.OP_TILE, frame, rect, pixels[version - 1])
+        if strokes is None:
+            self._append(self.OP_PIXELS, frame, (0, 0, 0, 0))
+        elif previous is not None and _is_prefix(previous, strokes):
+            if len(strokes) > len(previous):
+                self._append(self.OP_ADD_STROKES, frame, (0, 0, 0, 0), encode_strokes(strokes[len(previous):]))
+        elif previous is not None and _is_prefix(strokes, previous):
+            self._append(self.OP_TRIM_STROKES, frame, (0, 0, 0, 0), struct.pack("<I", len(strokes)))
+        else:
+            self._append(self.OP_STROKES, frame, (0, 0, 0, 0), encode_strokes(strokes))
+
+    def record_palette(self, palette):
+        self._append(self.OP_PALETTE, 0, (0, 0, 0, 0), bytes(v for c in palette or () for v in c))
+
+    def record_insert(self, index):
+        self._append(self.OP_INSERT, index, (0, 0, 0, 0))
+
+    def record_duplicate(self, index):
+        self._append(self.OP_DUPLICATE, index, (0, 0, 0, 0))
+
+    def record_delete(self, index):
+        self._append(self.OP_DELETE, index, (0, 0, 0, 0))
+
+    def record_move(self, index, target):
+        self._append(self.OP_MOVE, index, (0, 0, 0, 0), struct.pack("<I", target))
+
+    def record_add_background(self, index):
+        self._append(self.OP_ADD_BACKGROUND, index, (0, 0, 0, 0))
+
+    def record_delete_background(self, index):
+        self._append(self.OP_DELETE_BACKGROUND, index, (0, 0, 0, 0))
+
+    def sync(self):
+        """fsync pending records, rate-limited to once per sync_interval."""
+        now = time.monotonic()
+        if self._unsynced and now - self._last_sync >= self.sync_interval:
+            os.fsync(self._file.fileno())
+            self._unsynced = False
+            self._last_sync = now
+
+    def due(self):
+        """True when the journal should be compacted into the note."""
+        if self._first_edit is None:
+            return False
+        return self.size >= self.max_bytes or time.monotonic() - self._first_edit >= self.max_age
+
+    def compacted(self, offset):
+        """Drop the first `offset` bytes of records, which a save has absorbed."""
+        self.close()
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb") as f:
+            f.seek(len(self.MAGIC) + offset)
+            tail = f.read()
+        if tail:
+            with open(self.path + ".tmp", "wb") as f:
+                f.write(self.MAGIC + tail)
+            os.replace(self.path + ".tmp", self.path)
+            self._first_edit = time.monotonic()
+        else:
+            os.remove(self.path)
+            self._first_edit = None
+
+    def replay(self, frames):
+        """Re-apply the journal to a FrameStore. Returns the number of records."""
+        if not os.path.exists(self.path):
+            return 0
+        with open(self.path, "rb") as f:
+            data = f.read()
+        if not data.startswith(self.MAGIC):
+            return 0
+        pos = len(self.MAGIC)
+        count = 0
+        while pos + self.RECORD.size <= len(data):
+            op, frame, x, y, w, h, length = self.RECORD.unpack_from(data, pos)
+            payload = data[pos + self.RECORD.size:pos + self.RECORD.size + length]
+            if len(payload) < length:
+                break
+            pos += self.RECORD.size + length
+            if op == self.OP_TILE:
+                palette = padded_palette(frames.palette) if frames.palette is not None else None
+                frames.edit(frame).blit(load_tile(payload, (w, h), palette), (x, y))
+            elif op == self.OP_INSERT:
+                frames.insert(frame, frames.blank())
+            elif op == self.OP_DUPLICATE:
+                frames.duplicate(frame)
+            elif op == self.OP_DELETE:
+                frames.remove(frame)
+            elif op == self.OP_MOVE:
+                frames.move(frame, struct.unpack("<I", payload)[0])
+            elif op == self.OP_ADD_BACKGROUND:
+                frames.add_background()
+            elif op == self.OP_DELETE_BACKGROUND:
+                frames.remove_background(frame)
+            elif op == self.OP_PALETTE:
+                frames.set_palette([tuple(payload[i:i + 3]) for i in range(0, len(payload), 3)] or None)
+            elif op in (self.OP_STROKES, self.OP_PIXELS):
+                frames.edit(frame)
+                frames.set_strokes(frame, decode_strokes(payload) if op == self.OP_STROKES else None)
+            elif op == self.OP_ADD_STROKES:
+                frames.edit(frame)
+                frames.set_strokes(frame, (frames.strokes(frame) or ()) + decode_strokes(payload))
+            elif op == self.OP_TRIM_STROKES:
+                frames.edit(frame)
+                frames.set_strokes(frame, (frames.strokes(frame) or ())[:struct.unpack("<I", payload)[0]])
+            count += 1
+        if count:
+            self._first_edit = time.monotonic()
+        return count
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def discard(self):
+        """Delete the journal, e.g. when the note is replaced."""
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self._first_edit = None
+
+
+class JobCancelled(Exception):
+    """Raised inside a background job once it has been cancelled."""
+
+
+class Job:
+    """A unit of background work; see JobManager.submit()."""
+    def __init__(self, name, on_done=None, on_error=None, visible=True):
+        self.name = name
+        self.on_done = on_done
+        self.on_error = on_error
+        self.visible = visible
+        self.done = 0
+        self.total = 0
+        self.future = None
+        self._cancel = threading.Event()
+
+    def cancel(self):
+        self._cancel.set()
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    def report(self, done, total):
+        """Progress callback for the job's function; also the cancellation point."""
+        self.done = done
+        self.total = total
+        if self._cancel.is_set():
+            raise JobCancelled(self.name)
+
+
+class JobManager:
+    """
+    Runs saves, loads and exports off the UI thread.
+
+    submit() runs `fn(job, *args)` on a thread pool; the result is handed
+    to `on_done` (or the exception to `on_error`) back on the main thread
+    by poll(), which the main loop calls every tick and which stops after
+    `budget` seconds so applying results never eats a whole frame. Jobs
+    submitted with visible=False (housekeeping such as thumbnails) are not
+    listed in the progress display and Esc does not cancel them.
+    Tk dialogs are not jobs: Tk is not thread-safe, so they stay on the
+    main thread (see SlipnoteStudio.show_dialog) and only the work they
+    lead to is submitted.
+    """
+    def __init__(self, workers=2):
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="slipnote-job")
+        self.jobs = []
+        self._finished = queue.Queue()
+        self._progress = None
+
+    def submit(self, name, fn, *args, on_done=None, on_error=None, visible=True):
+        job = Job(name, on_done, on_error, visible)
+        self.jobs.append(job)
+        job.future = self.executor.submit(self._run, job, fn, args)
+        return job
+
+    def _run(self, job, fn, args):
+        try:
+            result = fn(job, *args)
+            self._finished.put((job, result, None))
+        except BaseException as e:
+            self._finished.put((job, None, e))
+
+    @property
+    def shown(self):
+        """The jobs listed in the progress display."""
+        return [job for job in self.jobs if job.visible]
+
+    @property
+    def active(self):
+        return [job for job in self.shown if not job.future.done()]
+
+    def cancel_all(self):
+        for job in self.shown:
+            job.cancel()
+
+    def poll(self, budget=0.005):
+        """
+        Apply finished jobs on the calling (main) thread. Returns True when
+        something finished or the progress of a running job changed.
+        """
+        changed = False
+        start = time.perf_counter()
+        while time.perf_counter() - start < budget:
+            try:
+                job, result, error = self._finished.get_nowait()
+            except queue.Empty:
+                break
+            changed = True
+            if job in self.jobs:
+                self.jobs.remove(job)
+            if error is None:
+                if job.on_done:
+                    job.on_done(result)
+            elif isinstance(error, JobCancelled):
+                logging.info("%s cancelled.", job.name)
+                if job.on_error:
+                    job.on_error(error)
+            else:
+                logging.error("%s failed: %s", job.name, error)
+                if job.on_error:
+                    job.on_error(error)
+        progress = [(job.name, job.done, job.total) for job in self.shown]
+        if progress != self._progress:
+            self._progress = progress
+            changed = True
+        return changed
+
+    def wait(self, job=None):
+        """Block until `job` (default: every job) is done and apply the results."""
+        for pending in [job] if job is not None else list(self.jobs):
+            try:
+                pending.future.result()
+            except Exception:
+                pass
+        while not self._finished.empty():
+            self.poll()
+
+    def wait_all(self):
+        """Let running jobs finish and apply their results (used on exit)."""
+        self.wait()
+        self.executor.shutdown()
+
+
+def ask_dialog(ask):
+    """Run `ask()` (which uses tkinter dialogs) with a hidden Tk root; main thread only."""
+    if not TK_AVAILABLE:
+        raise RuntimeError("dialogs need tkinter, which is not installed")
+    import tkinter
+    root = tkinter.Tk()
+    root.withdraw()
+    try:
+        return ask()
+    finally:
+        root.destroy()
+
+
+_image_cache = {}
+
+
+def load_image(path):
+    """
+    Load an image file as a per-pixel-alpha Surface, once per path.
+
+    pygame's own loader (SDL_image) is used so Pillow is not imported at
+    startup; the result is converted for the display when there is one.
+    """
+    image = _image_cache.get(path)
+    if image is None:
+        image = pygame.image.load(path)
+        if pygame.display.get_surface() is not None:
+            image = image.convert_alpha()
+        _image_cache[path] = image
+    return image
+
+
+class PlaybackScheduler:
+    """
+    Fixed-timestep clock that advances animation frames at the note's FPS,
+    independently of how often the main loop runs.
+
+    The number of due frames is derived from the total elapsed time rather
+    than by summing per-tick deltas, so rounding never accumulates into
+    drift. When the loop falls behind, update() reports every due step at
+    once and the caller shows only the last one (frames are skipped, the
+    timeline is not slowed down). `clock` is any callable returning seconds;
+    swapping in an audio clock via set_clock() slaves playback to audio.
+    """
+    def __init__(self, fps, clock=None):
+        self.fps = fps
+        self.clock = clock or time.perf_counter
+        self.skipped = 0
+        self.reset()
+
+    def reset(self):
+        """Start counting from frame zero at the current clock time."""
+        self._start = self.clock()
+        self._steps = 0
+        self.skipped = 0
+
+    def set_fps(self, fps):
+        """Change the timestep without jumping: rebase on the steps already taken."""
+        now = self.clock()
+        self._start = now - self._steps / float(fps)
+        self.fps = fps
+
+    def set_clock(self, clock):
+        """Follow another time source, e.g. the audio playback position."""
+        self.clock = clock or time.perf_counter
+        self._start = self.clock() - self._steps / float(self.fps)
+
+    def update(self):
+        """Return the number of playback steps due since the last call."""
+        due = int((self.clock() - self._start) * self.fps) - self._steps
+        if due <= 0:
+            return 0
+        self._steps += due
+        self.skipped += due - 1
+        return due
+
+
+class PlaybackEngine:
+    """
+    Plays the frames of a FrameStore in time with the audio track.
+
+    A producer thread keeps a ring buffer filled with the frames just ahead
+    of the playhead, decoded and composited over the background layers. While audio is playing, the mixer position
+    is the master clock of the PlaybackScheduler, so video follows audio
+    without drift however long the note is. Frames skipped because the loop
+    fell behind count as dropped; frames that were due before the producer
+    had decoded them count as late.
+    """
+    def __init__(self, frames, fps, ring_size=24, preload=8):
+        self.frames = frames
+        self.scheduler = PlaybackScheduler(fps)
+        self.ring_size = ring_size
+        self.preload = preload
+        self.ring = {}
+        self.playhead = 0
+        self.playing = False
+        self.with_audio = False
+        self.shown = 0
+        self.late = 0
+        self._cond = threading.Condition()
+        self._thread = None
+        self._audio_pos = 0
+        self._audio_wall = 0.0
+
+    @property
+    def dropped(self):
+        return self.scheduler.skipped
+
+    def start(self, first_frame=0, audio=None):
+        """
+        Preload the first frames, start the audio (a path or file object,
+        if any) and the producer.
+        """
+        self.stop()
+        self.playhead = first_frame
+        self.shown = self.late = 0
+        self.ring = {}
+        for index in self._window()[:self.preload]:
+            self.ring[index] = self.frames.composite(index)
+        self.with_audio = False
+        if audio:
+            try:
+                pygame.mixer.music.load(audio)
+                pygame.mixer.music.play()
+                self.with_audio = True
+            except pygame.error as e:
+                logging.error("Could not play audio track: %s", e)
+        self._audio_pos = 0
+        self._audio_wall = time.perf_counter()
+        self.scheduler.set_clock(self._audio_clock if self.with_audio else None)
+        self.scheduler.reset()
+        self.playing = True
+        self._thread = threading.Thread(target=self._produce, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if not self.playing:
+            return
+        with self._cond:
+            self.playing = False
+            self._cond.notify_all()
+        self._thread.join()
+        self._thread = None
+        self.ring = {}
+        if self.with_audio:
+            pygame.mixer.music.stop()
+
+    def update(self):
+        """
+        Advance the playhead to the frame the clock says is due.
+        Returns the Surface to show, or None when the frame has not changed.
+        """
+        steps = self.scheduler.update()
+        if not steps:
+            return None
+        with self._cond:
+            self.playhead = (self.playhead + steps) % len(self.frames)
+            surface = self.ring.get(self.playhead)
+            self._cond.notify()
+        if surface is None:
+            self.late += 1
+            surface = self.frames.composite(self.playhead)
+        self.shown += 1
+        return surface
+
+    def _audio_clock(self):
+        """
+        Seconds of audio played. get_pos() only moves once per mixer buffer,
+        so the time since it last changed is added on top. Once the track
+        ends the clock carries on from there in wall time.
+        """
+        now = time.perf_counter()
+        pos = pygame.mixer.music.get_pos()
+        if pos >= 0 and pos != self._audio_pos:
+            self._audio_pos = pos
+            self._audio_wall = now
+        return self._audio_pos / 1000.0 + (now - self._audio_wall)
+
+    def _window(self):
+        count = len(self.frames)
+        return [(self.playhead + k) % count for k in range(min(self.ring_size, count))]
+
+    def _produce(self):
+        """Producer thread: decode frames ahead of the playhead into the ring."""
+        while True:
+            with self._cond:
+                while self.playing:
+                    window = self._window()
+                    for index in list(self.ring):
+                        if index not in window:
+                            del self.ring[index]
+                    wanted = [i for i in window if i not in self.ring]
+                    if wanted:
+                        break
+                    self._cond.wait(0.05)
+                if not self.playing:
+                    return
+            index = wanted[0]
+            surface = self.frames.composite(index)
+            with self._cond:
+                if self.playing:
+                    self.ring[index] = surface
+
+
+# -----------------------------------------------------------------------------
+# PERFORMANCE MONITOR
+# -----------------------------------------------------------------------------
+def memory_usage():
+    """Resident memory of this process in bytes (peak if current is unknown), or None."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def slow_tick_hook(threshold=0.05):
+    """A PerfMonitor hook that logs every tick slower than `threshold` seconds."""
+    def hook(timings, total):
+        if total >= threshold:
+            phases = ", ".join(f"{name} {1000 * seconds:.1f}" for name, seconds in timings.items()
+                               if seconds >= 0.001)
+            logging.warning("Slow frame: %.1f ms (%s)", 1000 * total, phases)
+    return hook
+
+
+class PerfMonitor:
+    """
+    Per-phase timing of the main loop, for the HUD and for hooks.
+
+    The loop calls mark(phase) after each phase of a tick, which books the
+    time since the previous mark to that phase, and end_tick() at the end.
+    end_tick() passes the tick's timings to every hook added with
+    add_hook(), as `hook(timings, total)` in seconds, so stutters can be
+    logged or shipped elsewhere without touching the loop. averages() and
+    worst() summarize the last `window` ticks.
+
+    start_profile() captures the main thread either with cProfile
+    ("cprofile", written as a pstats file) or by sampling its stack every
+    `sample_interval` seconds from a helper thread ("sample", much cheaper;
+    written as folded stacks for flame graph tools).
+    """
+    PROFILE_MODES = ("cprofile", "sample")
+
+    def __init__(self, window=120, sample_interval=0.005):
+        self.ticks = deque(maxlen=window)
+        self.hooks = []
+        self.sample_interval = sample_interval
+        self.profile_mode = None
+        self.profile_path = None
+        self._profiler = None
+        self._samples = None
+        self._sampler = None
+        self._stop_sampling = threading.Event()
+        self._timings = {}
+        self._tick_start = self._last = time.perf_counter()
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+        return hook
+
+    def remove_hook(self, hook):
+        if hook in self.hooks:
+            self.hooks.remove(hook)
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self._timings[phase] = self._timings.get(phase, 0.0) + now - self._last
+        self._last = now
+
+    def end_tick(self):
+        now = time.perf_counter()
+        timings, total = self._timings, now - self._tick_start
+        self._timings = {}
+        self._tick_start = self._last = now
+        self.ticks.append((timings, total))
+        for hook in self.hooks:
+            hook(timings, total)
+
+    @property
+    def fps(self):
+        elapsed = sum(total for _, total in self.ticks)
+        return len(self.ticks) / elapsed if elapsed else 0.0
+
+    def averages(self):
+        """Mean seconds per tick spent in each phase."""
+        sums = {}
+        for timings, _ in self.ticks:
+            for phase, seconds in timings.items():
+                sums[phase] = sums.get(phase, 0.0) + seconds
+        return {phase: seconds / len(self.ticks) for phase, seconds in sums.items()}
+
+    def worst(self):
+        """Longest tick in the window, in seconds."""
+        return max((total for _, total in self.ticks), default=0.0)
+
+    # Profiling
+    def start_profile(self, path, mode="cprofile"):
+        """Start capturing the calling (main) thread into `path`."""
+        if mode not in self.PROFILE_MODES:
+            raise ValueError(f"Unknown profile mode: {mode}")
+        self.stop_profile()
+        self.profile_mode = mode
+        self.profile_path = path
+        if mode == "cprofile":
+            import cProfile
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        else:
+            self._samples = {}
+            self._stop_sampling.clear()
+            self._sampler = threading.Thread(target=self._sample, args=(threading.get_ident(),),
+                                             name="slipnote-sampler", daemon=True)
+            self._sampler.start()
+
+    def stop_profile(self):
+        """Stop capturing and write the profile. Returns its path, or None."""
+        if self.profile_mode is None:
+            return None
+        if self._profiler is not None:
+            self._profiler.disable()
+            self._profiler.dump_stats(self.profile_path)
+            self._profiler = None
+        if self._sampler is not None:
+            self._stop_sampling.set()
+            self._sampler.join()
+            self._sampler = None
+            with open(self.profile_path, "w") as f:
+                for stack, count in sorted(self._samples.items(), key=lambda item: -item[1]):
+                    f.write(f"{stack} {count}\n")
+            self._samples = None
+        path, self.profile_mode, self.profile_path = self.profile_path, None, None
+        return path
+
+    def _sample(self, thread_id):
+        """Sampler thread: count the main thread's stacks."""
+        while not self._stop_sampling.wait(self.sample_interval):
+            frame = sys._current_frames().get(thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            key = ";".join(reversed(stack))
+            self._samples[key] = self._samples.get(key, 0) + 1
+
+
+# -----------------------------------------------------------------------------
+# EXPORT (GIF / MP4)
+# -----------------------------------------------------------------------------
+# Frames are streamed from the .slip file through a process pool: each
+# worker opens the file itself and is handed only frame numbers, so no
+# frame data crosses process boundaries on the way in and at most a small
+# window of encoded frames is alive at any time.
+
+def read_slip_pickle(file_path):
+    """Read frames from the original pickle-of-RGBA format as opaque Surfaces."""
+    import pickle
+    with open(file_path, "rb") as f:
+        slip_info = pickle.load(f)
+    size = (slip_info["width"], slip_info["height"])
+    frames = []
+    for frame_rgba in slip_info["frames_rgba"]:
+        frame_surf = pygame.Surface(size)
+        frame_surf.blit(pygame.image.fromstring(frame_rgba, size, "RGBA"), (0, 0))
+        frames.append(frame_surf)
+    return frames
+
+
+def write_slip(file_path, frames, fps=30):
+    """Write a sequence of Surfaces as a .slip container."""
+    colours = set()
+    for frame in frames:
+        colours |= surface_colours(frame)
+    width, height = frames[0].get_size()
+    writer = SlipWriter(file_path, width, height, fps, build_palette(colours))
+    try:
+        for frame in frames:
+            writer.add_frame(frame)
+    except Exception:
+        writer.abort()
+        raise
+    writer.close()
+
+
+def _gif_lzw(indices, min_code_size):
+    """GIF-flavoured variable-width LZW, returned as 255-byte sub-blocks."""
+    clear = 1 << min_code_size
+    eoi = clear + 1
+    out = bytearray()
+    acc = nbits = 0
+    code_size = min_code_size + 1
+    next_code = eoi + 1
+    table = {}
+
+    acc |= clear << nbits
+    nbits += code_size
+    prefix = indices[0]
+    for value in indices[1:]:
+        key = (prefix << 8) | value
+        code = table.get(key)
+        if code is not None:
+            prefix = code
+            continue
+        acc |= prefix << nbits
+        nbits += code_size
+        while nbits >= 8:
+            out.append(acc & 0xFF)
+            acc >>= 8
+            nbits -= 8
+        # The decoder widens one code after the encoder adds an entry.
+        if next_code >= (1 << code_size) and code_size < 12:
+            code_size += 1
+        if next_code < 4096:
+            table[key] = next_code
+            next_code += 1
+        else:
+            acc |= clear << nbits
+            nbits += code_size
+            table = {}
+            next_code = eoi + 1
+            code_size = min_code_size + 1
+        prefix = value
+    for code in (prefix, eoi):
+        acc |= code << nbits
+        nbits += code_size
+        if next_code >= (1 << code_size) and code_size < 12:
+            code_size += 1
+    while nbits > 0:
+        out.append(acc & 0xFF)
+        acc >>= 8
+        nbits -= 8
+
+    blocks = bytearray([min_code_size])
+    for i in range(0, len(out), 255):
+        block = out[i:i + 255]
+        blocks.append(len(block))
+        blocks += block
+    blocks.append(0)
+    return bytes(blocks)
+
+
+def _gif_table(palette):
+    """Colour table padded to a power of two; returns (size bits, table bytes)."""
+    bits = max(1, (len(palette) - 1).bit_length())
+    table = bytes(v for c in palette for v in c).ljust(3 * (1 << bits), b"\0")
+    return bits, table
+
+
+_export_reader = None
+_export_scale = 1
+
+
+def _export_worker_init(slip_path, scale=1):
+    global _export_reader, _export_scale
+    _export_reader = SlipReader(slip_path)
+    _export_scale = scale
+
+
+def _encode_gif_frame(number):
+    """Worker: LZW-encode one frame; quantize it first if the note has no palette."""
+    reader = _export_reader
+    pixels = reader.read_pixels(number, _export_scale, flatten=True)
+    local_table = None
+    if reader.palette is None:
+        from PIL import Image
+        size = (reader.width * _export_scale, reader.height * _export_scale)
+        image = Image.frombytes("RGB", size, pixels).quantize(256)
+        pixels = image.tobytes()
+        palette = image.getpalette()[:768]
+        local_table = [tuple(palette[i:i + 3]) for i in range(0, len(palette), 3)]
+        bits = 8
+    else:
+        bits = max(1, (len(reader.palette) - 1).bit_length())
+    return local_table, _gif_lzw(pixels, max(2, bits))
+
+
+def _encode_rgb_frame(number):
+    """Worker: expand one frame to packed RGB24 for ffmpeg."""
+    return pygame.image.tostring(_export_reader.read_frame(number, _export_scale, flatten=True), "RGB")
+
+
+def _ordered_results(executor, fn, items, window):
+    """Like executor.map, but with at most `window` results outstanding."""
+    pending = []
+    for item in items:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= window:
+            yield pending.pop(0).result()
+    for future in pending:
+        yield future.result()
+
+
+def _frame_results(slip_path, fn, count, workers, scale):
+    """Run `fn` for every frame number, in a process pool unless workers == 0."""
+    if workers == 0:
+        _export_worker_init(slip_path, scale)
+        for number in range(count):
+            yield fn(number)
+        return
+    with concurrent.futures.ProcessPoolExecutor(workers, initializer=_export_worker_init,
+                                                  initargs=(slip_path, scale)) as executor:
+        yield from _ordered_results(executor, fn, range(count), (workers or os.cpu_count() or 1) * 2)
+
+
+def _write_gif(slip_path, out_path, reader, workers, progress, scale):
+    try:
+        _write_gif_frames(slip_path, out_path + ".tmp", reader, workers, progress, scale)
+    except BaseException:
+        if os.path.exists(out_path + ".tmp"):
+            os.remove(out_path + ".tmp")
+        raise
+    os.replace(out_path + ".tmp", out_path)
+
+
+def _write_gif_frames(slip_path, tmp_path, reader, workers, progress, scale):
+    fps = max(1, reader.fps)
+    width, height = reader.width * scale, reader.height * scale
+    with open(tmp_path, "wb") as out:
+        out.write(b"GIF89a")
+        flags = 0
+        global_table = b""
+        if reader.palette is not None:
+            bits, global_table = _gif_table(reader.palette)
+            flags = 0x80 | (bits - 1) << 4 | (bits - 1)
+        out.write(struct.pack("<HHBBB", width, height, flags, 0, 0))
+        out.write(global_table)
+        # Loop forever
+        out.write(b"\x21\xff\x0bNETSCAPE2.0\x03\x01\x00\x00\x00")
+        results = _frame_results(slip_path, _encode_gif_frame, len(reader), workers, scale)
+        for number, (local_table, data) in enumerate(results):
+            # Delays are in 1/100 s; rounding the running total keeps long
+            # animations in step with the note's FPS.
+            delay = round((number + 1) * 100 / fps) - round(number * 100 / fps)
+            out.write(struct.pack("<BBBBHBB", 0x21, 0xF9, 4, 0, delay, 0, 0))
+            descriptor_flags = 0
+            table = b""
+            if local_table is not None:
+                bits, table = _gif_table(local_table)
+                descriptor_flags = 0x80 | (bits - 1)
+            out.write(struct.pack("<BHHHHB", 0x2C, 0, 0, width, height, descriptor_flags))
+            out.write(table)
+            out.write(data)
+            if progress:
+                progress(number + 1, len(reader))
+        out.write(b"\x3b")
+
+
+def _close_quietly(pipe):
+    """Close a pipe to a process that may have exited already."""
+    try:
+        pipe.close()
+    except OSError:
+        pass
+
+
+def _write_mp4(slip_path, out_path, reader, audio_path, workers, progress, scale):
+    ffmpeg = shutil.which("ffmpeg")
+    if ffmpeg is None:
+        raise RuntimeError("MP4 export needs ffmpeg on PATH")
+    cmd = [ffmpeg, "-y", "-loglevel", "error",
+           "-f", "rawvideo", "-pix_fmt", "rgb24", "-s", f"{reader.width * scale}x{reader.height * scale}",
+           "-r", str(max(1, reader.fps)), "-i", "-"]
+    if audio_path:
+        # The animation sets the length: a short track is padded with
+        # silence and a long one is cut off at the last frame.
+        duration = len(reader) / max(1, reader.fps)
+        cmd += ["-i", audio_path, "-map", "0:v", "-map", "1:a", "-c:a", "aac",
+                "-af", "apad", "-t", f"{duration:.3f}"]
+    cmd += ["-c:v", "libx264", "-pix_fmt", "yuv420p", "-movflags", "+faststart", out_path]
+    # ffmpeg's messages go to a file, which cannot fill up and stall it
+    with tempfile.TemporaryFile() as messages:
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stderr=messages)
+        try:
+            write_error = None
+            results = _frame_results(slip_path, _encode_rgb_frame, len(reader), workers, scale)
+            try:
+                for number, rgb in enumerate(results):
+                    proc.stdin.write(rgb)
+                    if progress:
+                        progress(number + 1, len(reader))
+                proc.stdin.close()
+            except OSError as e:
+                # Usually a broken pipe: ffmpeg quit early, and its status says why
+                write_error = e
+                _close_quietly(proc.stdin)
+            finally:
+                results.close()  # shut the worker pool down now, not when collected
+            returncode = proc.wait()
+            if returncode != 0:
+                messages.seek(0)
+                detail = messages.read().decode(errors="replace").strip()
+                raise RuntimeError(f"ffmpeg exited with status {returncode}" + (f": {detail}" if detail else ""))
+            if write_error is not None:
+                raise write_error
+        except BaseException:
+            if proc.poll() is None:
+                proc.kill()
+            _close_quietly(proc.stdin)
+            proc.wait()
+            if os.path.exists(out_path):
+                os.remove(out_path)
+            raise
+
+
+def export_slipnote(slip_path, out_path, audio_path=None, workers=None, progress=None, scale=1):
+    """
+    Export a .slip file to GIF or MP4 (chosen by the extension of out_path).
+    `workers` is the process pool size (None: one per core, 0: encode in
+    this process). `progress(done, total)` is called after each frame.
+    With `scale` 2 or 4 vector frames are redrawn at that resolution (pixel
+    frames are enlarged). MP4s get `audio_path` as their sound track, or
+    else the note's own audio for the length of the animation. Legacy pickle
+    notes are migrated to a temporary container first.
+    """
+    temp_path = wav_path = None
+    if not is_slip_container(slip_path):
+        temp_path = out_path + ".tmp.slip"
+        write_slip(temp_path, read_slip_pickle(slip_path))
+        slip_path = temp_path
+    try:
+        reader = SlipReader(slip_path)
+        try:
+            ext = os.path.splitext(out_path)[1].lower()
+            if ext == ".gif":
+                _write_gif(slip_path, out_path, reader, workers, progress, scale)
+            elif ext == ".mp4":
+                track = None if audio_path else reader.read_audio(0, len(reader))
+                if track is not None:
+                    wav_path = audio_path = out_path + ".wav"
+                    with open(wav_path, "wb") as f:
+                        f.write(pcm_to_wav(*track))
+                _write_mp4(slip_path, out_path, reader, audio_path, workers, progress, scale)
+            else:
+                raise ValueError(f"Unsupported export format: {ext}")
+        finally:
+            reader.close()
+    finally:
+        for path in (temp_path, wav_path):
+            if path is not None and os.path.exists(path):
+                os.remove(path)
+
+
+def _export_one(job):
+    """Batch worker: export one note with in-process encoding."""
+    slip_path, out_path, scale = job
+    try:
+        export_slipnote(slip_path, out_path, workers=0, scale=scale)
+        return slip_path, None
+    except Exception as e:
+        return slip_path, str(e)
+
+
+def export_directory(src_dir, out_dir, fmt, workers=None, scale=1):
+    """
+    Convert every .slip in src_dir, one note per worker process.
+    Returns the number of notes that failed.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    jobs = []
+    for name in sorted(os.listdir(src_dir)):
+        # Hidden notes (the autosave) are not part of the collection
+        if name.lower().endswith(".slip") and not name.startswith("."):
+            base = os.path.splitext(name)[0]
+            jobs.append((os.path.join(src_dir, name), os.path.join(out_dir, f"{base}.{fmt}"), scale))
+    failures = 0
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        for slip_path, error in executor.map(_export_one, jobs):
+            if error:
+                failures += 1
+                logging.error("Failed to export %s: %s", slip_path, error)
+            else:
+                logging.info("Exported %s", slip_path)
+    logging.info("Exported %d of %d slipnotes to %s", len(jobs) - failures, len(jobs), out_dir)
+    return failures
 
-# For loading the icon and images via Pillow
-from PIL import Image
 
-# Try to import PyAudio
-try:
-    import pyaudio
-    PYAUDIO_AVAILABLE = True
-except ImportError:
-    logging.error("PyAudio not found. Using VirtualMicrophone.")
-    PYAUDIO_AVAILABLE = False
+# -----------------------------------------------------------------------------
+# IMPORT (GIF / VIDEO / IMAGE SEQUENCES)
+# -----------------------------------------------------------------------------
+# The reverse of export. Source frames are read in order in this process (a
+# GIF or a video can only be decoded front to back; for an image sequence
+# only the file names are), fitted to the note and dithered to a fixed
+# palette in a process pool, and streamed into a SlipWriter. Workers take
+# short runs of consecutive frames and also compress them, as keyframes and
+# as deltas within the run, which would otherwise leave the writer doing
+# most of the work. The pool keeps a small window of runs in flight, so a
+# long clip never sits in memory. Pillow does the image work; videos are
+# decoded and scaled by ffmpeg.
 
-import wave
+IMPORT_PALETTES = {
+    "colour": [(255, 255, 255), (0, 0, 0), (255, 0, 0), (0, 0, 255)],
+    "mono": [(255, 255, 255), (0, 0, 0)],
+}
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".tga", ".tif", ".tiff", ".webp")
+VIDEO_EXTENSIONS = (".mp4", ".m4v", ".mov", ".avi", ".mkv", ".webm", ".mpg", ".mpeg")
+IMPORT_RUN = 4  # consecutive frames per worker job
 
-# For exporting to GIF or MP4, you might use imageio or moviepy, but here we just log success.
-# If you want real exports, install something like `imageio` or `moviepy`.
-# pip install imageio moviepy
+_import_size = (400, 240)
+_import_palette = None
+_import_lut = None
+_import_dither = True
+_import_bpp = ENC_INDEX8
 
-# Custom logging handler to store messages for display in the Pygame window
-class PygameLogHandler(logging.Handler):
-    def __init__(self, studio, capacity=10):
-        super().__init__()
-        self.studio = studio
-        self.capacity = capacity
 
-    def emit(self, record):
-        msg = self.format(record)
-        self.studio.log_messages.append(msg)
-        if len(self.studio.log_messages) > self.capacity:
-            self.studio.log_messages.pop(0)
+def _import_worker_init(size, palette, dither, bpp):
+    global _import_size, _import_palette, _import_lut, _import_dither, _import_bpp
+    from PIL import Image
+    _import_size = size
+    _import_palette = Image.new("P", (1, 1))
+    _import_palette.putpalette([v for c in padded_palette(palette) for v in c])
+    # Padding entries repeat paper white; fold any match on them back to 0
+    _import_lut = bytes(i if i < len(palette) else 0 for i in range(256))
+    _import_dither = dither
+    _import_bpp = bpp
 
-class VirtualMicrophone:
+
+def _paper_rgb(image):
+    """An RGB copy of a Pillow image, with transparent pixels on paper white."""
+    from PIL import Image
+    if image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info:
+        image = image.convert("RGBA")
+        paper = Image.new("RGB", image.size, (255, 255, 255))
+        paper.paste(image, mask=image.getchannel("A"))
+        return paper
+    return image.convert("RGB")
+
+
+def _fit_image(image, size):
+    """Scale an RGB image to fit `size`, keeping its aspect ratio, centred on paper white."""
+    from PIL import Image
+    if image.size == size:
+        return image
+    scale = min(size[0] / image.width, size[1] / image.height)
+    fitted = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+    image = image.resize(fitted, Image.Resampling.LANCZOS, reducing_gap=3.0)
+    if fitted == size:
+        return image
+    paper = Image.new("RGB", size, (255, 255, 255))
+    paper.paste(image, ((size[0] - fitted[0]) // 2, (size[1] - fitted[1]) // 2))
+    return paper
+
+
+def _import_frame(source):
+    """Turn one source frame (an image file, or raw RGB as (size, data)) into palette indices."""
+    from PIL import Image
+    if isinstance(source, str):
+        with Image.open(source) as image:
+            image.draft("RGB", _import_size)  # JPEGs decode straight at a reduced size
+            image = _paper_rgb(image)
+    else:
+        image = Image.frombytes("RGB", *source)
+    dither = Image.Dither.FLOYDSTEINBERG if _import_dither else Image.Dither.NONE
+    image = _fit_image(image, _import_size).quantize(palette=_import_palette, dither=dither)
+    return image.tobytes().translate(_import_lut)
+
+
+def _import_run(run):
     """
-    Simulates a microphone by generating random 8-bit audio data.
-    Single-channel (mono).
+    Worker: convert a run of (source, repeat, advance) frames, where
+    `advance` is how many source frames the job stands for (dropped ones
+    included). Returns a (pixels, payload, delta, repeat, advance) tuple
+    per frame for SlipWriter.add_pixels; the first frame's delta is left
+    to the writer.
     """
-    def __init__(self, chunk=1024, rate=44100):
-        self.chunk = chunk
-        self.rate = rate
+    results = []
+    prev = None
+    for source, repeat, advance in run:
+        pixels = _import_frame(source)
+        delta = None if prev is None else compress_pixels(_xor_bytes(pixels, prev), _import_bpp)
+        results.append((pixels, compress_pixels(pixels, _import_bpp), delta, repeat, advance))
+        prev = pixels
+    return results
+
+
+def _import_runs(jobs):
+    run = []
+    for job in jobs:
+        run.append(job)
+        if len(run) == IMPORT_RUN:
+            yield run
+            run = []
+    if run:
+        yield run
+
+
+def _natural_key(path):
+    """Sort key that puts frame2.png before frame10.png."""
+    return [int(part) if part.isdigit() else part.lower()
+            for part in re.split(r"(\d+)", os.path.basename(path))]
+
+
+def image_sequence(source):
+    """The image files of a sequence: a folder, or a glob pattern such as shots/take1_*.png."""
+    if os.path.isdir(source):
+        paths = [os.path.join(source, name) for name in os.listdir(source)]
+    else:
+        paths = glob.glob(source)
+    paths = [p for p in paths if p.lower().endswith(IMAGE_EXTENSIONS) and os.path.isfile(p)]
+    return sorted(paths, key=_natural_key)
+
+
+def _gif_source(path, fps):
+    """
+    fps, frame total and jobs for an animated GIF. Frame delays are mapped
+    onto the note's fixed frame rate (by default the first frame's), so
+    frames held longer are repeated and frames too short for it dropped.
+    """
+    from PIL import Image
+    with Image.open(path) as image:
+        total = getattr(image, "n_frames", 1)
+        delay = image.info.get("duration") or 100
+    if fps is None:
+        fps = max(1, min(30, round(1000 / delay)))
+
+    def jobs():
+        from PIL import ImageSequence
+        elapsed = shown = read = 0
+        with Image.open(path) as image:
+            for frame in ImageSequence.Iterator(image):
+                read += 1
+                elapsed += frame.info.get("duration") or 100
+                repeat = round(elapsed * fps / 1000) - shown
+                if repeat > 0:
+                    shown += repeat
+                    rgb = _paper_rgb(frame)
+                    yield (rgb.size, rgb.tobytes()), repeat, read
+                    read = 0
+
+    return fps, total, jobs()
+
+
+def _video_probe(path):
+    """(frame rate, duration in seconds) of a video from ffprobe, or Nones."""
+    ffprobe = shutil.which("ffprobe")
+    if ffprobe is None:
+        return None, None
+    result = subprocess.run([ffprobe, "-v", "error", "-select_streams", "v:0",
+                             "-show_entries", "stream=avg_frame_rate:format=duration", "-of", "json", path],
+                            capture_output=True, text=True)
+    try:
+        info = json.loads(result.stdout)
+    except ValueError:
+        return None, None
+    rate = duration = None
+    try:
+        num, _, den = info["streams"][0]["avg_frame_rate"].partition("/")
+        rate = float(num) / float(den or 1)
+    except (ValueError, KeyError, IndexError, ZeroDivisionError):
+        pass
+    try:
+        duration = float(info["format"]["duration"])
+    except (ValueError, KeyError):
+        pass
+    return rate, duration
+
+
+def _video_source(path, fps, size):
+    """
+    fps, frame total and jobs for a video file. ffmpeg decodes it, resamples
+    it to the note's frame rate (by default the video's own, at most 30)
+    and fits it to the note, so workers only dither.
+    """
+    ffmpeg = shutil.which("ffmpeg")
+    if ffmpeg is None:
+        raise RuntimeError("video import needs ffmpeg on PATH")
+    rate, duration = _video_probe(path)
+    if fps is None:
+        fps = max(1, min(30, round(rate))) if rate else 30
+    total = round(duration * fps) if duration else 0
+    width, height = size
+    video_filter = (f"fps={fps},scale={width}:{height}:force_original_aspect_ratio=decrease,"
+                    f"pad={width}:{height}:(ow-iw)/2:(oh-ih)/2:white")
+
+    def jobs():
+        proc = subprocess.Popen([ffmpeg, "-loglevel", "error", "-i", path, "-vf", video_filter, "-an",
+                                 "-f", "rawvideo", "-pix_fmt", "rgb24", "-"], stdout=subprocess.PIPE)
+        try:
+            while True:
+                data = proc.stdout.read(width * height * 3)
+                if len(data) < width * height * 3:
+                    break
+                yield (size, data), 1, 1
+        except BaseException:
+            proc.kill()
+            raise
+        finally:
+            proc.stdout.close()
+            returncode = proc.wait()
+        if returncode != 0:
+            raise RuntimeError(f"ffmpeg exited with status {returncode}")
+
+    return fps, total, jobs()
+
+
+def _import_results(jobs, workers, initargs):
+    """Convert `jobs` run by run, in order, in a process pool unless workers == 0."""
+    if workers == 0:
+        _import_worker_init(*initargs)
+        for run in _import_runs(jobs):
+            yield _import_run(run)
+        return
+    # Runs hold a few source frames each, so only one per worker is queued
+    with concurrent.futures.ProcessPoolExecutor(workers, initializer=_import_worker_init,
+                                                  initargs=initargs) as executor:
+        yield from _ordered_results(executor, _import_run, _import_runs(jobs),
+                                    (workers or os.cpu_count() or 1) + 1)
+
+
+def import_frames(source, slip_path, fps=None, palette="colour", dither=True, workers=None, progress=None):
+    """
+    Import an animated GIF, a video file (needs ffmpeg) or an image sequence
+    (a folder of images, or a glob pattern) as a new note at `slip_path`.
+    Frames are fitted to 400x240 on paper white and dithered to one of the
+    IMPORT_PALETTES. `fps` defaults to the GIF's or video's own rate, and to
+    30 for image sequences. `workers` and `progress(done, total)` work as in
+    export_slipnote; they count source frames, `total` is 0 when unknown
+    (or an estimate, for videos) and the last call has done == total.
+    Returns the number of frames in the note.
+    """
+    if not PIL_AVAILABLE:
+        raise RuntimeError("importing needs Pillow, which is not installed")
+    size = (400, 240)
+    colours = IMPORT_PALETTES[palette]
+    ext = os.path.splitext(source)[1].lower()
+    if ext == ".gif":
+        fps, total, jobs = _gif_source(source, fps)
+    elif ext in VIDEO_EXTENSIONS:
+        fps, total, jobs = _video_source(source, fps, size)
+    else:
+        paths = image_sequence(source)
+        if not paths:
+            raise ValueError(f"No images found in {source}")
+        fps = fps or 30
+        total = len(paths)
+        jobs = ((path, 1, 1) for path in paths)
+
+    writer = SlipWriter(slip_path, *size, fps=fps, palette=colours)
+    try:
+        done = 0
+        for run in _import_results(jobs, workers, (size, colours, dither, writer.bpp)):
+            for pixels, payload, delta, repeat, advance in run:
+                writer.add_pixels(pixels, payload, delta)
+                # Held frames: the delta against the same pixels is next to free
+                for _ in range(repeat - 1):
+                    writer.add_pixels(pixels, payload)
+                done += advance
+            if progress:
+                progress(done, max(done, total))
+        if not writer.index:
+            raise ValueError(f"No frames found in {source}")
+        writer.close()
+        if progress:
+            # Frames dropped at the end, or a video shorter than estimated
+            progress(max(done, total), max(done, total))
+    except BaseException:
+        writer.abort()
+        raise
+    return len(writer.index)
 
-    def read(self, size):
-        # Generate random bytes (0–255) for 8-bit audio
-        return bytes(random.randint(0, 255) for _ in range(size))
 
 class SlipnoteStudio:
-    def __init__(self):
+    """
+    The editor. Constructing it sets everything up; run() enters the event
+    loop. With `headless` on, SDL's dummy video and audio drivers are used
+    and no images are loaded, so the editor can be driven from scripts
+    (see run_benchmarks) on machines without a display.
+    """
+    def __init__(self, headless=False, folder="slipnotes"):
         # Make sure there's a slipnotes folder
-        os.makedirs("slipnotes", exist_ok=True)
+        os.makedirs(folder, exist_ok=True)
 
+        self.headless = headless
+        if headless:
+            os.environ["SDL_VIDEODRIVER"] = "dummy"
+            os.environ["SDL_AUDIODRIVER"] = "dummy"
         pygame.init()
         pygame.mixer.init()
 
@@ -69,20 +3868,39 @@ class SlipnoteStudio:
         self.window_width, self.window_height = 400, 600
         self.screen = pygame.display.set_mode((self.window_width, self.window_height))
         pygame.display.set_caption("Slipnote Studio")
+        # Only queue the events the main loop handles. set_blocked(None) walks
+        # every SDL event type one call at a time (~18 ms); blocking just the
+        # known noisy ones is the same filter at a fraction of the cost.
+        handled = {QUIT, KEYDOWN, MOUSEBUTTONDOWN, MOUSEBUTTONUP, MOUSEMOTION,
+                   VIDEOEXPOSE, WINDOWEXPOSED}
+        pygame.event.set_blocked([v for k, v in vars(pygame.constants).items()
+                                  if k.isupper() and isinstance(v, int) and v not in handled
+                                  and v != NOEVENT
+                                  and pygame.event.event_name(v) not in ("Unknown", "UserEvent")])
+        pygame.event.set_allowed(list(handled))
 
         # Load icons/images
-        self.load_favicon(r"C:\Users\CCE\Downloads\16271246.png")
-        self.load_main_menu_image(r"C:\Users\CCE\Pictures\Capture.JPG")  # The green Slipnote Studio image
+        self.main_menu_image = None
+        if not headless:
+            self.load_favicon(os.path.join(ASSET_DIR, "favicon.png"))
+            self.load_main_menu_image(os.path.join(ASSET_DIR, "main_menu.png"))  # The green Slipnote Studio image
+
+        # Damage tracking: rectangles of the window that must be redrawn on
+        # the next tick. Nothing is drawn or pushed to the display while it
+        # is empty.
+        self.damage = [self.screen.get_rect()]
+        self.top_rect = pygame.Rect(0, 0, 400, 240)
 
         # Logging area
         self.log_messages = []
+        self.log_surfaces = None  # rendered log lines, rebuilt when a message arrives
         self.font = pygame.font.SysFont("Arial", 14)
         self.log_area_rect = pygame.Rect(0, 482, self.window_width, self.window_height - 482)
 
         # Add a custom logging handler to display logs in the window
-        log_handler = PygameLogHandler(self, capacity=10)
-        log_handler.setFormatter(logging.Formatter("%(levelname)s: %(message)s"))
-        logging.getLogger().addHandler(log_handler)
+        self.log_handler = PygameLogHandler(self, capacity=10)
+        self.log_handler.setFormatter(logging.Formatter("%(levelname)s: %(message)s"))
+        logging.getLogger().addHandler(self.log_handler)
 
         # State management: "main_menu", "create", "browse"
         self.state = "main_menu"
@@ -96,60 +3914,128 @@ class SlipnoteStudio:
         #  - frames for drawing
         #  - onion skin
         #  - audio recording, etc.
-        self.frames = [pygame.Surface((400, 240))]
+        self.frames = FrameStore((400, 240))
+        self.frames.append(self.frames.blank())
         self.current_frame = 0
         self.onion_skin = False
+        self.onion = OnionSkin(before=1, after=0)
+        self.active_background = None  # background layer drawn on (None: the current frame)
 
+        # What the top screen shows (the current frame over the background
+        # layers) and the layer Surface the tools draw on
         self.top_screen = self.frames[self.current_frame]
+        self.canvas = self.top_screen
+        # Display copy of the frame on screen, re-converted from palette
+        # indices only where the window is being redrawn
+        self.frame_view = pygame.Surface((400, 240))
         self.bottom_screen = pygame.Surface((400, 240))
-        self.top_screen.fill((255, 255, 255))
         self.bottom_screen.fill((255, 255, 255))
+        # Timeline at the bottom of the bottom screen; click to seek, drag to scrub
+        self.filmstrip = Filmstrip((0, 402, 400, 80), self.font)
+        self.scrub_part = None  # "thumbs" or "bar" while scrubbing
+        self.scrub_x = 0
 
         self.drawing = False
-        self.last_pos = None
         self.pen_color = (0, 0, 0)
         self.tool_mode = 'brush'
-        self.line_backup = None
+        self.brush_size = 2  # width of brush, eraser and line strokes
+        self.fill_tolerance = 32  # per channel, 0-255
+        self.fill_gap = 0  # gap closing of the bucket fill, in pixels
         self.line_start = None
+        self.line_end = None  # the line preview is drawn on screen until release
+        self.stroke = None  # Stroke being drawn with the brush
+        self.stroke_started = 0.0
+        self.stroke_segments = 0  # segments of self.stroke already on the frame
+        self.stroke_anchor = None  # stabilized pen position
+        self.pending_motion = []  # brush positions received since the last tick
+        self.stabilizer = 0.25  # 0: follow the pen exactly; towards 1: steadier, laggier
+        self.history = UndoHistory()
+
+        # Background jobs (saves, loads, exports, dialogs)
+        self.jobs = JobManager()
+        self.saving = None  # Job of the save in progress
 
         # For storing slipnotes in .slip files
-        self.slipnote_folder = "slipnotes"
+        self.slipnote_folder = folder
         self.selected_slip = None  # for editing
+        self.browse_index = BrowseIndex(self.slipnote_folder)
+        self.browse_scroll = 0  # first visible row of the thumbnail grid
+        self.browse_labels = OrderedDict()  # rendered filename labels
+        self.importing = set()  # note names imports are still writing
+
+        # Autosave: edits are journaled next to the note (an untitled note
+        # autosaves to slipnotes/.autosave.slip) and compacted into it.
+        self.note_path = None
+        self.autosave_path = os.path.join(self.slipnote_folder, ".autosave.slip")
+        self.journal = EditJournal(self.autosave_path)
+        self.history.on_change = self.journal_tiles
+        self.frames.on_palette = self.journal_palette
 
         # Audio attributes
         self.loaded_audio_path = None
         self.is_recording = False
         self.audio_thread = None
         self.audio_file = "recorded.wav"
+        self.recorder = None  # WavStreamWriter of the current take
+        # The note's own track is embedded in the .slip file; a new take or a
+        # loaded file replaces it on the next save (audio_version tells a save
+        # whether another take came along while it was running).
+        self.audio_rate = AUDIO_RATE
+        self.unsaved_audio = None
+        self.audio_version = 0
+        self.meter_rect = pygame.Rect(370, 250, 20, 100)
 
         # Microphone selection
         self.use_virtual_mic = not PYAUDIO_AVAILABLE
-        self.selected_device = 0
+        self.selected_device = None  # None: the system's default input
+        self.audio_devices = AudioDeviceManager()
+        if not headless and PYAUDIO_AVAILABLE:
+            self.audio_devices.start(self.selected_device)
+        self.record_requested = None  # perf_counter() of the last R press
+        self.record_latency = None  # seconds from that press to the first samples
+        self.virtual_mic_options = {"signal": "noise"}  # see VirtualMicrophone
 
-        # FPS
+        # FPS: self.fps is the note's playback rate; events and drawing run
+        # at display_fps regardless, and the PlaybackEngine steps the frames.
         self.fps = 30
+        self.display_fps = 60
         self.clock = pygame.time.Clock()
+        self.player = PlaybackEngine(self.frames, self.fps)
+
+        # Performance HUD (F3) and profiling (F9: cProfile, Shift+F9: sampling)
+        self.perf = PerfMonitor()
+        self.show_hud = False
+        self.hud_rect = pygame.Rect(190, 0, 210, 9 * self.font.get_linesize() + 8)
+        self.hud_surface = None
+        self.hud_refreshed = 0.0
+        self.hud_hook = None
 
         logging.info("Slipnote Studio started. Press 'F' to set FPS, or 'S' to select microphone.")
-        self.run()
+        self.recover_autosave()
 
     # -------------------------------------------------------------------------
     # LOAD IMAGES
     # -------------------------------------------------------------------------
     def load_favicon(self, path):
-        """Load favicon using Pillow and set it as the window icon."""
+        """Load favicon and set it as the window icon, if the file exists."""
+        if not os.path.exists(path):
+            logging.debug("No favicon at %s; using the default icon.", path)
+            return
         try:
-            im = Image.open(path).convert("RGBA")
-            icon_surface = pygame.image.fromstring(im.tobytes(), im.size, "RGBA")
-            pygame.display.set_icon(icon_surface)
+            pygame.display.set_icon(load_image(path))
         except Exception as e:
             logging.error("Could not load favicon. Using default icon. Error: %s", e)
 
     def load_main_menu_image(self, path):
-        """Load the main menu top-screen image (the green Slipnote Studio image)."""
+        """
+        Load the main menu top-screen image (the green Slipnote Studio image).
+        It is optional: without it the menu draws its own title screen.
+        """
+        if not os.path.exists(path):
+            logging.debug("No main menu image at %s; drawing the title screen.", path)
+            return
         try:
-            im = Image.open(path).convert("RGBA")
-            self.main_menu_image = pygame.image.fromstring(im.tobytes(), im.size, "RGBA")
+            self.main_menu_image = load_image(path)
         except Exception as e:
             logging.error("Could not load main menu image. Error: %s", e)
             self.main_menu_image = None
@@ -163,12 +4049,17 @@ class SlipnoteStudio:
             for event in pygame.event.get():
                 if event.type == QUIT:
                     running = False
-                    self.is_recording = False
                     break
 
                 elif event.type == KEYDOWN:
                     # Common keys for any state
-                    if event.key == K_f:
+                    if event.key == K_ESCAPE and self.jobs.active:
+                        self.jobs.cancel_all()
+                    elif event.key == K_F3:
+                        self.toggle_hud()
+                    elif event.key == K_F9:
+                        self.toggle_profile("sample" if event.mod & KMOD_SHIFT else "cprofile")
+                    elif event.key == K_f:
                         self.select_fps()
                     elif event.key == K_s:
                         self.select_microphone()
@@ -183,9 +4074,9 @@ class SlipnoteStudio:
                     if self.state == "main_menu":
                         self.handle_main_menu_click(event.pos)
                     elif self.state == "create":
-                        self.handle_create_mouse_down(event.pos)
+                        self.handle_create_mouse_down(event.pos, event.button)
                     elif self.state == "browse":
-                        self.handle_browse_mouse_down(event.pos)
+                        self.handle_browse_mouse_down(event.pos, event.button)
 
                 elif event.type == MOUSEBUTTONUP:
                     if self.state == "create":
@@ -195,29 +4086,170 @@ class SlipnoteStudio:
                     if self.state == "create":
                         self.handle_create_mouse_motion(event.pos)
 
-            # DRAW
-            self.screen.fill((200, 200, 200))
+                elif event.type in (VIDEOEXPOSE, WINDOWEXPOSED):
+                    self.invalidate()
+            self.flush_stroke_input()
+            if self.state == "create":
+                self.update_filmstrip()
+            self.perf.mark("events")
 
-            if self.state == "main_menu":
-                self.draw_main_menu()
-            elif self.state == "create":
-                self.draw_create()
-            elif self.state == "browse":
-                self.draw_browse()
+            if self.player.playing:
+                self.advance_playback()
+            if self.state == "browse":
+                self.update_browse_index()
+            if self.jobs.poll():
+                self.invalidate(self.log_area_rect)
+            self.update_autosave()
+            if self.show_hud:
+                self.update_hud()
+            self.perf.mark("update")
 
-            # Draw the log area
-            pygame.draw.rect(self.screen, (50, 50, 50), self.log_area_rect)
-            y_offset = self.log_area_rect.top + 5
-            for msg in self.log_messages:
-                text_surface = self.font.render(msg, True, (255, 255, 255))
-                self.screen.blit(text_surface, (5, y_offset))
-                y_offset += self.font.get_linesize()
+            # DRAW (only the damaged regions; idle ticks draw nothing)
+            if self.damage:
+                self.draw_damage()
+            self.frames.prefetch_step()
+            self.perf.mark("prefetch")
+            self.clock.tick(self.display_fps)
+            self.perf.mark("idle")
+            self.perf.end_tick()
 
-            pygame.display.flip()
-            self.clock.tick(self.fps)
+        self.close()
 
+    def close(self):
+        """Stop recording and playback, finish background jobs and shut pygame down."""
+        self.is_recording = False
+        if self.audio_thread is not None:
+            self.audio_thread.join()
+        self.player.stop()
+        self.audio_devices.close()
+        if self.perf.profile_mode is not None:
+            self.toggle_profile(self.perf.profile_mode)
+        logging.info("Waiting for background jobs to finish...")
+        self.jobs.wait_all()
+        self.journal.close()
+        logging.getLogger().removeHandler(self.log_handler)
         pygame.quit()
 
+    def invalidate(self, rect=None):
+        """Mark a window region (default: everything) for redraw on the next tick."""
+        self.damage.append(pygame.Rect(rect) if rect is not None else self.screen.get_rect())
+
+    def set_state(self, state):
+        """Switch between "main_menu", "create" and "browse"."""
+        self.state = state
+        self.invalidate()
+
+    def draw_damage(self):
+        """Redraw the damaged regions of the window and push only those to the display."""
+        damage, self.damage = self.damage, []
+        self.screen.set_clip(damage[0].unionall(damage[1:]))
+        self.screen.fill((200, 200, 200))
+
+        if self.state == "main_menu":
+            self.draw_main_menu()
+        elif self.state == "create":
+            self.draw_create()
+        elif self.state == "browse":
+            self.draw_browse()
+        self.perf.mark("draw")
+
+        if self.log_area_rect.collidelist(damage) != -1:
+            self.draw_log()
+        if self.hud_surface is not None and self.hud_rect.collidelist(damage) != -1:
+            self.screen.blit(self.hud_surface, self.hud_rect)
+        self.perf.mark("log")
+        self.screen.set_clip(None)
+        pygame.display.update(damage)
+        self.perf.mark("flip")
+
+    def draw_log(self):
+        """Draw the log area, rendering text only when the messages changed."""
+        if self.log_surfaces is None:
+            self.log_surfaces = [self.font.render(msg, True, (255, 255, 255))
+                                 for msg in list(self.log_messages)]
+        pygame.draw.rect(self.screen, (50, 50, 50), self.log_area_rect)
+        y_offset = self.log_area_rect.top + 5
+        for text_surface in self.log_surfaces:
+            self.screen.blit(text_surface, (5, y_offset))
+            y_offset += self.font.get_linesize()
+
+        # Progress of background jobs, bottom-right
+        y_offset = self.log_area_rect.bottom - 5
+        for job in reversed(self.jobs.shown):
+            percent = f" {100 * job.done // job.total}%" if job.total else "..."
+            text_surface = self.font.render(f"{job.name}{percent} (Esc cancels)", True, (255, 220, 120))
+            y_offset -= self.font.get_linesize()
+            pygame.draw.rect(self.screen, (50, 50, 50), text_surface.get_rect(topright=(395, y_offset)))
+            self.screen.blit(text_surface, text_surface.get_rect(topright=(395, y_offset)))
+
+    # -------------------------------------------------------------------------
+    # PERFORMANCE HUD / PROFILING
+    # -------------------------------------------------------------------------
+    def toggle_hud(self):
+        """Show or hide the performance overlay; slow frames are logged while it is shown."""
+        self.show_hud = not self.show_hud
+        if self.show_hud:
+            self.hud_hook = self.perf.add_hook(slow_tick_hook())
+            self.hud_refreshed = 0.0
+        else:
+            self.perf.remove_hook(self.hud_hook)
+            self.hud_surface = None
+        self.invalidate(self.hud_rect)
+
+    def update_hud(self, interval=0.25):
+        """Re-render the overlay a few times a second from the PerfMonitor and caches."""
+        now = time.perf_counter()
+        if now - self.hud_refreshed < interval:
+            return
+        self.hud_refreshed = now
+        averages = self.perf.averages()
+
+        def ms(phase):
+            return 1000 * averages.get(phase, 0.0)
+
+        hit_rate = self.frames.hit_rate
+        hits = "-" if hit_rate is None else f"{100 * hit_rate:.0f}%"
+        memory = memory_usage()
+        lines = [
+            f"FPS {self.perf.fps:.1f}   worst {1000 * self.perf.worst():.1f} ms",
+            f"events {ms('events'):.2f}  update {ms('update'):.2f} ms",
+            f"draw {ms('draw'):.2f}  log {ms('log'):.2f}  flip {ms('flip'):.2f} ms",
+            f"frame cache {hits} hit, {self.frames.cache_used / 1e6:.1f} MB",
+            f"frames {len(self.frames)}, {self.frames.unique_count} unique, "
+            f"{self.frames.background_count} bg",
+            "memory " + ("?" if memory is None else f"{memory / 1e6:.0f} MB"),
+        ]
+        if self.is_recording and self.recorder is not None:
+            recorder_queue = self.recorder.queue
+            lines.append(f"recorder queue {recorder_queue.qsize()}/{recorder_queue.maxsize} chunks")
+        else:
+            lines.append("recorder idle")
+        if self.player.playing:
+            lines.append(f"playback ring {len(self.player.ring)}/{self.player.ring_size}, "
+                         f"{self.player.dropped} dropped")
+        else:
+            lines.append("playback idle")
+        if self.perf.profile_mode is not None:
+            lines.append(f"profiling ({self.perf.profile_mode}), F9 stops")
+
+        self.hud_surface = pygame.Surface(self.hud_rect.size, SRCALPHA)
+        self.hud_surface.fill((0, 0, 0, 170))
+        for i, line in enumerate(lines):
+            self.hud_surface.blit(self.font.render(line, True, (255, 255, 120)),
+                                  (4, 4 + i * self.font.get_linesize()))
+        self.invalidate(self.hud_rect)
+
+    def toggle_profile(self, mode):
+        """Start a profile capture of the main loop, or stop the running one and write it out."""
+        if self.perf.profile_mode is not None:
+            logging.info("Profile written to %s", self.perf.stop_profile())
+        else:
+            ext = ".prof" if mode == "cprofile" else ".folded"
+            path = os.path.join(self.slipnote_folder, time.strftime("profile-%Y%m%d-%H%M%S") + ext)
+            self.perf.start_profile(path, mode)
+            logging.info("Profiling (%s); press F9 again to stop.", mode)
+        self.hud_refreshed = 0.0
+
     # -------------------------------------------------------------------------
     # STATE: MAIN MENU
     # -------------------------------------------------------------------------
@@ -253,37 +4285,71 @@ class SlipnoteStudio:
         """Check if user clicked 'Create Slipnote' or 'Browse Slipnotes'."""
         if self.btn_create_rect.collidepoint(pos):
             logging.info("Create Slipnote button clicked.")
-            self.state = "create"
+            self.set_state("create")
         elif self.btn_browse_rect.collidepoint(pos):
             logging.info("Browse Slipnotes button clicked.")
-            self.state = "browse"
+            self.browse_index.poll(force=True)
+            self.set_state("browse")
 
     # -------------------------------------------------------------------------
     # STATE: CREATE (drawing/editing slipnotes)
     # -------------------------------------------------------------------------
     def draw_create(self):
         """Draw the create slipnote interface (top screen is drawing, bottom is empty)."""
-        # Onion skin
-        if self.onion_skin and self.current_frame > 0:
-            prev_frame = self.frames[self.current_frame - 1].copy()
-            prev_frame.set_alpha(100)
-            self.screen.blit(prev_frame, (0, 0))
+        area = self.screen.get_clip().clip(self.top_rect)
+        if not self.player.playing:
+            self.top_screen = self.frames.composite(self.current_frame)
+        self.frame_view.blit(self.top_screen, area, area)
+        # Onion skin: cached ghost layer, with the live frame multiplied on top
+        if self.onion_skin and not self.player.playing:
+            self.screen.blit(self.onion.layer(self.frames, self.current_frame), (0, 0))
+            self.screen.blit(self.frame_view, area, area, special_flags=BLEND_RGB_MULT)
         else:
-            self.screen.blit(self.top_screen, (0, 0))
+            self.screen.blit(self.frame_view, area, area)
+        if self.line_start is not None and self.line_end is not None:
+            pygame.draw.line(self.screen, self.pen_color, self.line_start, self.line_end, self.brush_size)
 
         pygame.draw.line(self.screen, (0, 0, 0), (0, 240), (400, 240), 2)
         self.screen.blit(self.bottom_screen, (0, 242))
+        if self.filmstrip.rect.colliderect(self.screen.get_clip()):
+            self.filmstrip.draw(self.screen, self.frames, self.current_frame)
+        if self.is_recording and self.recorder is not None:
+            self.draw_level_meter()
+
+    def draw_level_meter(self):
+        """Recording level (RMS bar) and decaying peak marker."""
+        rect = self.meter_rect
+        pygame.draw.rect(self.screen, (40, 40, 40), rect)
+        level_h = int(rect.height * min(1.0, self.recorder.level))
+        pygame.draw.rect(self.screen, (0, 200, 0), (rect.left, rect.bottom - level_h, rect.width, level_h))
+        peak_y = rect.bottom - int(rect.height * min(1.0, self.recorder.peak_hold))
+        pygame.draw.line(self.screen, (255, 60, 60), (rect.left, peak_y), (rect.right - 1, peak_y), 2)
 
     def handle_create_keys(self, event):
         """Handle key presses in the create slipnote mode."""
-        if event.key == K_n:
+        if event.key == K_n and event.mod & KMOD_CTRL:
+            self.add_background()
+        elif event.key == K_x and event.mod & KMOD_CTRL:
+            self.delete_background()
+        elif event.key == K_TAB:
+            self.cycle_layer()
+        elif event.key == K_n:
             self.add_frame()
+        elif event.key == K_d:
+            self.duplicate_frame()
+        elif event.key in (K_x, K_DELETE):
+            self.delete_frame()
+        elif event.key == K_LEFT and event.mod & KMOD_SHIFT:
+            self.move_frame(-1)
+        elif event.key == K_RIGHT and event.mod & KMOD_SHIFT:
+            self.move_frame(1)
         elif event.key == K_LEFT:
             self.previous_frame()
         elif event.key == K_RIGHT:
             self.next_frame()
         elif event.key == K_o:
             self.onion_skin = not self.onion_skin
+            self.invalidate(self.top_rect)
         elif event.key == K_c:
             self.clear_current_frame()
         elif event.key == K_p:
@@ -294,6 +4360,28 @@ class SlipnoteStudio:
         elif event.key == K_l:
             self.tool_mode = 'line'
             logging.info("Tool mode set to Line.")
+        elif event.key == K_e:
+            self.tool_mode = 'eraser'
+            logging.info("Tool mode set to Eraser.")
+        elif event.key == K_g and event.mod & KMOD_SHIFT:
+            steps = (0, 2, 4, 8)
+            self.fill_gap = steps[(steps.index(self.fill_gap) + 1) % len(steps)] if self.fill_gap in steps else 0
+            logging.info("Fill gap closing: %d px.", self.fill_gap)
+        elif event.key == K_g and event.mod & KMOD_CTRL:
+            steps = (0, 32, 64, 128)
+            self.fill_tolerance = (steps[(steps.index(self.fill_tolerance) + 1) % len(steps)]
+                                   if self.fill_tolerance in steps else 0)
+            logging.info("Fill tolerance: %d.", self.fill_tolerance)
+        elif event.key == K_g:
+            self.tool_mode = 'fill'
+            logging.info("Tool mode set to Fill.")
+        elif event.key in (K_LEFTBRACKET, K_RIGHTBRACKET):
+            self.set_brush_size(self.brush_size + (1 if event.key == K_RIGHTBRACKET else -1))
+        elif event.key == K_t:
+            # Cycle the stabilizer strength
+            steps = (0.0, 0.25, 0.5, 0.75)
+            self.set_stabilizer(steps[(steps.index(self.stabilizer) + 1) % len(steps)]
+                                if self.stabilizer in steps else 0.0)
         elif event.key == K_r:
             self.toggle_recording()
         elif event.key == K_k:
@@ -302,105 +4390,525 @@ class SlipnoteStudio:
             self.load_audio()
         elif event.key == K_m:
             self.play_loaded_audio()
+        elif event.key == K_z and event.mod & KMOD_CTRL:
+            if event.mod & KMOD_SHIFT:
+                self.redo()
+            else:
+                self.undo()
+        elif event.key == K_y and event.mod & KMOD_CTRL:
+            self.redo()
         elif event.key == K_s:
             # Overload 'S' if you want to save slip, or you can choose another key
             self.save_slipnote_dialog()
 
-    def handle_create_mouse_down(self, pos):
-        """Handle mouse button down in create mode."""
-        if pos[1] <= 240:
-            if self.tool_mode == 'brush':
+    def handle_create_mouse_down(self, pos, button=1):
+        """Handle mouse button down in create mode; the wheel scrolls the filmstrip."""
+        if button in (4, 5):
+            if self.filmstrip.scroll(-2 if button == 4 else 2, len(self.frames)):
+                self.invalidate(self.filmstrip.rect)
+        elif self.filmstrip.part_at(pos) is not None and not self.drawing:
+            if self.player.playing:
+                self.play_animation()
+            self.scrub_part = self.filmstrip.part_at(pos)
+            self.scrub_x = pos[0]
+            self.update_filmstrip()
+        elif pos[1] <= 240:
+            if self.tool_mode in ('brush', 'eraser'):
+                colour = self.pen_color if self.tool_mode == 'brush' else (255, 255, 255)
+                self.frames.ensure_colour(colour)
+                index = self.layer_index()
+                self.canvas = self.frames.edit(index)
+                self.history.begin_stroke(index, self.canvas, self.frames.strokes(index))
                 self.drawing = True
-                self.last_pos = pos
+                self.stroke = Stroke(self.tool_mode, colour, self.brush_size, smooth=True)
+                self.stroke.add_point(pos, 0)
+                self.stroke_started = time.perf_counter()
+                self.stroke_segments = 0
+                self.stroke_anchor = pos
+                self.pending_motion = []
             elif self.tool_mode == 'line':
                 self.line_start = pos
-                self.line_backup = self.top_screen.copy()
+                self.line_end = pos
+                self.stroke_started = time.perf_counter()
+            elif self.tool_mode == 'fill':
+                self.fill_at(pos)
 
     def handle_create_mouse_up(self, pos):
         """Handle mouse button up in create mode."""
-        if self.tool_mode == 'brush':
+        if self.scrub_part is not None:
+            self.scrub_part = None
+            self.goto_frame(self.current_frame)
+        elif self.tool_mode in ('brush', 'eraser'):
+            if self.drawing:
+                self.flush_stroke_input(final=True)
+                self.frames.add_stroke(self.layer_index(), self.stroke)
+                self.history.end_stroke(self.frames.strokes(self.layer_index()))
             self.drawing = False
+            self.stroke = None
         elif self.tool_mode == 'line' and self.line_start is not None:
-            pygame.draw.line(self.top_screen, self.pen_color, self.line_start, pos, 2)
+            self.frames.ensure_colour(self.pen_color)
+            index = self.layer_index()
+            self.canvas = self.frames.edit(index)
+            self.history.begin_stroke(index, self.canvas, self.frames.strokes(index))
+            self.history.before_draw(segment_rect(self.line_start, pos, self.brush_size))
+            line_rect = pygame.draw.line(self.canvas, self.pen_color, self.line_start, pos,
+                                         self.brush_size)
+            stroke = Stroke("line", self.pen_color, self.brush_size)
+            stroke.add_point(self.line_start, 0)
+            stroke.add_point(pos, 1000 * (time.perf_counter() - self.stroke_started))
+            self.frames.add_stroke(index, stroke)
+            self.history.end_stroke(self.frames.strokes(index))
+            self.invalidate(line_rect.union(self.line_preview_rect()))
             self.line_start = None
-            self.line_backup = None
+            self.line_end = None
 
     def handle_create_mouse_motion(self, pos):
         """Handle mouse motion in create mode."""
-        if self.tool_mode == 'brush' and self.drawing:
+        if self.scrub_part is not None:
+            self.scrub_x = pos[0]  # applied once per tick by update_filmstrip
+        elif self.tool_mode in ('brush', 'eraser') and self.drawing:
             if pos[1] <= 240:
-                pygame.draw.line(self.top_screen, self.pen_color, self.last_pos, pos, 2)
-                self.last_pos = pos
+                self.pending_motion.append(pos)
         elif self.tool_mode == 'line' and self.line_start is not None:
-            self.top_screen.blit(self.line_backup, (0, 0))
-            if pos[1] <= 240:
-                pygame.draw.line(self.top_screen, self.pen_color, self.line_start, pos, 2)
+            old_rect = self.line_preview_rect()
+            self.line_end = pos if pos[1] <= 240 else None
+            self.invalidate(old_rect.union(self.line_preview_rect()))
+
+    def flush_stroke_input(self, final=False):
+        """
+        Add the brush motion received since the last tick to the stroke and
+        draw everything that became final in a single pygame.draw.lines call.
+        Positions are pulled towards the previous one by the stabilizer and
+        ones that round to the same pixel are dropped; their timestamps are
+        spread over the time since the last point. `final` also draws the
+        last segment, which otherwise waits for the next point.
+        """
+        stroke = self.stroke
+        if stroke is None:
+            return
+        if self.pending_motion:
+            positions, self.pending_motion = self.pending_motion, []
+            last_t = stroke.points[-1][2]
+            now = 1000 * (time.perf_counter() - self.stroke_started)
+            follow = 1.0 - self.stabilizer
+            ax, ay = self.stroke_anchor
+            for i, (x, y) in enumerate(positions, 1):
+                ax += (x - ax) * follow
+                ay += (y - ay) * follow
+                point = (round(ax), round(ay))
+                if point != stroke.points[-1][:2]:
+                    stroke.add_point(point, last_t + (now - last_t) * i / len(positions))
+            self.stroke_anchor = (ax, ay)
+        end = len(stroke.points) - 1 if final else stroke.complete_segments
+        line = stroke.polyline(start=self.stroke_segments, end=end)
+        if len(line) > 1:
+            rect = polyline_rect(line, stroke.width)
+            self.history.before_draw(rect)
+            pygame.draw.lines(self.canvas, stroke.colour, False, line, stroke.width)
+            self.frames.touch(self.layer_index(), rect)
+            self.invalidate(rect)
+            self.stroke_segments = end
+
+    def update_filmstrip(self):
+        """
+        Per-tick upkeep of the filmstrip: show the frame under the scrubbing
+        pointer, and make thumbnails for the visible frames (not while a
+        stroke is being drawn).
+        """
+        if self.scrub_part is not None:
+            frame = self.filmstrip.scrub(self.scrub_x, self.scrub_part, len(self.frames))
+            if frame != self.current_frame:
+                self.goto_frame(frame)
+        if not self.drawing and self.filmstrip.update(self.frames, self.jobs):
+            self.invalidate(self.filmstrip.rect)
+
+    def fill_at(self, pos):
+        """Bucket fill the area around `pos` with the pen colour, as one undoable stroke."""
+        index = self.layer_index()
+        if not self.top_rect.collidepoint(pos) or self.frames[index].get_at(pos)[:3] == self.pen_color:
+            return
+        self.frames.ensure_colour(self.pen_color)
+        self.canvas = self.frames.edit(index)
+        region, rect = fill_region(self.canvas, pos, self.fill_tolerance, self.fill_gap)
+        self.history.begin_stroke(index, self.canvas, self.frames.strokes(index))
+        self.history.before_draw(rect)
+        paint_region(self.canvas, region, self.pen_color)
+        stroke = Stroke("fill", self.pen_color, self.fill_gap)
+        stroke.add_point(pos, 0, self.fill_tolerance)
+        self.frames.add_stroke(index, stroke)
+        self.history.end_stroke(self.frames.strokes(index))
+        self.invalidate(rect)
+
+    def set_brush_size(self, size):
+        self.brush_size = max(1, min(size, 32))
+        logging.info("Brush size: %d px.", self.brush_size)
+
+    def set_stabilizer(self, amount):
+        self.stabilizer = amount
+        logging.info("Stroke stabilizer: %d%%.", round(100 * amount))
+
+    def line_preview_rect(self):
+        """Screen area covered by the line tool's preview."""
+        if self.line_end is None:
+            return pygame.Rect(self.line_start, (0, 0))
+        return segment_rect(self.line_start, self.line_end, self.brush_size)
+
+    def undo(self):
+        self.show_history_change(self.history.undo(self.frames), "Undo")
+
+    def redo(self):
+        self.show_history_change(self.history.redo(self.frames), "Redo")
+
+    def show_history_change(self, change, action):
+        """Jump to the frame an undo/redo changed and redraw the changed area."""
+        if change is None:
+            logging.info("Nothing to %s.", action.lower())
+            return
+        frame, rect = change
+        if frame < 0:
+            self.active_background = -1 - frame
+        else:
+            self.active_background = None
+            if frame != self.current_frame:
+                self.goto_frame(frame)
+        self.invalidate(rect)
+
+    # Frame management
+    def goto_frame(self, index):
+        """Make `index` the current frame and start decoding its neighbours."""
+        self.current_frame = max(0, min(index, len(self.frames) - 1))
+        self.top_screen = self.frames.composite(self.current_frame)
+        self.frames.prefetch(self.current_frame)
+        self.invalidate(self.top_rect)
+        # The thumbnails stay put under a pointer scrubbing them
+        if self.scrub_part != "thumbs":
+            self.filmstrip.follow(self.current_frame, len(self.frames))
+        self.invalidate(self.filmstrip.rect)
+
+    def add_frame(self):
+        """Insert a blank frame after the current one and switch to it."""
+        self.frames.insert(self.current_frame + 1, self.frames.blank())
+        self.history.frame_inserted(self.current_frame + 1)
+        self.journal.record_insert(self.current_frame + 1)
+        self.goto_frame(self.current_frame + 1)
+        logging.info("Added frame %d/%d.", self.current_frame + 1, len(self.frames))
+
+    def duplicate_frame(self):
+        """Insert a copy of the current frame after it and switch to the copy."""
+        if self.drawing:
+            return
+        self.frames.duplicate(self.current_frame)
+        self.history.frame_inserted(self.current_frame + 1)
+        self.journal.record_duplicate(self.current_frame)
+        self.goto_frame(self.current_frame + 1)
+        logging.info("Duplicated frame %d/%d.", self.current_frame + 1, len(self.frames))
+
+    def delete_frame(self):
+        """Delete the current frame; the last frame left is cleared instead."""
+        if self.drawing:
+            return
+        if len(self.frames) == 1:
+            self.clear_current_frame()
+            return
+        self.frames.remove(self.current_frame)
+        self.history.frame_removed(self.current_frame)
+        self.journal.record_delete(self.current_frame)
+        self.goto_frame(self.current_frame)
+        logging.info("Deleted frame; now at %d/%d.", self.current_frame + 1, len(self.frames))
+
+    def move_frame(self, offset):
+        """Move the current frame `offset` places along the timeline, keeping it current."""
+        target = max(0, min(self.current_frame + offset, len(self.frames) - 1))
+        if self.drawing or target == self.current_frame:
+            return
+        self.frames.move(self.current_frame, target)
+        self.history.frame_moved(self.current_frame, target)
+        self.journal.record_move(self.current_frame, target)
+        self.goto_frame(target)
+
+    def previous_frame(self):
+        if self.current_frame > 0:
+            self.goto_frame(self.current_frame - 1)
+
+    def next_frame(self):
+        if self.current_frame < len(self.frames) - 1:
+            self.goto_frame(self.current_frame + 1)
+
+    def clear_current_frame(self):
+        """Clear the layer being drawn on: the current frame or the active background."""
+        index = self.layer_index()
+        self.canvas = self.frames.edit(index)
+        self.history.begin_stroke(index, self.canvas, self.frames.strokes(index))
+        self.history.before_draw(self.canvas.get_rect())
+        self.canvas.fill((255, 255, 255))
+        self.frames.set_strokes(index, ())
+        self.history.end_stroke(())
+        self.invalidate(self.top_rect)
+
+    # Background layers
+    def layer_index(self):
+        """FrameStore index the tools draw on: the current frame or a background layer (negative)."""
+        if self.active_background is None:
+            return self.current_frame
+        return -1 - self.active_background
+
+    def cycle_layer(self):
+        """Switch drawing from the frame to each background layer in turn, and back."""
+        if self.drawing:
+            return
+        if self.active_background is None:
+            self.active_background = 0 if self.frames.background_count else None
+        elif self.active_background + 1 < self.frames.background_count:
+            self.active_background += 1
+        else:
+            self.active_background = None
+        if self.active_background is None:
+            logging.info("Drawing on frame %d.", self.current_frame + 1)
+        else:
+            logging.info("Drawing on background %d/%d (shared by all frames).",
+                         self.active_background + 1, self.frames.background_count)
+
+    def add_background(self):
+        """Add a background layer, shared by all frames, on top of the others and draw on it."""
+        if self.drawing:
+            return
+        index = self.frames.add_background()
+        self.journal.record_add_background(index)
+        self.active_background = -1 - index
+        self.invalidate(self.top_rect)
+        logging.info("Added background %d; Tab switches layers.", self.active_background + 1)
+
+    def delete_background(self):
+        """Delete the background layer being drawn on and go back to the frame."""
+        if self.drawing or self.active_background is None:
+            return
+        index = self.layer_index()
+        self.frames.remove_background(index)
+        self.history.background_removed(index)
+        self.journal.record_delete_background(index)
+        logging.info("Deleted background %d.", self.active_background + 1)
+        self.active_background = None
+        self.invalidate(self.top_rect)
+
+    # Playback
+    def play_animation(self):
+        """
+        Start or stop playback at the note's FPS. The note's audio plays
+        along and acts as the playback clock.
+        """
+        if self.player.playing:
+            self.player.stop()
+            logging.info("Playback stopped: %d shown, %d dropped, %d late.",
+                         self.player.shown, self.player.dropped, self.player.late)
+            self.goto_frame(self.current_frame)
+            return
+        audio, first_frame = self.playback_audio()
+        self.player.start(first_frame, audio)
+        self.goto_frame(self.player.playhead)
+        logging.info("Playing animation at %d FPS%s.", self.fps, " with audio" if self.player.with_audio else "")
+
+    def playback_audio(self):
+        """
+        Returns (audio, first frame) for playback. Playback starts at the
+        current frame with just that part of the note's embedded track
+        decoded (as an in-memory WAV). A take or loaded file that is not
+        saved yet plays from the start, together with frame 0.
+        """
+        if self.unsaved_audio and not self.is_recording:
+            return self.unsaved_audio, 0
+        reader = self.frames.reader
+        track = reader.read_audio(self.current_frame) if reader is not None else None
+        if track is None:
+            return None, self.current_frame
+        return io.BytesIO(pcm_to_wav(*track)), self.current_frame
+
+    def advance_playback(self):
+        """Show the frame the playback clock says is due, if it changed."""
+        surface = self.player.update()
+        if surface is not None:
+            self.current_frame = self.player.playhead
+            self.top_screen = surface
+            self.invalidate(self.top_rect)
+            self.filmstrip.follow(self.current_frame, len(self.frames))
+            self.invalidate(self.filmstrip.rect)
 
     # Saving/loading .slip
     def save_slipnote_dialog(self):
         """Prompt the user for a .slip filename, then save the current frames."""
-        root = tk.Tk()
-        root.withdraw()
-        file_path = filedialog.asksaveasfilename(
-            defaultextension=".slip",
-            filetypes=[("Slipnote files", "*.slip")],
-            initialdir=self.slipnote_folder,
-            title="Save Slipnote"
-        )
-        root.destroy()
-        if file_path:
-            self.save_slipnote(file_path)
-            logging.info(f"Slipnote saved to {file_path}")
+        def ask():
+            from tkinter import filedialog
+            return filedialog.asksaveasfilename(
+                defaultextension=".slip",
+                filetypes=[("Slipnote files", "*.slip")],
+                initialdir=self.slipnote_folder,
+                title="Save Slipnote"
+            )
+
+        def apply(file_path):
+            if file_path:
+                self.save_slipnote(file_path)
+            else:
+                logging.info("Save cancelled.")
+
+        self.show_dialog("Save dialog", ask, apply)
+
+    def save_slipnote(self, file_path, autosave=False):
+        """
+        Save the note to `file_path` in the background (see write_snapshot).
+        The frames are snapshotted copy-on-write, so drawing can go on while
+        the file is written; when it is done the store is re-backed by the
+        new file, which unpins every frame not edited in the meantime, and
+        the journal records the save covered are dropped. A new audio take
+        is compressed into the note by the same job.
+        """
+        if self.saving is not None:
+            if not autosave:
+                logging.info("A save is already in progress.")
+            return
+        snapshot = self.frames.snapshot({self.layer_index()} if self.drawing else ())
+        journal = self.journal
+        journal_offset = journal.size
+        audio_path = None if self.is_recording else self.unsaved_audio
+        audio_version = self.audio_version
+
+        def write(job):
+            audio = encode_audio_file(audio_path, self.audio_rate, self.fps) if audio_path else None
+            return write_snapshot(snapshot, file_path, self.fps, job.report, audio)
+
+        def done(writer):
+            self.saving = None
+            if audio_path and self.audio_version == audio_version:
+                self.unsaved_audio = None
+            with self.frames.lock:
+                # Let go of the old mapping before the file can be replaced
+                self.frames.release()
+                writer.publish()
+                self.frames.adopt(snapshot, SlipReader(file_path))
+            self.goto_frame(self.current_frame)
+            if journal is self.journal:
+                journal.compacted(journal_offset)
+                if journal.base_path != file_path:
+                    # Saved under a new name: edits made during the save
+                    # move to a journal next to the new file.
+                    self.journal = EditJournal(file_path)
+                    if os.path.exists(journal.path):
+                        os.replace(journal.path, self.journal.path)
+                    if journal.base_path == self.autosave_path and os.path.exists(self.autosave_path):
+                        os.remove(self.autosave_path)
+            self.note_path = file_path
+            if autosave:
+                logging.info(f"Autosaved to {file_path}")
+            else:
+                logging.info(f"Slipnote saved to {file_path}")
+
+        def failed(error):
+            self.saving = None
+            self.frames.discard(snapshot)
+
+        name = f"{'Autosaving' if autosave else 'Saving'} {os.path.basename(file_path)}"
+        self.saving = self.jobs.submit(name, write, on_done=done, on_error=failed)
+
+    def finish_save(self):
+        """
+        Block until the save in progress, if any, is written and applied.
+        Its done() re-backs the store with the saved file, so it must run
+        before the store is handed another note, and the store's reader,
+        which the save reads from, must not be closed under it.
+        """
+        if self.saving is not None:
+            self.jobs.wait(self.saving)
+
+    # Autosave
+    def journal_tiles(self, frame, tiles, version, strokes, previous):
+        """UndoHistory hook: every tile and stroke change goes to the journal."""
+        self.journal.record_tiles(frame, tiles, version, strokes, previous)
+
+    def journal_palette(self, palette):
+        """FrameStore hook: palette growth goes to the journal before the tiles that use it."""
+        self.journal.record_palette(palette)
+
+    def update_autosave(self):
+        """Per-tick autosave upkeep: fsync the journal and compact it when due."""
+        if self.journal.size:
+            self.journal.sync()
+            if self.journal.due() and self.saving is None and not self.player.playing:
+                self.save_slipnote(self.journal.base_path, autosave=True)
+
+    def recover_autosave(self):
+        """
+        On startup, reopen the most recent note that has an unsaved journal,
+        or else the untitled note's autosave. A compacted autosave has no
+        journal left, but it is only removed once the note is saved under a
+        name (see save_slipnote).
+        """
+        journals = [os.path.join(self.slipnote_folder, f) for f in os.listdir(self.slipnote_folder)
+                    if f.endswith(".slip.journal")]
+        journals = [j for j in journals if os.path.getsize(j) > len(EditJournal.MAGIC)]
+        if not journals:
+            if os.path.exists(self.autosave_path):
+                logging.info("Reopening the untitled note from its autosave")
+                self.load_slipnote(self.autosave_path)
+                self.set_state("create")
+            return
+        latest = max(journals, key=os.path.getmtime)
+        base_path = latest[:-len(".journal")]
+        logging.info("Recovering unsaved edits from %s", os.path.basename(latest))
+        if os.path.exists(base_path):
+            self.load_slipnote(base_path)
         else:
-            logging.info("Save cancelled.")
-
-    def save_slipnote(self, file_path):
-        """
-        Simple approach: store each frame as raw pixels or compressed string.
-        For demonstration, we’ll just store the number of frames and the color of each pixel.
-        This is not a real robust format—just an example.
-        """
-        import pickle
-        # Convert frames to raw data
-        frame_data = []
-        for frame in self.frames:
-            # Get raw pixel data
-            pixels = pygame.image.tostring(frame, "RGBA")
-            frame_data.append(pixels)
-        slip_info = {
-            "num_frames": len(self.frames),
-            "width": 400,
-            "height": 240,
-            "frames_rgba": frame_data,
-        }
-        with open(file_path, "wb") as f:
-            pickle.dump(slip_info, f)
+            self.open_journal(base_path)
+        self.set_state("create")
+
+    def open_journal(self, base_path):
+        """Switch journaling to `base_path` and replay any edits left in it."""
+        self.journal.close()
+        self.journal = EditJournal(base_path)
+        replayed = self.journal.replay(self.frames)
+        if replayed:
+            logging.info("Replayed %d journaled edits.", replayed)
+            self.goto_frame(self.current_frame)
 
     # -------------------------------------------------------------------------
     # STATE: BROWSE (view existing .slip files, click to edit/convert)
     # -------------------------------------------------------------------------
+    # Thumbnail grid geometry (top screen)
+    BROWSE_COLS = 4
+    BROWSE_ROWS = 3
+    BROWSE_CELL = (100, 80)
+
     def draw_browse(self):
         """
-        Display a simple list of .slip files in self.slipnote_folder on the top screen.
+        Display the .slip files in self.slipnote_folder as a scrollable grid
+        of first-frame thumbnails. Only the visible rows are drawn.
         If the user has selected one, show options to edit or convert (mp4/gif).
         """
-        # We'll just fill the top screen with a white background and list the files
-        top_area = pygame.Surface((400, 240))
-        top_area.fill((255, 255, 255))
-
-        slip_files = self.get_slip_files()
-        y_offset = 10
-        for slip in slip_files:
-            label = self.font.render(slip, True, (0, 0, 0))
-            top_area.blit(label, (10, y_offset))
-            y_offset += 20
-
-        self.screen.blit(top_area, (0, 0))
+        pygame.draw.rect(self.screen, (255, 255, 255), self.top_rect)
+        entries = self.browse_index.entries
+        first = self.browse_scroll * self.BROWSE_COLS
+        visible = entries[first:first + self.BROWSE_COLS * self.BROWSE_ROWS]
+        for i, name in enumerate(visible):
+            cell = self.browse_cell_rect(i)
+            if name == self.selected_slip:
+                pygame.draw.rect(self.screen, (120, 200, 120), cell)
+            thumb_pos = (cell.x + 6, cell.y + 4)
+            thumb = self.browse_index.thumbnail(name)
+            if thumb is not None:
+                self.screen.blit(thumb, thumb_pos)
+            else:
+                pygame.draw.rect(self.screen, (220, 220, 220), (thumb_pos, BrowseIndex.THUMB_SIZE))
+            pygame.draw.rect(self.screen, (0, 0, 0), (thumb_pos, BrowseIndex.THUMB_SIZE), 1)
+            self.screen.blit(self.browse_label(name), (cell.x + 6, cell.y + 59))
+        if not entries:
+            self.screen.blit(self.font.render("No slipnotes yet. Press I to import one.", True, (0, 0, 0)), (10, 10))
         pygame.draw.line(self.screen, (0, 0, 0), (0, 240), (400, 240), 2)
 
         # Bottom screen: if user selected a slip, show "Edit" or "Convert"
         self.screen.blit(self.bottom_screen, (0, 242))
         if self.selected_slip:
+            info = self.browse_index.info(self.selected_slip)
+            if info is not None and info[0] >= 0:
+                details = f"{self.selected_slip}: {info[0]} frames @ {info[1]} FPS"
+                self.screen.blit(self.font.render(details, True, (0, 0, 0)), (10, 252))
             # Show two rectangles for Edit and Convert
             edit_rect = pygame.Rect(50, 242 + 80, 100, 40)
             conv_rect = pygame.Rect(250, 242 + 80, 100, 40)
@@ -417,26 +4925,70 @@ class SlipnoteStudio:
             cly = conv_rect.centery - conv_label.get_height() // 2
             self.screen.blit(conv_label, (clx, cly))
 
+    def browse_cell_rect(self, slot):
+        """Screen rectangle of the `slot`-th visible grid cell."""
+        w, h = self.BROWSE_CELL
+        return pygame.Rect((slot % self.BROWSE_COLS) * w, (slot // self.BROWSE_COLS) * h, w, h)
+
+    def browse_label(self, name):
+        """Rendered (and cached) filename label, clipped to the cell width."""
+        label = self.browse_labels.get(name)
+        if label is None:
+            text = os.path.splitext(name)[0]
+            while len(text) > 1 and self.font.size(text)[0] > self.BROWSE_CELL[0] - 8:
+                text = text[:-1]
+            label = self.font.render(text, True, (0, 0, 0))
+            self.browse_labels[name] = label
+            while len(self.browse_labels) > 4 * self.BROWSE_COLS * self.BROWSE_ROWS:
+                self.browse_labels.popitem(last=False)
+        return label
+
+    def scroll_browse(self, rows):
+        """Scroll the grid by whole rows, clamped to the listing."""
+        total_rows = -(-len(self.browse_index.entries) // self.BROWSE_COLS)
+        new_scroll = max(0, min(self.browse_scroll + rows, total_rows - self.BROWSE_ROWS))
+        if new_scroll != self.browse_scroll:
+            self.browse_scroll = new_scroll
+            self.invalidate(self.top_rect)
+
+    def update_browse_index(self):
+        """Per-tick upkeep of the browse index while Browse mode is shown."""
+        changed = self.browse_index.poll()
+        done = self.browse_index.build_step()
+        if changed or done:
+            self.scroll_browse(0)
+            self.invalidate()
+
     def handle_browse_keys(self, event):
-        """Handle key presses in the browse section (none for now)."""
-        pass
+        """Scroll the grid with the arrow and page keys; I imports an animation."""
+        if event.key == K_i:
+            self.import_animation_dialog()
+        elif event.key == K_UP:
+            self.scroll_browse(-1)
+        elif event.key == K_DOWN:
+            self.scroll_browse(1)
+        elif event.key == K_PAGEUP:
+            self.scroll_browse(-self.BROWSE_ROWS)
+        elif event.key == K_PAGEDOWN:
+            self.scroll_browse(self.BROWSE_ROWS)
 
-    def handle_browse_mouse_down(self, pos):
+    def handle_browse_mouse_down(self, pos, button=1):
         """
-        If user clicks on a slip file in the top screen, select it.
+        If user clicks on a slip thumbnail in the top screen, select it.
         If user clicks 'Edit' or 'Convert' on bottom screen, do the action.
+        The mouse wheel scrolls the grid.
         """
-        if pos[1] <= 240:
-            # top screen: check if user clicked on a slip file label
-            slip_files = self.get_slip_files()
-            y_offset = 10
-            for slip in slip_files:
-                label_rect = pygame.Rect(10, y_offset, 380, 20)
-                if label_rect.collidepoint(pos):
-                    self.selected_slip = slip
-                    logging.info(f"Selected slip: {slip}")
-                    break
-                y_offset += 20
+        if button in (4, 5):
+            self.scroll_browse(-1 if button == 4 else 1)
+        elif pos[1] <= 240:
+            # top screen: check if user clicked on a thumbnail
+            w, h = self.BROWSE_CELL
+            slot = (pos[1] // h) * self.BROWSE_COLS + pos[0] // w
+            index = self.browse_scroll * self.BROWSE_COLS + slot
+            if slot < self.BROWSE_COLS * self.BROWSE_ROWS and index < len(self.browse_index.entries):
+                self.selected_slip = self.browse_index.entries[index]
+                self.invalidate()
+                logging.info(f"Selected slip: {self.selected_slip}")
         else:
             # bottom screen: check if user clicked Edit or Convert
             if self.selected_slip:
@@ -445,63 +4997,139 @@ class SlipnoteStudio:
                 if edit_rect.collidepoint(pos):
                     logging.info(f"Editing slip: {self.selected_slip}")
                     self.load_slipnote(os.path.join(self.slipnote_folder, self.selected_slip))
-                    self.state = "create"
+                    self.set_state("create")
                 elif conv_rect.collidepoint(pos):
                     logging.info(f"Converting slip to MP4/GIF: {self.selected_slip}")
                     self.convert_slipnote(self.selected_slip)
 
-    def get_slip_files(self):
-        """Return a list of .slip files in the slipnotes folder."""
-        files = []
-        for f in os.listdir(self.slipnote_folder):
-            if f.lower().endswith(".slip"):
-                files.append(f)
-        return files
+    def import_animation_dialog(self):
+        """Prompt for a GIF, video or image sequence to import (see import_animation)."""
+        def ask():
+            from tkinter import filedialog
+            return filedialog.askopenfilename(
+                filetypes=[("Animations", " ".join("*" + ext for ext in (".gif",) + VIDEO_EXTENSIONS)),
+                           ("Image sequences (any frame)", " ".join("*" + ext for ext in IMAGE_EXTENSIONS))],
+                title="Import into Slipnotes"
+            )
+
+        def apply(file_path):
+            if file_path:
+                self.import_animation(file_path)
+            else:
+                logging.info("Import cancelled.")
+
+        self.show_dialog("Import dialog", ask, apply)
+
+    def import_animation(self, source):
+        """
+        Import `source` (see import_frames) as a new note in the slipnotes
+        folder, in the background, and select it when it is done. A still
+        image stands for every image with its extension in its folder.
+        """
+        label = os.path.basename(source)
+        base, ext = os.path.splitext(label)
+        if ext.lower() in IMAGE_EXTENSIONS:
+            folder = os.path.dirname(source)
+            base = os.path.basename(os.path.abspath(folder))
+            label = f"{base}/*{ext}"
+            source = os.path.join(glob.escape(folder), "*" + ext)
+        name = base + ".slip"
+        number = 1
+        while name in self.importing or os.path.exists(os.path.join(self.slipnote_folder, name)):
+            number += 1
+            name = f"{base}-{number}.slip"
+        target = os.path.join(self.slipnote_folder, name)
+        self.importing.add(name)
+
+        def run(job):
+            return import_frames(source, target, progress=job.report)
+
+        def done(count):
+            self.importing.discard(name)
+            logging.info("Imported %s as %s (%d frames).", label, name, count)
+            self.browse_index.poll(force=True)
+            self.selected_slip = name
+            self.invalidate()
+
+        self.jobs.submit(f"Importing {label}", run, on_done=done,
+                         on_error=lambda error: self.importing.discard(name))
 
     def load_slipnote(self, file_path):
         """
-        Load frames from a .slip file (our simple pickle format).
-        Replace current frames with loaded data.
+        Open a .slip file as the current note, in the background. Containers
+        are only indexed; frames are decoded by the FrameStore when they are
+        shown. Legacy pickles are migrated in memory; saving writes them
+        back as containers. A save in progress is finished first, both before the
+        file is read and before the store is replaced (see finish_save).
         """
-        import pickle
-        try:
-            with open(file_path, "rb") as f:
-                slip_info = pickle.load(f)
-            self.frames = []
-            for frame_rgba in slip_info["frames_rgba"]:
-                frame_surf = pygame.image.fromstring(frame_rgba, (slip_info["width"], slip_info["height"]), "RGBA")
-                self.frames.append(frame_surf)
-            self.current_frame = 0
-            self.top_screen = self.frames[self.current_frame]
+        self.finish_save()
+
+        def read(job):
+            if is_slip_container(file_path):
+                return SlipReader(file_path)
+            return read_slip_pickle(file_path)
+
+        def apply(note):
+            self.finish_save()
+            self.player.stop()
+            if isinstance(note, SlipReader):
+                self.frames.attach(note)
+                self.fps = note.fps
+                self.player.scheduler.set_fps(self.fps)
+            else:
+                self.frames.reset(note)
+                logging.info("Migrated a pickle-based slipnote; save it to convert it.")
+            self.history.clear()
+            self.active_background = None
+            self.unsaved_audio = None
+            self.note_path = file_path
+            self.open_journal(file_path)
+            self.goto_frame(0)
             logging.info(f"Loaded slipnote from {file_path}")
-        except Exception as e:
-            logging.error(f"Failed to load slipnote: {e}")
+
+        self.jobs.submit(f"Loading {os.path.basename(file_path)}", read, on_done=apply)
 
     def convert_slipnote(self, slip_file):
         """
-        Placeholder for converting .slip to MP4 or GIF.
-        Here, we just log success. In a real app, you'd use imageio/moviepy.
+        Export a slipnote from the slipnotes folder next to it as .gif, and
+        as .mp4 (with its own audio track) when ffmpeg is available.
+        Each export runs as a background job.
         """
-        base_name = os.path.splitext(slip_file)[0]
-        # e.g. slip_file = "my_slip.slip", base_name = "my_slip"
-        # Suppose we export "my_slip.mp4" and "my_slip.gif"
-        logging.info(f"Converted {slip_file} -> {base_name}.mp4, {base_name}.gif")
+        slip_path = os.path.join(self.slipnote_folder, slip_file)
+        base_path = os.path.splitext(slip_path)[0]
+        targets = [base_path + ".gif"]
+        if shutil.which("ffmpeg"):
+            targets.append(base_path + ".mp4")
+        else:
+            logging.info("ffmpeg not found; skipping MP4 export.")
+        for out_path in targets:
+            out_name = os.path.basename(out_path)
+
+            def export(job, out_path=out_path):
+                export_slipnote(slip_path, out_path, progress=job.report)
+
+            self.jobs.submit(f"Exporting {out_name}", export,
+                             on_done=lambda _, out_name=out_name: logging.info(f"Converted {slip_file} -> {out_name}"))
 
     # -------------------------------------------------------------------------
     # FPS & Microphone
     # -------------------------------------------------------------------------
     def select_fps(self):
         """Open a dialog to allow the user to select FPS (between 1 and 30)."""
-        root = tk.Tk()
-        root.withdraw()
-        new_fps = simpledialog.askinteger("Select FPS", "Enter FPS (1-30):",
-                                          minvalue=1, maxvalue=30, initialvalue=self.fps)
-        root.destroy()
-        if new_fps is not None:
-            self.fps = new_fps
-            logging.info("FPS set to %d", self.fps)
-        else:
-            logging.info("FPS selection cancelled; current FPS remains %d", self.fps)
+        def ask():
+            from tkinter import simpledialog
+            return simpledialog.askinteger("Select FPS", "Enter FPS (1-30):",
+                                           minvalue=1, maxvalue=30, initialvalue=self.fps)
+
+        def apply(new_fps):
+            if new_fps is not None:
+                self.fps = new_fps
+                self.player.scheduler.set_fps(new_fps)
+                logging.info("FPS set to %d", self.fps)
+            else:
+                logging.info("FPS selection cancelled; current FPS remains %d", self.fps)
+
+        self.show_dialog("FPS dialog", ask, apply)
 
     def select_microphone(self):
         """List available microphone devices and allow the user to select one."""
@@ -509,39 +5137,51 @@ class SlipnoteStudio:
             logging.error("PyAudio not available. Cannot select microphone.")
             return
 
-        import pyaudio
-        p = pyaudio.PyAudio()
-        device_list = []
-        for i in range(p.get_device_count()):
-            info = p.get_device_info_by_index(i)
-            if info.get("maxInputChannels", 0) > 0:
-                device_list.append((i, info.get("name", "Unknown")))
-        p.terminate()
+        self.audio_devices.start(self.selected_device)
 
-        if not device_list:
-            logging.error("No input devices found.")
-            return
+        def ask():
+            from tkinter import simpledialog
+            return simpledialog.askinteger("Select Microphone", "Enter microphone device index:",
+                                           minvalue=0, maxvalue=max(d[0] for d in self.audio_devices.devices),
+                                           initialvalue=self.selected_device)
+
+        def apply(mic_index):
+            if mic_index is not None:
+                self.selected_device = mic_index
+                self.use_virtual_mic = False
+                logging.info("Selected microphone device: %d", mic_index)
+                # Open the new device now rather than when R is pressed
+                self.jobs.submit("Open microphone", lambda job: self.audio_devices.warm(mic_index))
+            else:
+                logging.info("No microphone selected; defaulting to VirtualMicrophone.")
+                self.use_virtual_mic = True
 
-        logging.info("Available microphone devices:")
-        for dev in device_list:
-            logging.info("Device %d: %s", dev[0], dev[1])
+        def listed(_):
+            device_list = self.audio_devices.devices
+            if not device_list:
+                logging.error("No input devices found.")
+                apply(None)
+                return
+            logging.info("Available microphone devices:")
+            for dev in device_list:
+                logging.info("Device %d: %s", dev[0], dev[1])
+            self.show_dialog("Microphone dialog", ask, apply)
 
-        root = tk.Tk()
-        root.withdraw()
-        mic_index = simpledialog.askinteger("Select Microphone",
-                                            "Enter microphone device index:",
-                                            minvalue=0,
-                                            maxvalue=max(d[0] for d in device_list),
-                                            initialvalue=self.selected_device)
-        root.destroy()
+        # Enumerated once when the manager started; normally done already
+        self.jobs.submit("Listing microphones", lambda job: self.audio_devices.wait_ready(), on_done=listed)
 
-        if mic_index is not None:
-            self.selected_device = mic_index
-            self.use_virtual_mic = False
-            logging.info("Selected microphone device: %d", mic_index)
-        else:
-            logging.info("No microphone selected; defaulting to VirtualMicrophone.")
-            self.use_virtual_mic = True
+    def show_dialog(self, name, ask, apply):
+        """
+        Show a Tk dialog (see ask_dialog) on the main thread, where Tk has to
+        run, and hand the answer to `apply`. The dialog is modal, so the main
+        loop waits for it; anything slow that follows goes to self.jobs.
+        """
+        try:
+            answer = ask_dialog(ask)
+        except Exception as e:
+            logging.error("%s failed: %s", name, e)
+            return
+        apply(answer)
 
     # -------------------------------------------------------------------------
     # AUDIO RECORDING
@@ -550,6 +5190,7 @@ class SlipnoteStudio:
         """Start or stop recording audio."""
         if not self.is_recording:
             logging.info("Recording started (8-bit, mono).")
+            self.record_requested = time.perf_counter()
             self.is_recording = True
             self.audio_thread = threading.Thread(target=self.record_audio)
             self.audio_thread.start()
@@ -558,50 +5199,47 @@ class SlipnoteStudio:
             logging.info("Recording stopped.")
 
     def record_audio(self):
-        """Record audio until self.is_recording is False."""
-        chunk = 1024
-        rate = 44100
-        channels = 1  # mono
+        """Record audio until self.is_recording is False, streaming it to disk."""
+        devices = self.audio_devices
+        chunk = devices.chunk
+        rate = devices.rate
 
-        frames = []
+        self.recorder = WavStreamWriter(self.audio_file, rate=rate, channels=devices.channels)
+        try:
+            if devices.available and not self.use_virtual_mic:
+                try:
+                    # The stream was opened in the background; this only starts it
+                    stream = devices.open_input(self.selected_device)
+                    try:
+                        self.record_chunks(stream)
+                    finally:
+                        devices.close_input()
+                except Exception as e:
+                    logging.error("Error using PyAudio: %s", e)
+                    logging.info("Falling back to VirtualMicrophone.")
+                    self.use_virtual_mic = True
 
-        if PYAUDIO_AVAILABLE and not self.use_virtual_mic:
-            import pyaudio
-            p = pyaudio.PyAudio()
-            try:
-                stream = p.open(format=pyaudio.paInt8,
-                                channels=channels,
-                                rate=rate,
-                                input=True,
-                                frames_per_buffer=chunk,
-                                input_device_index=self.selected_device)
-                while self.is_recording:
-                    data = stream.read(chunk)
-                    frames.append(data)
-                stream.stop_stream()
-                stream.close()
-                p.terminate()
-            except Exception as e:
-                logging.error("Error using PyAudio: %s", e)
-                logging.info("Falling back to VirtualMicrophone.")
-                self.use_virtual_mic = True
-                p.terminate()
-
-        if self.use_virtual_mic:
-            logging.info("Using VirtualMicrophone for audio data...")
-            virtual_mic = VirtualMicrophone(chunk=chunk, rate=rate)
-            while self.is_recording:
-                data = virtual_mic.read(chunk)
-                frames.append(data)
-                time.sleep(0.01)
-
-        wf = wave.open(self.audio_file, 'wb')
-        wf.setnchannels(channels)
-        wf.setsampwidth(1)  # 1 byte = 8 bits
-        wf.setframerate(rate)
-        wf.writeframes(b''.join(frames))
-        wf.close()
+            if self.use_virtual_mic:
+                logging.info("Using VirtualMicrophone for audio data...")
+                self.record_chunks(VirtualMicrophone(chunk=chunk, rate=rate, **self.virtual_mic_options))
+        finally:
+            self.recorder.close()
+            self.invalidate(self.meter_rect)
         logging.info("Audio saved to %s", self.audio_file)
+        self.set_unsaved_audio(self.audio_file)
+
+    def record_chunks(self, source):
+        """Copy chunks from `source` (a stream or VirtualMicrophone) to the recorder while recording."""
+        chunk = self.audio_devices.chunk
+        first = True
+        while self.is_recording:
+            data = source.read(chunk)
+            self.recorder.write(data)
+            if first and self.record_requested is not None:
+                self.record_latency = time.perf_counter() - self.record_requested
+                logging.info("First samples after %.0f ms.", self.record_latency * 1000)
+                first = False
+            self.invalidate(self.meter_rect)
 
     def play_recorded_audio(self):
         """Play the recorded audio file."""
@@ -617,19 +5255,28 @@ class SlipnoteStudio:
     # -------------------------------------------------------------------------
     def load_audio(self):
         """Open a file dialog to select a WAV or MP3 file and load it."""
-        root = tk.Tk()
-        root.withdraw()
-        file_path = filedialog.askopenfilename(filetypes=[("Audio files", "*.wav *.mp3")])
-        root.destroy()
-        if file_path:
-            try:
-                pygame.mixer.music.load(file_path)
-                self.loaded_audio_path = file_path
-                logging.info("Audio file loaded: %s", file_path)
-            except pygame.error as e:
-                logging.error("Could not load the audio file: %s", e)
-        else:
-            logging.info("No file selected.")
+        def ask():
+            from tkinter import filedialog
+            return filedialog.askopenfilename(filetypes=[("Audio files", "*.wav *.mp3")])
+
+        def apply(file_path):
+            if file_path:
+                try:
+                    pygame.mixer.music.load(file_path)
+                    self.loaded_audio_path = file_path
+                    self.set_unsaved_audio(file_path)
+                    logging.info("Audio file loaded: %s", file_path)
+                except pygame.error as e:
+                    logging.error("Could not load the audio file: %s", e)
+            else:
+                logging.info("No file selected.")
+
+        self.show_dialog("Audio dialog", ask, apply)
+
+    def set_unsaved_audio(self, file_path):
+        """Make `file_path` the note's audio track; it is embedded on the next save."""
+        self.unsaved_audio = file_path
+        self.audio_version += 1
 
     def play_loaded_audio(self):
         """Play the loaded external audio file."""
@@ -640,5 +5287,313 @@ class SlipnoteStudio:
             logging.info("No audio file loaded. Press 'U' to load one.")
 
 
+# -----------------------------------------------------------------------------
+# BENCHMARKS
+# -----------------------------------------------------------------------------
+# Drive a headless editor through the same entry points the event loop
+# uses, on synthetic notes, and report timings as JSON so runs can be
+# compared over time.
+
+def _bench_result(count, seconds, unit="ops", nbytes=None):
+    """One timing record: totals plus per-op and per-second rates."""
+    result = {"count": count, "unit": unit, "seconds": round(seconds, 6),
+              "per_op_ms": round(1000 * seconds / count, 4) if count else None,
+              "per_second": round(count / seconds, 2) if seconds else None}
+    if nbytes is not None:
+        result["bytes"] = nbytes
+        result["mb_per_second"] = round(nbytes / seconds / 1e6, 2) if seconds else None
+    return result
+
+
+def _bench_strokes(studio, rng, strokes, segments):
+    """Draw random brush strokes on the current frame; returns (segments, seconds)."""
+    studio.tool_mode = "brush"
+    elapsed = 0.0
+    for _ in range(strokes):
+        x, y = rng.randrange(400), rng.randrange(240)
+        start = time.perf_counter()
+        studio.handle_create_mouse_down((x, y))
+        for segment in range(1, segments + 1):
+            x = min(399, max(0, x + rng.randint(-12, 12)))
+            y = min(239, max(0, y + rng.randint(-12, 12)))
+            studio.handle_create_mouse_motion((x, y))
+            if segment % 4 == 0:
+                # As if four motion events arrived per tick
+                studio.flush_stroke_input()
+        studio.handle_create_mouse_up((x, y))
+        elapsed += time.perf_counter() - start
+    return strokes * segments, elapsed
+
+
+def _bench_frame_pass(studio, order):
+    """Switch to every frame in `order` and redraw the window; returns seconds."""
+    start = time.perf_counter()
+    for index in order:
+        studio.goto_frame(index)
+        studio.draw_damage()
+    return time.perf_counter() - start
+
+
+def _bench_scrub(studio):
+    """
+    Drag across the filmstrip's overview bar from the first frame to the
+    last, one main loop tick per pixel; returns (ticks, seconds, worst tick).
+    """
+    bar = studio.filmstrip.bar_rect
+    studio.handle_create_mouse_down((bar.x, bar.centery))
+    ticks, worst = 0, 0.0
+    start = time.perf_counter()
+    for x in range(bar.x, bar.right):
+        tick = time.perf_counter()
+        studio.handle_create_mouse_motion((x, bar.centery))
+        studio.jobs.poll()
+        studio.update_filmstrip()
+        if studio.damage:
+            studio.draw_damage()
+        worst = max(worst, time.perf_counter() - tick)
+        ticks += 1
+    elapsed = time.perf_counter() - start
+    studio.handle_create_mouse_up((bar.right - 1, bar.centery))
+    return ticks, elapsed, worst
+
+
+def _bench_note(frame_count, folder, rng, workers):
+    """Run every benchmark on one synthetic note of `frame_count` frames."""
+    results = {}
+    studio = SlipnoteStudio(headless=True, folder=folder)
+    try:
+        studio.set_state("create")
+        studio.draw_damage()
+
+        start = time.perf_counter()
+        for _ in range(frame_count - 1):
+            studio.add_frame()
+        results["frame_add"] = _bench_result(frame_count - 1, time.perf_counter() - start, "frames")
+
+        segments = seconds = 0
+        for index in range(frame_count):
+            studio.goto_frame(index)
+            drawn, elapsed = _bench_strokes(studio, rng, strokes=3, segments=16)
+            segments += drawn
+            seconds += elapsed
+        results["stroke"] = _bench_result(segments, seconds, "segments")
+
+        # Bucket fills from random points, most of which flood the paper
+        studio.tool_mode = "fill"
+        studio.fill_gap = 2
+        fills = min(frame_count, 100)
+        start = time.perf_counter()
+        for index in range(fills):
+            studio.goto_frame(index)
+            studio.pen_color = ((255, 220, 0), (0, 0, 0))[index % 2]
+            studio.handle_create_mouse_down((rng.randrange(400), rng.randrange(240)))
+        results["fill"] = _bench_result(fills, time.perf_counter() - start, "fills")
+        studio.pen_color = (0, 0, 0)
+
+        order = list(range(frame_count))
+        results["frame_switch"] = _bench_result(frame_count, _bench_frame_pass(studio, order), "frames")
+        studio.onion_skin = True
+        results["onion_skin"] = _bench_result(frame_count, _bench_frame_pass(studio, order), "frames")
+        studio.onion_skin = False
+
+        # A background layer under every frame: first pass builds the composites
+        studio.add_background()
+        _bench_strokes(studio, rng, strokes=20, segments=16)
+        studio.active_background = None
+        results["frame_switch_layers"] = _bench_result(frame_count, _bench_frame_pass(studio, order), "frames")
+        studio.active_background = 0
+        studio.delete_background()
+
+        note_path = os.path.join(folder, "bench.slip")
+        start = time.perf_counter()
+        studio.save_slipnote(note_path)
+        studio.jobs.wait()
+        results["save"] = _bench_result(frame_count, time.perf_counter() - start, "frames",
+                                        os.path.getsize(note_path))
+
+        start = time.perf_counter()
+        studio.load_slipnote(note_path)
+        studio.jobs.wait()
+        results["load"] = _bench_result(frame_count, time.perf_counter() - start, "frames",
+                                        os.path.getsize(note_path))
+        # Frames now come from the file: first visits decode them
+        results["frame_switch_cold"] = _bench_result(frame_count, _bench_frame_pass(studio, order), "frames")
+        rng.shuffle(order)
+        results["frame_switch_random"] = _bench_result(frame_count, _bench_frame_pass(studio, order), "frames")
+        ticks, seconds, worst = _bench_scrub(studio)
+        results["scrub"] = _bench_result(ticks, seconds, "ticks")
+        results["scrub"]["worst_tick_ms"] = round(1000 * worst, 3)
+    finally:
+        studio.close()
+
+    formats = ["gif"] + (["mp4"] if shutil.which("ffmpeg") else [])
+    for fmt in formats:
+        out_path = os.path.join(folder, f"bench.{fmt}")
+        start = time.perf_counter()
+        export_slipnote(note_path, out_path, workers=workers)
+        results[f"export_{fmt}"] = _bench_result(frame_count, time.perf_counter() - start, "frames",
+                                                 os.path.getsize(out_path))
+    if PIL_AVAILABLE:
+        # And back: decode the GIF, dither it to the import palette and write a note
+        import_path = os.path.join(folder, "bench-import.slip")
+        start = time.perf_counter()
+        count = import_frames(os.path.join(folder, "bench.gif"), import_path, fps=30, workers=workers)
+        results["import_gif"] = _bench_result(count, time.perf_counter() - start, "frames",
+                                              os.path.getsize(import_path))
+
+    # Recorder: as much audio as the note lasts at 30 FPS, written as fast as it is generated
+    rate, chunk = 44100, 1024
+    chunks = max(1, frame_count * rate // 30 // chunk)
+    mic = VirtualMicrophone(chunk=chunk, rate=rate, seed=rng.random(), realtime=False)
+    recorder = WavStreamWriter(os.path.join(folder, "bench.wav"), rate=rate)
+    start = time.perf_counter()
+    for _ in range(chunks):
+        recorder.write(mic.read(chunk))
+    recorder.close()
+    results["recorder"] = _bench_result(chunks * chunk, time.perf_counter() - start, "samples", chunks * chunk)
+    return results
+
+
+_STARTUP_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import slipnote
+imported = time.perf_counter()
+studio = slipnote.SlipnoteStudio(headless=True, folder=sys.argv[1])
+studio.draw_damage()
+ready = time.perf_counter()
+studio.close()
+print(json.dumps([imported - start, ready - imported]))
+"""
+
+
+def _bench_startup(folder, runs=3):
+    """Cold start in fresh interpreters: module import, then studio up and first frame drawn."""
+    imports = []
+    inits = []
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, "-c", _STARTUP_PROBE, folder], env=env,
+                                capture_output=True, text=True, check=True).stdout
+        imported, ready = json.loads(output.strip().splitlines()[-1])
+        imports.append(imported)
+        inits.append(ready)
+    return {"import": _bench_result(runs, sum(imports), "runs"),
+            "first_frame": _bench_result(runs, sum(inits), "runs")}
+
+
+def _bench_record_latency(folder, takes=5):
+    """Time from starting a take to the first recorded samples (VirtualMicrophone)."""
+    studio = SlipnoteStudio(headless=True, folder=folder)
+    seconds = 0.0
+    try:
+        studio.use_virtual_mic = True
+        # Takes go to the bench's temporary folder, not the working directory
+        studio.audio_file = os.path.join(folder, "bench-take.wav")
+        for _ in range(takes):
+            studio.record_latency = None
+            studio.toggle_recording()
+            while studio.record_latency is None and studio.audio_thread.is_alive():
+                time.sleep(0.001)
+            studio.toggle_recording()
+            studio.audio_thread.join()
+            seconds += studio.record_latency or 0.0
+    finally:
+        studio.close()
+    return _bench_result(takes, seconds, "takes")
+
+
+def run_benchmarks(sizes=(10, 100, 1000), workers=None, seed=0):
+    """
+    Benchmark cold start and record latency, then stroke drawing, frame
+    add/switch, onion skin compositing, save/load, export and recording on
+    synthetic notes of each size in `sizes`. Returns a JSON-serializable
+    report.
+    """
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "pygame": pygame.version.ver,
+        "platform": platform.platform(),
+        "numpy": NUMPY_AVAILABLE,
+        "seed": seed,
+        "notes": {},
+    }
+    with tempfile.TemporaryDirectory(prefix="slipnote-bench-") as folder:
+        report["startup"] = _bench_startup(folder)
+        report["record_latency"] = _bench_record_latency(folder)
+    rng = random.Random(seed)
+    for frame_count in sizes:
+        with tempfile.TemporaryDirectory(prefix="slipnote-bench-") as folder:
+            report["notes"][str(frame_count)] = _bench_note(frame_count, folder, rng, workers)
+    return report
+
+
+def main(argv=None):
+    """Start the editor, or run a headless subcommand (see --help)."""
+    parser = argparse.ArgumentParser(prog="slipnote.py", description="Slipnote Studio")
+    commands = parser.add_subparsers(dest="command")
+    export = commands.add_parser("export", help="convert a .slip (or a folder of them) to GIF/MP4")
+    export.add_argument("source", help=".slip file or folder of .slip files")
+    export.add_argument("target", help="output .gif/.mp4 file, or output folder for a source folder")
+    export.add_argument("--format", choices=("gif", "mp4"), default="gif",
+                        help="output format when converting a folder (default: gif)")
+    export.add_argument("--audio", help="audio track to mux into MP4 output")
+    export.add_argument("--jobs", type=int, default=None, help="worker processes (default: one per core)")
+    export.add_argument("--scale", type=int, choices=(1, 2, 4), default=1,
+                        help="render at 2x or 4x the note's resolution (strokes are redrawn, not enlarged)")
+    imports = commands.add_parser("import", help="make a .slip from a GIF, a video or an image sequence")
+    imports.add_argument("source", help="GIF, video file (needs ffmpeg), folder of images or glob pattern")
+    imports.add_argument("target", help="output .slip file")
+    imports.add_argument("--fps", type=int, choices=range(1, 31), metavar="1-30", default=None,
+                         help="note frame rate (default: the source's own, 30 for image sequences)")
+    imports.add_argument("--palette", choices=sorted(IMPORT_PALETTES), default="colour",
+                         help="colour: white, black, red and blue (default); mono: black and white")
+    imports.add_argument("--no-dither", dest="dither", action="store_false",
+                         help="map each pixel to the nearest colour instead of dithering")
+    imports.add_argument("--jobs", type=int, default=None, help="worker processes (default: one per core)")
+    bench = commands.add_parser("bench", help="benchmark editor operations headless, report as JSON")
+    bench.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000],
+                       help="frame counts of the synthetic notes (default: 10 100 1000)")
+    bench.add_argument("--jobs", type=int, default=None, help="export worker processes (default: one per core)")
+    bench.add_argument("--seed", type=int, default=0, help="seed for the synthetic drawings")
+    bench.add_argument("--output", help="write the JSON report to this file instead of stdout")
+    args = parser.parse_args(argv)
+
+    if args.command == "export":
+        if os.path.isdir(args.source):
+            return 1 if export_directory(args.source, args.target, args.format, args.jobs, args.scale) else 0
+        try:
+            export_slipnote(args.source, args.target, audio_path=args.audio, workers=args.jobs,
+                            scale=args.scale)
+        except Exception as e:
+            logging.error("Failed to export %s: %s", args.source, e)
+            return 1
+        logging.info("Exported %s -> %s", args.source, args.target)
+        return 0
+
+    if args.command == "import":
+        try:
+            count = import_frames(args.source, args.target, args.fps, args.palette, args.dither, args.jobs)
+        except Exception as e:
+            logging.error("Failed to import %s: %s", args.source, e)
+            return 1
+        logging.info("Imported %s -> %s (%d frames)", args.source, args.target, count)
+        return 0
+
+    if args.command == "bench":
+        logging.getLogger().setLevel(logging.WARNING)
+        report = json.dumps(run_benchmarks(args.sizes, args.jobs, args.seed), indent=2)
+        if args.output:
+            with open(args.output, "w") as f:
+                f.write(report + "\n")
+        else:
+            print(report)
+        return 0
+
+    SlipnoteStudio().run()
+    return 0
+
+
 if __name__ == "__main__":
-    SlipnoteStudio()
+    sys.exit(main())